@@ -0,0 +1,360 @@
+# -*- coding: utf-8 -*-
+"""
+    pyrseas.capture
+    ~~~~~~~~~~~~~~~
+
+    A `RecordingDbConnection` is a catalog connection that saves the
+    results of the queries it runs to a capture file.  A
+    `ReplayDbConnection` answers the same queries from that file,
+    without a server, so that the catalogs of a database can be
+    fetched, e.g., to benchmark or test :class:`Database`, on any
+    machine.
+
+    A capture file is gzip-compressed JSON.  The queries are keyed by
+    the server version and by their text, with the whitespace
+    normalized, preceded by the statements run without fetching rows
+    earlier in the same transaction, if any.  Their results are stored
+    as the column names and the list of the values of each row.  A
+    query that returned different results during a run is marked as
+    such, and cannot be replayed.  A statement that failed is stored
+    with its error, which is raised again when it is replayed.
+"""
+import gzip
+import json
+import os
+from io import BytesIO
+
+from psycopg2 import DatabaseError
+
+from pyrseas.database import CatDbConnection
+from pyrseas.mapwriter import replace_file
+from pyrseas.timings import count_query
+
+CAPTURE_FORMAT = 1
+
+
+def query_key(query, args=None, setup=None):
+    """Return the key of a query in a capture file
+
+    :param query: text of the query
+    :param args: arguments to the query
+    :param setup: list of the keys of the statements run before the
+        query in the same transaction, e.g., to create a temporary
+        view that the query deparses
+    :return: the query with its whitespace normalized, followed by the
+        arguments as JSON, if any, and preceded by the setup
+        statements, each followed by a semicolon
+    """
+    key = ' '.join(query.split())
+    if args:
+        key += '\0' + json.dumps(args, sort_keys=True, default=str)
+    if setup:
+        key = ''.join(stmt + '; ' for stmt in setup) + key
+    return key
+
+
+def read_capture(path):
+    """Read the queries of a capture file
+
+    :param path: file path
+    :return: dictionary of the results of the queries, by server
+        version and query key
+    """
+    with gzip.GzipFile(path, 'rb') as f:
+        capture = json.loads(f.read().decode('utf-8'))
+    if capture.get('format') != CAPTURE_FORMAT:
+        raise ValueError("Unsupported capture file format: %s" % path)
+    return dict((int(version), queries)
+                for (version, queries) in capture['servers'].items())
+
+
+def write_capture(path, servers):
+    """Write the queries of a capture file
+
+    :param path: file path
+    :param servers: dictionary of the results of the queries, by
+        server version and query key
+
+    Values that JSON cannot represent, e.g., Decimal, are stored as
+    text.
+    """
+    data = json.dumps({'format': CAPTURE_FORMAT, 'servers': dict(
+        (str(version), queries) for (version, queries) in servers.items())},
+        sort_keys=True, separators=(',', ':'), default=str)
+    buf = BytesIO()
+    # no timestamp, so the same capture gives the same file
+    with gzip.GzipFile(fileobj=buf, mode='wb', mtime=0) as f:
+        f.write(data.encode('utf-8'))
+    replace_file(path, buf.getvalue())
+
+
+class CapturedRow(list):
+    """A row replayed from a capture file
+
+    As a psycopg2 DictRow, the values can be accessed by position or
+    by column name.
+    """
+
+    def __init__(self, values, index):
+        super(CapturedRow, self).__init__(values)
+        self._index = index
+
+    def __getitem__(self, key):
+        if not isinstance(key, (int, slice)):
+            key = self._index[key]
+        return super(CapturedRow, self).__getitem__(key)
+
+    def keys(self):
+        return sorted(self._index, key=self._index.get)
+
+    def values(self):
+        return list(self)
+
+    def items(self):
+        return [(key, self[key]) for key in self.keys()]
+
+    def get(self, key, default=None):
+        return self[key] if key in self._index else default
+
+
+class ReplayCursor(object):
+    """A cursor returning the rows of a query from a capture file"""
+
+    def __init__(self, query, result):
+        self.query = query
+        self.result = result
+
+    def fetchall(self):
+        """Return the rows of the query
+
+        :return: list of CapturedRow's
+        """
+        if self.result is None:
+            raise KeyError("Query not captured: %s" % ' '.join(
+                self.query.split()))
+        if self.result.get('varies'):
+            raise ValueError("Query with varying results: %s" % ' '.join(
+                self.query.split()))
+        index = dict((col, i) for (i, col) in
+                     enumerate(self.result['columns']))
+        return [CapturedRow(row, index) for row in self.result['rows']]
+
+    def fetchone(self):
+        """Return the first row of the query
+
+        :return: CapturedRow, or None
+        """
+        rows = self.fetchall()
+        return rows[0] if rows else None
+
+    def close(self):
+        pass
+
+
+class CaptureDbConnection(CatDbConnection):
+    """A catalog connection keying its queries as in a capture file
+
+    The statements run without fetching their rows, e.g., SET, are
+    kept until the transaction ends, to key the queries that follow
+    them (see :func:`query_key`).  The same query may thus return
+    different rows after different statements, e.g., when deparsing
+    successive temporary views of the same name.
+    """
+
+    def __init__(self, *args, **kwargs):
+        super(CaptureDbConnection, self).__init__(*args, **kwargs)
+        self.setup = []
+        self._fetching = False
+
+    def key(self, query, args=None):
+        """Return the key of a query run now
+
+        :param query: text of the query
+        :param args: arguments to the query
+        :return: string
+        """
+        return query_key(query, args, self.setup)
+
+    def _execute(self, key, query, args=None):
+        return super(CaptureDbConnection, self).execute(query, args)
+
+    def execute(self, query, args=None):
+        """Execute a query, keeping it if its rows are not fetched"""
+        key = self.key(query, args)
+        if not self._fetching:
+            self.setup.append(query_key(query, args))
+        try:
+            return self._execute(key, query, args)
+        except DatabaseError:
+            # the transaction was rolled back
+            self.setup = []
+            raise
+
+    def fetchone(self, query, args=None):
+        """Execute a single row SELECT query and return the row"""
+        self._fetching = True
+        try:
+            return super(CaptureDbConnection, self).fetchone(query, args)
+        finally:
+            self._fetching = False
+
+    def fetchall(self, query, args=None):
+        """Execute a SELECT query and return the rows"""
+        self._fetching = True
+        try:
+            return super(CaptureDbConnection, self).fetchall(query, args)
+        finally:
+            self._fetching = False
+
+    def commit(self):
+        """Commit the current transaction"""
+        self.setup = []
+        super(CaptureDbConnection, self).commit()
+
+    def rollback(self):
+        """Roll back the current transaction"""
+        self.setup = []
+        super(CaptureDbConnection, self).rollback()
+
+
+class RecordingDbConnection(CaptureDbConnection):
+    """A catalog connection saving the query results to a capture file
+
+    The results of the queries are kept in memory until :meth:`save`
+    is called.  The statements run without fetching their rows, e.g.,
+    SET, are not recorded, unless they fail.
+    """
+
+    def __init__(self, dbname, user=None, pswd=None, host=None, port=None,
+                 path=None):
+        """Initialize the connection information
+
+        :param path: path to the capture file
+        """
+        super(RecordingDbConnection, self).__init__(dbname, user, pswd,
+                                                    host, port)
+        self.path = path
+        self.queries = {}
+        self.partial = set()
+
+    def _execute(self, key, query, args=None):
+        try:
+            return super(RecordingDbConnection, self)._execute(key, query,
+                                                               args)
+        except DatabaseError as exc:
+            self.queries[key] = {'error': str(exc).strip()}
+            self.partial.discard(key)
+            raise
+
+    def record(self, query, args, rows, partial=False):
+        """Record the rows fetched by a query
+
+        :param query: text of the query
+        :param args: arguments to the query
+        :param rows: list of rows
+        :param partial: only the first row was fetched
+
+        If the query was already recorded with other rows, it is marked
+        as varying, since replaying either result would be wrong.
+        """
+        key = self.key(query, args)
+        values = [list(row) for row in rows]
+        old = self.queries.get(key)
+        if old is None:
+            self.queries[key] = {
+                'columns': list(rows[0].keys()) if rows else [],
+                'rows': values}
+            if partial:
+                self.partial.add(key)
+        elif old.get('varies') or 'error' in old:
+            self.queries[key] = {'varies': True}
+        elif partial or key in self.partial:
+            if old['rows'][:1] != values[:1]:
+                self.queries[key] = {'varies': True}
+            elif not partial:
+                # keep all the rows of a query fetched in full
+                self.queries[key]['rows'] = values
+                self.partial.discard(key)
+        elif old['rows'] != values:
+            self.queries[key] = {'varies': True}
+
+    def fetchone(self, query, args=None):
+        """Execute a single row SELECT query, recording the row"""
+        row = super(RecordingDbConnection, self).fetchone(query, args)
+        self.record(query, args, [] if row is None else [row], True)
+        return row
+
+    def fetchall(self, query, args=None):
+        """Execute a SELECT query, recording the rows"""
+        rows = super(RecordingDbConnection, self).fetchall(query, args)
+        self.record(query, args, rows)
+        return rows
+
+    def save(self):
+        """Save the recorded queries to the capture file
+
+        The queries already in the file, e.g., from other runs against
+        the same database, are kept unless they were run again.
+        """
+        if not self.queries:
+            return
+        servers = {}
+        if os.path.exists(self.path):
+            servers = read_capture(self.path)
+        servers.setdefault(self._version, {}).update(self.queries)
+        write_capture(self.path, servers)
+
+
+class ReplayDbConnection(CaptureDbConnection):
+    """A catalog connection answering the queries from a capture file
+
+    No server is connected to: transactions are ignored and statements
+    that were not recorded, e.g., SET, do nothing, but fetching the
+    rows of a query that was not recorded raises a KeyError, and those
+    of a query whose results varied a ValueError.  A statement that
+    failed when recorded raises a DatabaseError.
+    """
+
+    def __init__(self, dbname, path, version=None):
+        """Initialize the connection from a capture file
+
+        :param dbname: database name
+        :param path: path to the capture file
+        :param version: server version to replay (default the highest
+            recorded)
+        """
+        super(ReplayDbConnection, self).__init__(dbname)
+        servers = read_capture(path)
+        if version is None and servers:
+            version = max(servers)
+        if version not in servers:
+            raise ValueError("No queries of server version %s in %s" % (
+                version, path))
+        self._version = version
+        self.queries = servers[version]
+
+    def connect(self):
+        pass
+
+    def close(self):
+        pass
+
+    def commit(self):
+        self.setup = []
+
+    def rollback(self):
+        self.setup = []
+
+    def _execute(self, key, query, args=None):
+        """Return a cursor over the recorded rows of a query
+
+        :param key: key of the query
+        :param query: text of the query
+        :param args: arguments to query
+        :return: ReplayCursor
+        """
+        count_query()
+        result = self.queries.get(key)
+        if result is not None and 'error' in result:
+            raise DatabaseError(result['error'])
+        return ReplayCursor(query, result)
@@ -5,9 +5,8 @@ import os
 from argparse import ArgumentParser, FileType
 import getpass
 
-import yaml
-
 from pyrseas.config import Config
+from pyrseas.yamlutil import yamlload
 
 _cfg = None
 
@@ -66,6 +65,19 @@ def cmd_parser(description, version):
                         help="root of repository (default %(default)s)")
     parent.add_argument('-o', '--output', type=FileType('w'),
                         help="output file name (default stdout)")
+    parent.add_argument('--timings', action='store_true',
+                        help="output the time and catalog queries taken by "
+                        "each stage to stderr")
+    parent.add_argument('--timings-json', metavar='FILE',
+                        help="append the timings of each stage to FILE, as "
+                        "JSON lines")
+    capture = parent.add_mutually_exclusive_group()
+    capture.add_argument('--record-catalogs', metavar='FILE',
+                         help="save the results of the catalog queries to "
+                         "FILE")
+    capture.add_argument('--replay-catalogs', metavar='FILE',
+                         help="answer the catalog queries from FILE, saved "
+                         "by --record-catalogs, without a server")
     parser = ArgumentParser(parents=[parent], description=description)
     parser.add_argument('--version', action='version',
                         version='%(prog)s ' + '%s' % version)
@@ -97,7 +109,7 @@ def parse_args(parser):
         tfr('files', key, args[key])
 
     if 'config' in _cfg['files'] and _cfg['files']['config']:
-        _cfg.merge(yaml.safe_load(_cfg['files']['config']))
+        _cfg.merge(yamlload(_cfg['files']['config']))
     if 'repository' in args:
         if args['repository'] != os.getcwd():
             _cfg['repository']['path'] = args['repository']
@@ -4,8 +4,7 @@
 import os
 import sys
 
-import yaml
-
+from pyrseas.yamlutil import yamlload
 
 CFG_FILE = os.environ.get("PYRSEAS_CONFIG_FILE", "config.yaml")
 
@@ -28,7 +27,7 @@ def _load_cfg(cfgdir):
             cfgpath = cfgdir
         if os.path.exists(cfgpath):
             with open(cfgpath) as f:
-                cfg = yaml.safe_load(f)
+                cfg = yamlload(f)
     return cfg
 
 
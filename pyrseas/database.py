@@ -10,16 +10,25 @@
     system catalogs.  The `ndb` Dicts object defines the schemas based
     on the `input_map` supplied to the `from_map` method.
 """
+import atexit
 import os
 import sys
 from operator import itemgetter
 from collections import defaultdict, deque
-import yaml
+from multiprocessing import Pool
 
+from psycopg2 import DatabaseError
 from pgdbconn.dbconn import DbConnection
 
-from pyrseas.yamlutil import yamldump
+from pyrseas.mapcache import MapCache
+from pyrseas.mapwriter import MapWriter, manifest_name
+from pyrseas.datacopy import BulkLoad, DataExporter, TRACKING_SCHEMA
+from pyrseas.datacopy import TRACKING_TABLE, loaded_checksums
+from pyrseas.formats import format_of_file, map_format
+from pyrseas.timings import count_query, count_rows, timed
 from pyrseas.dbobject import fetch_reserved_words, DbObjectDict, DbSchemaObject
+from pyrseas.dbobject import DeferredStmt, quote_id, normalize_sql
+from pyrseas.dbobject.privileges import GrantStmt, holds_privileges
 from pyrseas.dbobject.language import LanguageDict
 from pyrseas.dbobject.cast import CastDict
 from pyrseas.dbobject.schema import SchemaDict
@@ -55,6 +64,45 @@ def flatten(lst):
             yield elem
 
 
+def load_map_file(path):
+    """Load a map from a file in the metadata directory
+
+    :param path: file path
+    :return: dictionary (empty if the file does not hold a map)
+
+    The format of the file is given by its extension (see
+    :func:`~pyrseas.formats.format_of_file`).  This is a module-level
+    function so that it can be called in worker processes.
+    """
+    with open(path, 'rb') as f:
+        objmap = (format_of_file(path) or map_format()).load(f.read())
+    return objmap if isinstance(objmap, dict) else {}
+
+
+def schema_files(subdir, ext):
+    """List the object files in a schema directory
+
+    :param subdir: schema directory path
+    :param ext: extension of the files, including the dot
+    :return: list of file paths, in sorted order
+
+    The files may be directly in the directory or, in the 'sharded'
+    layout, in its subdirectories.
+    """
+    objfiles = []
+    if not os.path.isdir(subdir):
+        return objfiles
+    for entry in sorted(os.listdir(subdir)):
+        path = os.path.join(subdir, entry)
+        if os.path.isdir(path):
+            objfiles.extend(os.path.join(path, schobj)
+                            for schobj in sorted(os.listdir(path))
+                            if schobj.endswith(ext))
+        elif entry.endswith(ext):
+            objfiles.append(path)
+    return objfiles
+
+
 class CatDbConnection(DbConnection):
     """A database connection, specialized for querying catalogs"""
 
@@ -77,6 +125,24 @@ class CatDbConnection(DbConnection):
             self.connect()
         return self._version
 
+    def execute(self, query, args=None):
+        """Execute a query, counting it for the timings of the stages"""
+        count_query()
+        return super(CatDbConnection, self).execute(query, args)
+
+    def fetchone(self, query, args=None):
+        """Execute a single row SELECT query, counting the row fetched"""
+        row = super(CatDbConnection, self).fetchone(query, args)
+        if row is not None:
+            count_rows([row])
+        return row
+
+    def fetchall(self, query, args=None):
+        """Execute a SELECT query, counting the rows fetched"""
+        rows = super(CatDbConnection, self).fetchall(query, args)
+        count_rows(rows)
+        return rows
+
 
 class Database(object):
     """A database definition, from its catalogs and/or a YAML spec."""
@@ -200,12 +266,31 @@ class Database(object):
         """Initialize the database
 
         :param config: configuration dictionary
+
+        With the `record_catalogs` option, the results of the catalog
+        queries are saved to that capture file when the program exits.
+        With the `replay_catalogs` option, they are read from such a
+        file instead of from the server (see :mod:`pyrseas.capture`).
         """
         db = config['database']
-        self.dbconn = CatDbConnection(db['dbname'], db['username'],
-                                      db['password'], db['host'], db['port'])
+        opts = config.get('options')
+        if getattr(opts, 'replay_catalogs', None):
+            from pyrseas.capture import ReplayDbConnection
+            self.dbconn = ReplayDbConnection(db['dbname'],
+                                             opts.replay_catalogs)
+        elif getattr(opts, 'record_catalogs', None):
+            from pyrseas.capture import RecordingDbConnection
+            self.dbconn = RecordingDbConnection(
+                db['dbname'], db['username'], db['password'], db['host'],
+                db['port'], opts.record_catalogs)
+            atexit.register(self.dbconn.save)
+        else:
+            self.dbconn = CatDbConnection(db['dbname'], db['username'],
+                                          db['password'], db['host'],
+                                          db['port'])
         self.db = None
         self.config = config
+        self.bulk_load = None
 
     def _link_refs(self, db):
         """Link related objects"""
@@ -346,91 +431,166 @@ class Database(object):
         the dictionary are then linked to related objects, e.g.,
         columns are linked to the tables they belong.
         """
-        self.db = self.Dicts(self.dbconn, single_db)
-        self._build_dependency_graph(self.db, self.dbconn)
-        if self.dbconn.conn:
-            self.dbconn.conn.close()
-        self._link_refs(self.db)
+        with timed('read catalogs'):
+            self.db = self.Dicts(self.dbconn, single_db)
+            with timed('dependency graph'):
+                self._build_dependency_graph(self.db, self.dbconn)
+            if self.dbconn.conn:
+                self.dbconn.conn.close()
+            with timed('link references'):
+                self._link_refs(self.db)
 
     def from_map(self, input_map, langs=None):
         """Populate the new database objects from the input map
 
-        :param input_map: a YAML map defining the new database
+        :param input_map: a YAML map defining the new database, or an
+            iterable of its (key, value) pairs
         :param langs: list of language templates
 
         The `ndb` holder is populated by various DbObjectDict-derived
         classes by traversing the YAML input map. The objects in the
         dictionary are then linked to related objects, e.g., columns
         are linked to the tables they belong.
+
+        Each schema is converted as soon as it is found, so that when
+        the pairs are loaded one at a time (see
+        :func:`~pyrseas.yamlutil.yamlload_items`) its input map can be
+        released before the next one is read.
         """
         self.ndb = self.Dicts()
-        input_schemas = {}
+        if isinstance(input_map, dict):
+            input_map = input_map.items()
         input_extens = {}
         input_langs = {}
         input_casts = {}
         input_fdws = {}
         input_ums = {}
         input_evttrigs = {}
-        for key in input_map:
+        for (key, inobj) in input_map:
             if key.startswith('schema '):
-                input_schemas.update({key: input_map[key]})
+                self.ndb.schemas.from_map({key: inobj}, self.ndb)
             elif key.startswith('extension '):
-                input_extens.update({key: input_map[key]})
+                input_extens.update({key: inobj})
             elif key.startswith('language '):
-                input_langs.update({key: input_map[key]})
+                input_langs.update({key: inobj})
             elif key.startswith('cast '):
-                input_casts.update({key: input_map[key]})
+                input_casts.update({key: inobj})
             elif key.startswith('foreign data wrapper '):
-                input_fdws.update({key: input_map[key]})
+                input_fdws.update({key: inobj})
             elif key.startswith('user mapping for '):
-                input_ums.update({key: input_map[key]})
+                input_ums.update({key: inobj})
             elif key.startswith('event trigger '):
-                input_evttrigs.update({key: input_map[key]})
+                input_evttrigs.update({key: inobj})
             else:
                 raise KeyError("Expected typed object, found '%s'" % key)
         self.ndb.extensions.from_map(input_extens, langs, self.ndb)
         self.ndb.languages.from_map(input_langs)
-        self.ndb.schemas.from_map(input_schemas, self.ndb)
         self.ndb.casts.from_map(input_casts, self.ndb)
         self.ndb.fdwrappers.from_map(input_fdws, self.ndb)
         self.ndb.eventtrigs.from_map(input_evttrigs, self.ndb)
         self._link_refs(self.ndb)
 
-    def map_from_dir(self):
+    def map_from_dir(self, jobs=None, cache=None):
         """Read the database maps starting from the metadata directory
 
+        :param jobs: number of processes to parse the files with
+        :param cache: use a cache of parsed files: 'stat' or 'digest'
         :return: dictionary
+
+        The files are listed first, in sorted order, so that the
+        result does not depend on the order of the directory entries.
+        If `jobs` (by default, the `jobs` option) is greater than one,
+        the files are parsed by a pool of that many processes.  The
+        maps are then merged in the order in which they were listed.
+
+        If `cache` (by default, the `cache` option) is set, the parsed
+        maps are kept in a :class:`~pyrseas.mapcache.MapCache` in the
+        user's cache directory.
+        Only the files whose modification time or size changed (or, with
+        'digest', whose contents changed) since they were cached are
+        parsed.
+
+        If the directory has a manifest, as output with the 'sharded'
+        layout, the object files of each schema are those it lists.
+        Otherwise, the schema directories are listed, including their
+        shard subdirectories.
         """
         metadata_dir = self.config['files']['metadata_path']
         if not os.path.isdir(metadata_dir):
             sys.exit("Metadata directory '%s' doesn't exist" % metadata_dir)
-
-        def load(subdir, obj):
-            with open(os.path.join(subdir, obj), 'r') as f:
-                objmap = yaml.safe_load(f)
-            return objmap if isinstance(objmap, dict) else {}
+        opts = self.config.get('options')
+        if jobs is None:
+            jobs = getattr(opts, 'jobs', None) or 1
+        if cache is None:
+            cache = getattr(opts, 'cache', None)
+
+        mapfmt = map_format(getattr(opts, 'format', None) or 'yaml')
+        ext = '.' + mapfmt.ext
+        manifest = None
+        manifest_path = os.path.join(metadata_dir, manifest_name(mapfmt.ext))
+        if os.path.exists(manifest_path):
+            manifest = load_map_file(manifest_path)['files']
+
+        # each entry is a top-level object file, or a schema file with the
+        # list of files in the schema directory, if any
+        entries = []
+        for entry in sorted(os.listdir(metadata_dir)):
+            # skip over unknown files/dirs
+            if not entry.endswith(ext) or entry.startswith('database.') or \
+                    entry == os.path.basename(manifest_path):
+                continue
+            path = os.path.join(metadata_dir, entry)
+            if not entry.startswith('schema.'):
+                entries.append((path, None))
+                continue
+            if manifest is not None:
+                objfiles = [os.path.join(metadata_dir, *relpath.split('/'))
+                            for relpath in manifest.get(entry, [])]
+            else:
+                objfiles = schema_files(path[:-len(ext)], ext)
+            # read schema.xxx.yaml first
+            entries.append((path, objfiles))
+
+        paths = []
+        for (path, objfiles) in entries:
+            paths.append(path)
+            paths.extend(objfiles or [])
+        maps = {}
+        if cache:
+            mapcache = MapCache(metadata_dir, cache == 'digest')
+            for path in paths:
+                objmap = mapcache.get(path)
+                if objmap is not None:
+                    maps[path] = objmap
+            paths = [path for path in paths if path not in maps]
+        if jobs > 1 and len(paths) > 1:
+            pool = Pool(min(jobs, len(paths)))
+            try:
+                parsed = pool.map(load_map_file, paths,
+                                  max(1, len(paths) // (jobs * 4)))
+            finally:
+                pool.close()
+                pool.join()
+        else:
+            parsed = [load_map_file(path) for path in paths]
+        if cache:
+            for (path, objmap) in zip(paths, parsed):
+                mapcache.put(path, objmap)
+            # saved before the merge below updates the schema maps in place
+            mapcache.save()
+        maps.update(zip(paths, parsed))
 
         inmap = {}
-        for entry in os.listdir(metadata_dir):
-            if entry.endswith('.yaml'):
-                if entry.startswith('database.'):
-                    continue
-                if not entry.startswith('schema.'):
-                    inmap.update(load(metadata_dir, entry))
-            else:
-                # skip over unknown files/dirs
-                if not entry.startswith('schema.'):
-                    continue
-                # read schema.xxx.yaml first
-                schmap = load(metadata_dir, entry + '.yaml')
-                assert(len(schmap) == 1)
-                key = list(schmap.keys())[0]
-                inmap.update({key: {}})
-                subdir = os.path.join(metadata_dir, entry)
-                if os.path.isdir(subdir):
-                    for schobj in os.listdir(subdir):
-                        schmap[key].update(load(subdir, schobj))
-                inmap.update(schmap)
+        for (path, objfiles) in entries:
+            if objfiles is None:
+                inmap.update(maps[path])
+                continue
+            schmap = maps[path]
+            assert(len(schmap) == 1)
+            key = list(schmap.keys())[0]
+            for objfile in objfiles:
+                schmap[key].update(maps[objfile])
+            inmap.update(schmap)
 
         return inmap
 
@@ -438,44 +598,93 @@ class Database(object):
         """Convert the db maps to a single hierarchy suitable for YAML
 
         :return: a YAML-suitable dictionary (without any Python objects)
+
+        With the `multiple_files` option, the objects are output to
+        files in the metadata directory through a
+        :class:`~pyrseas.mapwriter.MapWriter`: only the files whose
+        contents changed are rewritten and only those of objects that
+        no longer exist are removed.
         """
         if not self.db:
             self.from_catalog(True)
 
         opts = self.config['options']
-
-        def mkdir_parents(dir):
-            head, tail = os.path.split(dir)
-            if head and not os.path.isdir(head):
-                mkdir_parents(head)
-            if tail:
-                os.mkdir(dir)
-
         if opts.multiple_files:
             opts.metadata_dir = self.config['files']['metadata_path']
             if not os.path.exists(opts.metadata_dir):
-                mkdir_parents(opts.metadata_dir)
-            dbfilepath = os.path.join(opts.metadata_dir, 'database.%s.yaml' %
-                                      self.dbconn.dbname)
+                os.makedirs(opts.metadata_dir)
+            mapfmt = map_format(getattr(opts, 'format', None) or 'yaml')
+            dbfilepath = os.path.join(opts.metadata_dir, 'database.%s.%s' % (
+                self.dbconn.dbname, mapfmt.ext))
+            # the files previously output, to remove those whose objects
+            # no longer exist
+            oldfiles = set()
             if os.path.exists(dbfilepath):
-                with open(dbfilepath, 'r') as f:
-                    objmap = yaml.safe_load(f)
-                for obj, val in list(objmap.items()):
+                objmap = load_map_file(dbfilepath)
+                for val in objmap.values():
                     if isinstance(val, dict):
-                        dirpath = ''
-                        for schobj, fpath in list(val.items()):
-                            filepath = os.path.join(opts.metadata_dir, fpath)
-                            if os.path.exists(filepath):
-                                os.remove(filepath)
-                                if schobj == 'schema':
-                                    (dirpath, ext) = os.path.splitext(filepath)
-                        if os.path.exists(dirpath):
-                            os.rmdir(dirpath)
+                        oldfiles.update(val.values())
                     else:
-                        filepath = os.path.join(opts.metadata_dir, val)
-                        if (os.path.exists(filepath)):
-                            os.remove(filepath)
+                        oldfiles.add(val)
+            opts.writer = MapWriter(
+                opts.metadata_dir,
+                int((getattr(opts, 'write_budget', None) or 64) * 1048576),
+                getattr(opts, 'durability', None) or 'atomic', mapfmt,
+                getattr(opts, 'layout', None) or 'flat')
+
+        with timed('convert map'):
+            dbmap = self._nonschema_map(opts)
+            dbmap.update(self.db.schemas.to_map(self.db, opts))
+        if 'datacopy' in self.config:
+            try:
+                opts.data_exporter.finish()
+            finally:
+                del opts.data_exporter
 
+        if opts.multiple_files:
+            opts.writer.add(os.path.basename(dbfilepath), dbmap)
+            opts.writer.finish(oldfiles)
+
+        return dbmap
+
+    def iter_map(self):
+        """Generate the db map one top-level object at a time
+
+        :return: generator of (key, value) pairs, in sorted key order
+
+        Unlike :meth:`to_map`, each schema is converted only when its
+        turn comes, so that the maps of the schemas already output can
+        be released.  This is only used for single file output.
+        """
+        if not self.db:
+            self.from_catalog(True)
+
+        opts = self.config['options']
+        dbmap = self._nonschema_map(opts)
+        schemas = dict((sch.extern_key(), sch) for sch in
+                       self.db.schemas.selected(opts))
+        for key in sorted(set(dbmap) | set(schemas)):
+            if key in schemas:
+                schmap = schemas[key].to_map(self.db, self.db.schemas, opts)
+                for item in schmap.items():
+                    yield item
+            else:
+                yield (key, dbmap.pop(key))
+        if 'datacopy' in self.config:
+            try:
+                opts.data_exporter.finish()
+            finally:
+                del opts.data_exporter
+
+    def _nonschema_map(self, opts):
+        """Convert the objects not owned by schemas to a YAML-suitable map
+
+        :param opts: options to include/exclude information, etc.
+        :return: dictionary
+
+        This also prepares the data directory and the exporter, if any
+        tables are to be copied out when their schemas are mapped.
+        """
         dbmap = self.db.extensions.to_map(self.db, opts)
         dbmap.update(self.db.languages.to_map(self.db, opts))
         dbmap.update(self.db.casts.to_map(self.db, opts))
@@ -484,19 +693,203 @@ class Database(object):
         if 'datacopy' in self.config:
             opts.data_dir = self.config['files']['data_path']
             if not os.path.exists(opts.data_dir):
-                mkdir_parents(opts.data_dir)
-        dbmap.update(self.db.schemas.to_map(self.db, opts))
+                os.makedirs(opts.data_dir)
+            opts.data_exporter = DataExporter(
+                self.dbconn, self._data_connection,
+                getattr(opts, 'jobs', None) or 1,
+                getattr(opts, 'compress', None))
+        return dbmap
 
-        if opts.multiple_files:
-            with open(dbfilepath, 'w') as f:
-                f.write(yamldump(dbmap))
+    def _data_connection(self):
+        """Return a new connection to the database, to copy data with
 
-        return dbmap
+        :return: DbConnection, not yet connected
+        """
+        db = self.config['database']
+        return DbConnection(db['dbname'], db['username'], db['password'],
+                            db['host'], db['port'])
+
+    def _same_data_layout(self, old, new):
+        """Check whether two versions of a table hold the same rows
+
+        :param old: existing table, or None
+        :param new: table in the input map
+        :return: whether both have the same columns and primary key
+        """
+        from .dbobject.table import Table
+
+        return isinstance(old, Table) and old.primary_key is not None and \
+            old.data_columns() == new.data_columns() and \
+            old.key_columns() == new.key_columns()
+
+    def _mark_online(self):
+        """Flag new objects to be changed without long exclusive locks
+
+        Only CHECK and FOREIGN KEY constraints on existing, regular
+        tables are added as NOT VALID, since new tables are empty.
+        Columns on existing tables use a validated CHECK constraint to
+        SET NOT NULL, on servers that can use it to skip the scan.
+        Indexes on existing tables are built CONCURRENTLY, except for
+        new unique indexes which other new objects may depend on.
+        """
+        from .dbobject.constraint import CheckConstraint, ForeignKey
+        from .dbobject.table import DbClass, Table
+
+        def existing_table(sch, tbl, cls=Table):
+            table = self.db.tables.get((sch, tbl))
+            return isinstance(table, cls) and \
+                getattr(table, 'partition_by', None) is None
+
+        for constr in list(self.ndb.constraints.values()):
+            if isinstance(constr, (CheckConstraint, ForeignKey)) and \
+                    not getattr(constr, 'is_domain_check', False) and \
+                    existing_table(constr.schema, constr.table):
+                constr._online = True
+        for key, idx in list(self.ndb.indexes.items()):
+            if idx.unique and key not in self.db.indexes:
+                continue
+            if existing_table(idx.schema, idx.table, DbClass):
+                idx._online = True
+        if self.dbconn.version < 120000:
+            return
+        for (sch, tbl), cols in list(self.ndb.columns.items()):
+            if existing_table(sch, tbl):
+                for col in cols:
+                    col._online = True
+
+    def _deparse_views(self):
+        """Replace view definitions that the server deparses identically
+
+        For each view in the input map whose normalized definition
+        differs from that of the existing view, a temporary view is
+        created with the new definition and deparsed with
+        pg_get_viewdef().  If the result matches the existing
+        definition, e.g., because the input only differs in implicit
+        casts or qualification, the existing definition is used so that
+        the view is not replaced.  The temporary view is created with
+        the view's schema first in the search path, so that unqualified
+        names are resolved as in the view, but it is deparsed with the
+        search path of the catalog connection, as the existing view
+        was.  The temporary view and the search path settings are
+        rolled back.
+        """
+        from .dbobject.view import View
+
+        srch_path = None
+        for key, view in list(self.ndb.tables.items()):
+            old = self.db.tables.get(key)
+            if not isinstance(view, View) or not isinstance(old, View) or \
+                    view.definition is None or old.definition is None:
+                continue
+            olddefn = normalize_sql(old.definition)
+            if normalize_sql(view.definition) == olddefn:
+                continue
+            try:
+                if srch_path is None:
+                    srch_path = self.dbconn.fetchone("SHOW search_path")[0]
+                self.dbconn.execute("SET LOCAL search_path TO %s, pg_catalog"
+                                    % quote_id(view.schema)).close()
+                self.dbconn.execute(
+                    "CREATE TEMPORARY VIEW pyrseas_deparse AS %s" %
+                    view.definition.strip().rstrip(';')).close()
+                self.dbconn.execute("SET LOCAL search_path TO %s" %
+                                    srch_path).close()
+                defn = self.dbconn.fetchone(
+                    "SELECT pg_get_viewdef("
+                    "'pg_temp.pyrseas_deparse'::regclass, true)")[0]
+            except DatabaseError:
+                # e.g., the definition refers to objects not yet created:
+                # just compare the definitions as given
+                continue
+            finally:
+                self.dbconn.rollback()
+            if normalize_sql(defn) == olddefn:
+                view.definition = old.definition
+
+    def _consolidate_grants(self, stmts):
+        """Replace GRANTs on every object of a kind in a schema
+
+        :param stmts: list of SQL statements
+        :return: list of SQL statements
+
+        GRANT statements for the same grantee and privileges on
+        tables (including views and foreign tables), sequences or
+        functions of a schema are replaced by a single GRANT ... ON
+        ALL ... IN SCHEMA, placed where the last of them was.  This
+        is only done if every other object of that kind in the schema
+        already exists and already holds those privileges, granted by
+        its owner, so that the statement has no further effect.
+        Schemas with extensions are skipped since extension members
+        are not part of the maps.
+        """
+        from .dbobject.table import DbClass, Sequence
+        from .dbobject.function import Proc
+
+        def privkind(obj):
+            if isinstance(obj, Sequence):
+                return 'SEQUENCES'
+            elif isinstance(obj, DbClass):
+                return 'TABLES'
+            elif isinstance(obj, Proc):
+                return 'FUNCTIONS'
+            return None
+
+        extschs = set(ext.schema for ext in self.ndb.extensions.values())
+        groups = {}
+        for i, stmt in enumerate(stmts):
+            if not isinstance(stmt, GrantStmt):
+                continue
+            kind = privkind(stmt.obj)
+            if kind is None or stmt.obj.schema in extschs:
+                continue
+            groups.setdefault((stmt.obj.schema, kind, stmt.grantee,
+                               stmt.privmask, stmt.grant_option),
+                              []).append(i)
+
+        members = {}
+        for objdict in (self.ndb.tables, self.ndb.ftables,
+                        self.ndb.functions):
+            for obj in list(objdict.values()):
+                members.setdefault((obj.schema, privkind(obj)), []).append(
+                    obj)
+        replace = {}
+        for key in sorted(groups):
+            (sch, kind, grantee, privmask, grant_option) = key
+            positions = groups[key]
+            if len(positions) < 2:
+                continue
+            granted = set(stmts[i].obj.key() for i in positions)
+            consolidate = True
+            for obj in members.get((sch, kind), []):
+                if obj.key() in granted:
+                    continue
+                old = self.db.dbobjdict_from_catalog(obj.catalog).get(
+                    obj.key())
+                if old is None or not holds_privileges(
+                        old, grantee, privmask, grant_option) or \
+                        not holds_privileges(obj, grantee, privmask,
+                                             grant_option):
+                    consolidate = False
+                    break
+            if not consolidate:
+                continue
+            stmt = "GRANT %s ON ALL %s IN SCHEMA %s TO %s" % (
+                stmts[positions[-1]].privs, kind, quote_id(sch), grantee)
+            if grant_option:
+                stmt += " WITH GRANT OPTION"
+            replace[positions[-1]] = stmt
+            for i in positions[:-1]:
+                replace[i] = None
+        if not replace:
+            return stmts
+        return [replace.get(i, stmt) for i, stmt in enumerate(stmts)
+                if replace.get(i, stmt) is not None]
 
     def diff_map(self, input_map, quote_reserved=True):
         """Generate SQL to transform an existing database
 
-        :param input_map: a YAML map defining the new database
+        :param input_map: a YAML map defining the new database, or an
+            iterable of its (key, value) pairs
         :param quote_reserved: fetch reserved words
         :return: list of SQL statements
 
@@ -504,7 +897,25 @@ class Database(object):
         catalogs, to the input YAML map and generates SQL statements
         to transform the database into the one represented by the
         input.
+
+        If the `online` option is set, constraints are added as NOT
+        VALID and the statements to validate them, instances of
+        :class:`DeferredStmt`, are placed at the end of the list.
+
+        If the `deparse_views` option is set, changed view definitions
+        are compared after being deparsed by the server (see
+        :meth:`_deparse_views`).
+
+        If the `consolidate_grants` option is set, GRANTs on all the
+        tables, sequences or functions of a schema are replaced by
+        schema-wide GRANTs (see :meth:`_consolidate_grants`).
+
+        If the `bulk_load` option is set, the data of the `datacopy`
+        tables is not copied by the statements returned, but by the
+        :class:`BulkLoad` left in the `bulk_load` attribute, to be run
+        once they are committed.
         """
+        from .dbobject.schema import Schema
         from .dbobject.table import Table
 
         if not self.db:
@@ -512,9 +923,10 @@ class Database(object):
         opts = self.config['options']
         if opts.schemas:
             schlist = ['schema ' + sch for sch in opts.schemas]
-            for sch in list(input_map.keys()):
-                if sch not in schlist and sch.startswith('schema '):
-                    del input_map[sch]
+            if isinstance(input_map, dict):
+                input_map = input_map.items()
+            input_map = ((key, inobj) for (key, inobj) in input_map
+                         if key in schlist or not key.startswith('schema '))
             self._trim_objects(opts.schemas)
 
         # quote_reserved is only set to False by most tests
@@ -523,11 +935,17 @@ class Database(object):
 
         langs = [lang[0] for lang in self.dbconn.fetchall(
             "SELECT tmplname FROM pg_pltemplate")]
-        self.from_map(input_map, langs)
+        with timed('read input map'):
+            self.from_map(input_map, langs)
         if opts.revert:
             (self.db, self.ndb) = (self.ndb, self.db)
             del self.ndb.schemas['pg_catalog']
             self.db.languages.dbconn = self.dbconn
+        self.ndb.indexes.detect_renames(self.db.indexes)
+        if getattr(opts, 'online', False):
+            self._mark_online()
+        if getattr(opts, 'deparse_views', False):
+            self._deparse_views()
 
         # First sort the objects in the new db in dependency order
         new_objs = []
@@ -536,32 +954,34 @@ class Database(object):
             pairs.sort()
             new_objs.extend(list(map(itemgetter(1), pairs)))
 
-        new_objs = self.dep_sorted(new_objs, self.ndb)
+        with timed('sort dependencies'):
+            new_objs = self.dep_sorted(new_objs, self.ndb)
 
         # Then generate the sql for all the objects, walking in dependency
         # order over all the db objects
 
         stmts = []
-        for new in new_objs:
-            d = self.db.dbobjdict_from_catalog(new.catalog)
-            old = d.get(new.key())
-            if old is not None:
-                stmts.append(old.alter(new))
-            else:
-                stmts.append(new.create_sql(self.dbconn.version))
-
-                # Check if the object just created was renamed, in which case
-                # don't try to delete the original one
-                if getattr(new, 'oldname', None):
-                    try:
-                        origname, new.name = new.name, new.oldname
-                        oldkey = new.key()
-                    finally:
-                        new.name = origname
-                    # Intentionally raising KeyError as tested e.g. in
-                    # test_bad_rename_view -- ok Joe?
-                    old = d[oldkey]
-                    old._nodrop = True
+        with timed('generate statements'):
+            for new in new_objs:
+                d = self.db.dbobjdict_from_catalog(new.catalog)
+                old = d.get(new.key())
+                if old is not None:
+                    stmts.append(old.alter(new))
+                else:
+                    stmts.append(new.create_sql(self.dbconn.version))
+
+                    # Check if the object just created was renamed, in which
+                    # case don't try to delete the original one
+                    if getattr(new, 'oldname', None):
+                        try:
+                            origname, new.name = new.name, new.oldname
+                            oldkey = new.key()
+                        finally:
+                            new.name = origname
+                        # Intentionally raising KeyError as tested e.g. in
+                        # test_bad_rename_view -- ok Joe?
+                        old = d[oldkey]
+                        old._nodrop = True
 
         # Order the old database objects in reverse dependency order
         old_objs = []
@@ -569,24 +989,51 @@ class Database(object):
             pairs = list(d.items())
             pairs.sort
             old_objs.extend(list(map(itemgetter(1), pairs)))
-        old_objs = self.dep_sorted(old_objs, self.db)
+        with timed('sort dependencies'):
+            old_objs = self.dep_sorted(old_objs, self.db)
         old_objs.reverse()
 
         # Drop the objects that don't appear in the new db
-        for old in old_objs:
-            d = self.ndb.dbobjdict_from_catalog(old.catalog)
-            if isinstance(old, Table):
-                new = d.get(old.key())
-                if new is not None:
-                    stmts.extend(old.alter_drop_columns(new))
-            if not getattr(old, '_nodrop', False) and old.key() not in d:
-                stmts.extend(old.drop())
+        with timed('generate drops'):
+            for old in old_objs:
+                d = self.ndb.dbobjdict_from_catalog(old.catalog)
+                if isinstance(old, Table):
+                    new = d.get(old.key())
+                    if new is not None:
+                        stmts.extend(old.alter_drop_columns(new))
+                if getattr(old, 'schema', None) == TRACKING_SCHEMA or (
+                        isinstance(old, Schema) and
+                        old.name == TRACKING_SCHEMA):
+                    # reserved for internal use (see Schema.to_map)
+                    continue
+                if not getattr(old, '_nodrop', False) and old.key() not in d:
+                    stmts.extend(old.drop())
 
         if 'datacopy' in self.config:
-            opts.data_dir = self.config['files']['data_path']
-            stmts.append(self.ndb.schemas.data_import(opts))
+            with timed('generate data import'):
+                opts.data_dir = self.config['files']['data_path']
+                opts.server_version = self.dbconn.version
+                # the rows of existing tables whose columns and key did not
+                # change can be compared to those exported
+                opts.dbconn = self.dbconn
+                opts.unchanged_tables = set(
+                    key for (key, table) in self.ndb.tables.items()
+                    if isinstance(table, Table) and
+                    table.primary_key is not None and
+                    self._same_data_layout(self.db.tables.get(key), table))
+                if (TRACKING_SCHEMA, TRACKING_TABLE) in self.db.tables:
+                    opts.loaded_checksums = loaded_checksums(self.dbconn)
+                if getattr(opts, 'bulk_load', False):
+                    opts.bulk_loader = self.bulk_load = BulkLoad()
+                stmts.append(self.ndb.schemas.data_import(opts))
 
         stmts = [s for s in flatten(stmts)]
+        if getattr(opts, 'consolidate_grants', False):
+            stmts = self._consolidate_grants(stmts)
+        deferred = [s for s in stmts if isinstance(s, DeferredStmt)]
+        if deferred:
+            stmts = [s for s in stmts if not isinstance(s, DeferredStmt)] + \
+                deferred
         funcs = False
         for s in stmts:
             if "LANGUAGE sql" in s and (
@@ -0,0 +1,1040 @@
+# -*- coding: utf-8 -*-
+"""
+    pyrseas.datacopy
+    ~~~~~~~~~~~~~~~~
+
+    A `DataExporter` copies out the data of the tables listed in the
+    `datacopy` configuration, either serially on the catalog connection
+    or in parallel over several connections sharing one snapshot.
+
+    The data files may be compressed, as indicated by their extension.
+    They are compressed and decompressed as the data flows to and from
+    the COPY statements.
+
+    The data is copied in CSV format or, for the tables so configured,
+    in the PostgreSQL binary format.  The header of binary files is
+    extended with the server version and the column types, so that
+    the data can be checked against the target table when imported.
+
+    Large tables may be split into chunks by ranges of their primary
+    key.  A `ChunkedExport` keeps a manifest of the chunks, so that an
+    interrupted export can be resumed.
+
+    The rows are normally sorted by the server.  They may instead be
+    read in the order of a unique index, or copied unsorted and then
+    sorted by :func:`sort_csv_file`.
+
+    Tables configured to skip unchanged data are only exported if their
+    modification counters moved since the last export, as recorded in
+    a state file along with the checksum of the data files.  When they
+    are imported, the checksum is recorded in the database, so that the
+    same files are not loaded again.
+
+    A `BulkLoad` copies the data into the tables in parallel, and only
+    then rebuilds their indexes and adds back their constraints.
+"""
+import gzip
+import heapq
+import json
+from hashlib import sha256
+import os
+import struct
+import tempfile
+import threading
+
+try:
+    from queue import Queue, Empty
+except ImportError:
+    from Queue import Queue, Empty
+try:
+    from shlex import quote as shell_quote
+except ImportError:
+    from pipes import quote as shell_quote
+try:
+    import zstandard
+except ImportError:
+    zstandard = None
+try:
+    import lz4.frame
+except ImportError:
+    lz4 = None
+
+from pyrseas.mapwriter import replace_file
+from pyrseas.timings import timed
+
+MIN_SNAPSHOT_VERSION = 90200
+MIN_TABLESAMPLE_VERSION = 90500
+SAMPLE_ROWS_PER_CHUNK = 100
+CHUNKS_EXT = 'chunks'
+STATE_EXT = 'export'
+TRACKING_SCHEMA = 'pyrseas'
+TRACKING_TABLE = 'datacopy_loads'
+
+COMPRESSION = {'gzip': ('gz', 'gzip -dc'), 'zstd': ('zst', 'zstd -dcq'),
+               'lz4': ('lz4', 'lz4 -dc')}
+"""Compression methods: extension and command to decompress to stdout"""
+
+FORMATS = {'csv': 'data', 'binary': 'bin'}
+"""Data formats and the extensions of their files"""
+
+MODES = ['replace', 'merge']
+"""Modes of importing the data: truncating the table, or merging"""
+
+ORDERS = ['sort', 'index', 'client']
+"""Ways of ordering the exported rows: sorted by the server, read in
+the order of a unique index, or sorted by the client"""
+
+SORT_BUDGET = 64 * 1024 * 1024
+
+BINARY_SIGNATURE = b'PGCOPY\n\xff\r\n\x00'
+BINARY_HEADER_LEN = len(BINARY_SIGNATURE) + 8
+
+
+def check_compression(compression):
+    """Check that a compression method can be used
+
+    :param compression: 'none', 'gzip', 'zstd', 'lz4' or None
+    """
+    if compression in (None, 'none', 'gzip'):
+        return
+    if compression not in COMPRESSION:
+        raise ValueError("Unknown compression: %s" % compression)
+    if (compression == 'zstd' and zstandard is None) or (
+            compression == 'lz4' and lz4 is None):
+        raise ValueError("The %s compression requires the %s package" % (
+            compression, 'zstandard' if compression == 'zstd' else 'lz4'))
+
+
+def check_format(format):
+    """Check that a data format is known
+
+    :param format: 'csv' or 'binary'
+    """
+    if format not in FORMATS:
+        raise ValueError("Unrecognized datacopy format: %s" % format)
+
+
+def check_mode(mode):
+    """Check that an import mode is known
+
+    :param mode: 'replace' or 'merge'
+    """
+    if mode not in MODES:
+        raise ValueError("Unrecognized datacopy mode: %s" % mode)
+
+
+def check_order(order):
+    """Check that a way of ordering the exported rows is known
+
+    :param order: 'sort', 'index' or 'client'
+    """
+    if order not in ORDERS:
+        raise ValueError("Unrecognized datacopy order: %s" % order)
+
+
+def data_ext(compression=None, format='csv'):
+    """Return the extension of the data files
+
+    :param compression: compression method, or None or 'none'
+    :param format: data format: 'csv' or 'binary'
+    :return: extension, e.g., data, data.gz or bin
+    """
+    if compression in (None, 'none'):
+        return FORMATS[format]
+    return FORMATS[format] + '.' + COMPRESSION[compression][0]
+
+
+def data_paths(table, dirpath):
+    """Return the possible paths of the data file of a table
+
+    :param table: the Table
+    :param dirpath: full path to the directory for the file
+    :return: list of paths, uncompressed CSV first
+    """
+    return [os.path.join(dirpath, table.extern_filename(data_ext(method,
+                                                                 format)))
+            for format in sorted(FORMATS.keys(), reverse=True)
+            for method in [None] + sorted(COMPRESSION.keys())]
+
+
+def is_binary_file(path):
+    """Check whether a data file is in binary format
+
+    :param path: file path
+    :return: boolean
+    """
+    if compression_of_file(path) is not None:
+        path = os.path.splitext(path)[0]
+    return path.endswith('.' + FORMATS['binary'])
+
+
+def compression_of_file(path):
+    """Return the compression method of a data file
+
+    :param path: file path
+    :return: compression method, or None if not compressed
+    """
+    for (method, (ext, cmd)) in COMPRESSION.items():
+        if path.endswith('.' + ext):
+            return method
+    return None
+
+
+def open_data_file(path, mode='rb'):
+    """Open a data file, compressing or decompressing it as needed
+
+    :param path: file path
+    :param mode: 'rb' or 'wb'
+    :return: binary file object
+    """
+    compression = compression_of_file(path)
+    check_compression(compression)
+    if compression == 'gzip':
+        return gzip.open(path, mode)
+    elif compression == 'zstd':
+        return zstandard.open(path, mode)
+    elif compression == 'lz4':
+        return lz4.frame.open(path, mode)
+    return open(path, mode)
+
+
+class BinaryHeaderWriter(object):
+    """Writer of binary COPY output adding data to its header extension
+
+    PostgreSQL skips the header extension area of binary files, so the
+    files can still be loaded by COPY.
+    """
+
+    def __init__(self, f, extension):
+        """Initialize the writer
+
+        :param f: binary file object to write to
+        :param extension: bytes to add to the header extension area
+        """
+        self.f = f
+        self.extension = extension
+        self.head = b''
+
+    def write(self, data):
+        if self.head is None:
+            return self.f.write(data)
+        self.head += data
+        if len(self.head) < BINARY_HEADER_LEN:
+            return
+        if not self.head.startswith(BINARY_SIGNATURE):
+            raise ValueError("Invalid binary COPY output")
+        start = BINARY_HEADER_LEN
+        end = start + struct.unpack('>I', self.head[start - 4:start])[0]
+        if len(self.head) < end:
+            return
+        extension = self.extension + self.head[start:end]
+        self.f.write(self.head[:start - 4] +
+                     struct.pack('>I', len(extension)) + extension +
+                     self.head[end:])
+        self.head = None
+
+
+def binary_header(version, columns):
+    """Return the header extension of the binary data files
+
+    :param version: server version number
+    :param columns: list of column (name, type) pairs
+    :return: bytes
+    """
+    return json.dumps({'pyrseas': {'version': version, 'columns': [
+        list(col) for col in columns]}}, sort_keys=True).encode('utf-8')
+
+
+def read_binary_header(path):
+    """Read the header added to a binary data file by the exporter
+
+    :param path: file path
+    :return: dictionary with the server version and column types, or
+        None if the file has no such header
+    """
+    with open_data_file(path, 'rb') as f:
+        head = f.read(BINARY_HEADER_LEN)
+        if len(head) < BINARY_HEADER_LEN or \
+                not head.startswith(BINARY_SIGNATURE):
+            raise ValueError("%s is not a binary COPY file" % path)
+        extension = f.read(struct.unpack('>I', head[-4:])[0])
+    try:
+        header = json.loads(extension.decode('utf-8'))['pyrseas']
+    except (ValueError, KeyError, TypeError):
+        return None
+    header['columns'] = [tuple(col) for col in header['columns']]
+    return header
+
+
+def binary_compatible(header, columns, version):
+    """Check whether binary data can be loaded as is into a table
+
+    :param header: header read from the file, or None
+    :param columns: list of column (name, type) pairs of the table
+    :param version: version number of the server to load into
+    :return: boolean
+
+    The columns must have the same types, and the server must not be
+    of an older major version than the one the data was copied from.
+    Data without a header is assumed to be compatible.
+    """
+    if header is None:
+        return True
+    if version is not None and version // 100 < header['version'] // 100:
+        return False
+    return header['columns'] == list(columns)
+
+
+def copy_to_file(dbconn, sql, path, columns=None):
+    """Execute an SQL COPY ... TO STDOUT command to a data file
+
+    :param dbconn: database connection
+    :param sql: SQL copy command
+    :param path: file path, possibly of a compressed file
+    :param columns: for binary output, list of column (name, type)
+        pairs to record in the header
+    """
+    if compression_of_file(path) is None and columns is None:
+        dbconn.sql_copy_to(sql, path)
+        return
+    if dbconn.conn is None or dbconn.conn.closed:
+        dbconn.connect()
+    header = None
+    if columns is not None:
+        header = binary_header(dbconn.conn.server_version, columns)
+    with open_data_file(path, 'wb') as f:
+        curs = dbconn.conn.cursor()
+        try:
+            curs.copy_expert(sql, f if header is None else
+                             BinaryHeaderWriter(f, header))
+        finally:
+            curs.close()
+
+
+def csv_records(f):
+    """Iterate over the records of a CSV file
+
+    :param f: file object, open in binary mode
+    :return: iterator of records (bytes), each ending with a newline
+
+    A record ends at the first newline outside of a quoted value, i.e.,
+    after an even number of quote characters, since quotes within
+    values are doubled.
+    """
+    rec = b''
+    quotes = 0
+    for line in f:
+        rec += line
+        quotes += line.count(b'"')
+        if quotes % 2 == 0:
+            yield rec if rec.endswith(b'\n') else rec + b'\n'
+            rec = b''
+    if rec:
+        yield rec if rec.endswith(b'\n') else rec + b'\n'
+
+
+def sort_csv_file(srcpath, destpath, budget=SORT_BUDGET):
+    """Sort the records of a CSV file into a data file
+
+    :param srcpath: path of the unsorted, uncompressed file
+    :param destpath: path of the data file, possibly compressed
+    :param budget: bytes of records to sort in memory
+
+    The records are ordered by their text, which gives a canonical
+    order for a given set of rows.  Batches of records that exceed the
+    memory budget are sorted and written to temporary files, in the
+    directory of the data file, which are then merged.
+    """
+    runs = []
+    try:
+        batch = []
+        size = 0
+        with open(srcpath, 'rb') as f:
+            for rec in csv_records(f):
+                batch.append(rec)
+                size += len(rec)
+                if size > budget:
+                    runs.append(_write_run(sorted(batch), destpath))
+                    batch = []
+                    size = 0
+        if runs and batch:
+            runs.append(_write_run(sorted(batch), destpath))
+        files = [open(path, 'rb') for path in runs]
+        try:
+            if files:
+                recs = heapq.merge(*[csv_records(run) for run in files])
+            else:
+                recs = sorted(batch)
+            with open_data_file(destpath, 'wb') as f:
+                for rec in recs:
+                    f.write(rec)
+        finally:
+            for run in files:
+                run.close()
+    finally:
+        for path in runs:
+            os.remove(path)
+
+
+def _write_run(recs, destpath):
+    (fd, path) = tempfile.mkstemp(prefix='.sort.',
+                                  dir=os.path.dirname(destpath) or None)
+    with os.fdopen(fd, 'wb') as f:
+        for rec in recs:
+            f.write(rec)
+    return path
+
+
+def copy_from_file(dbconn, path, table):
+    """Copy a data file, possibly compressed, into a table
+
+    :param dbconn: database connection
+    :param path: file path
+    :param table: possibly schema qualified table name
+    """
+    if dbconn.conn is None or dbconn.conn.closed:
+        dbconn.connect()
+    options = "(FORMAT binary)" if is_binary_file(path) else "CSV"
+    with open_data_file(path, 'rb') as f:
+        curs = dbconn.conn.cursor()
+        try:
+            curs.copy_expert("COPY %s FROM STDIN WITH %s" % (table, options),
+                             f)
+        finally:
+            curs.close()
+
+
+def execute_stmt(dbconn, stmt):
+    """Execute a statement output by yamltodb
+
+    :param dbconn: database connection
+    :param stmt: SQL statement or tuple of a psql \\copy command
+    """
+    if isinstance(stmt, tuple):
+        # expected format: (\\copy, table, from, path, options)
+        copy_from_file(dbconn, stmt[3], stmt[1])
+    else:
+        dbconn.execute(stmt).close()
+
+
+def copy_command(stmt):
+    """Return the text of a psql \\copy command output by yamltodb
+
+    :param stmt: tuple of a psql \\copy command
+    :return: string
+
+    The path of the file is quoted as a psql literal and, if it is
+    given to a command to decompress the file, for the shell as well.
+    """
+    # expected format: (\\copy, table, from, path, options)
+    (copy, table, source, path, options) = stmt
+    if source.startswith(" from program "):
+        path = shell_quote(path)
+    return "".join((copy, table, source, path.replace("'", "''"), options))
+
+
+def copy_program(path):
+    """Return the command that psql should decompress a data file with
+
+    :param path: file path
+    :return: shell command prefix, or None if the file is not compressed
+    """
+    compression = compression_of_file(path)
+    if compression is None:
+        return None
+    return COMPRESSION[compression][1]
+
+
+def chunks_path(table, dirpath):
+    """Return the path of the chunk manifest of a table
+
+    :param table: the Table
+    :param dirpath: full path to the directory for the data files
+    :return: file path
+    """
+    return os.path.join(dirpath, table.extern_filename(CHUNKS_EXT))
+
+
+def read_chunks(path):
+    """Read a chunk manifest
+
+    :param path: file path
+    :return: dictionary, or None if there is no manifest
+    """
+    if not os.path.exists(path):
+        return None
+    with open(path, 'rb') as f:
+        return json.loads(f.read().decode('utf-8'))
+
+
+def state_path(table, dirpath):
+    """Return the path of the file recording the last export of a table
+
+    :param table: the Table
+    :param dirpath: full path to the directory for the data files
+    :return: file path
+    """
+    return os.path.join(dirpath, table.extern_filename(STATE_EXT))
+
+
+def read_state(path):
+    """Read the file recording the last export of a table
+
+    :param path: file path
+    :return: dictionary, or None if there is no such file
+    """
+    if not os.path.exists(path):
+        return None
+    with open(path, 'rb') as f:
+        return json.loads(f.read().decode('utf-8'))
+
+
+def files_checksum(paths):
+    """Return a checksum of the contents of data files
+
+    :param paths: list of file paths
+    :return: SHA-256 digest, as text, or None if a file does not exist
+
+    The names of the files are included, so that the checksum differs
+    if the data is split differently, e.g., in chunks.
+    """
+    digest = sha256()
+    for path in paths:
+        if not os.path.exists(path):
+            return None
+        digest.update(os.path.basename(path).encode('utf-8') + b'\0')
+        with open(path, 'rb') as f:
+            for block in iter(lambda: f.read(1024 * 1024), b''):
+                digest.update(block)
+    return digest.hexdigest()
+
+
+def table_counters(dbconn, table):
+    """Return the counters of the changes made to a table
+
+    :param dbconn: database connection
+    :param table: the Table
+    :return: list of values, or None if the changes are not counted
+
+    Besides the number of rows inserted, updated and deleted, the
+    storage file of the table, which TRUNCATE replaces, and the time
+    the counters were last reset are returned.
+    """
+    row = dbconn.fetchone(
+        "SELECT pg_relation_filenode(relid), n_tup_ins, n_tup_upd, "
+        "n_tup_del, (SELECT stats_reset::text FROM pg_stat_database "
+        "WHERE datname = current_database()) FROM pg_stat_user_tables "
+        "WHERE relid = %s::regclass "
+        "AND current_setting('track_counts')::boolean",
+        (table.qualname(), ))
+    return None if row is None else list(row)
+
+
+def tracking_stmts():
+    """Return the statements creating the table of the loaded data
+
+    :return: list of SQL statements
+    """
+    return ["CREATE SCHEMA IF NOT EXISTS %s" % TRACKING_SCHEMA,
+            "CREATE TABLE IF NOT EXISTS %s.%s (schema_name text, "
+            "table_name text, checksum text NOT NULL, loaded_at timestamp "
+            "with time zone NOT NULL DEFAULT now(), PRIMARY KEY "
+            "(schema_name, table_name))" % (TRACKING_SCHEMA, TRACKING_TABLE)]
+
+
+def record_load_stmts(table, checksum):
+    """Return the statements recording the data loaded into a table
+
+    :param table: the Table
+    :param checksum: checksum of the data files loaded
+    :return: list of SQL statements
+    """
+    key = "%s, %s" % (quote_literal(table.schema), quote_literal(table.name))
+    return ["DELETE FROM %s.%s WHERE (schema_name, table_name) = (%s)" % (
+        TRACKING_SCHEMA, TRACKING_TABLE, key),
+        "INSERT INTO %s.%s (schema_name, table_name, checksum) VALUES "
+        "(%s, %s)" % (TRACKING_SCHEMA, TRACKING_TABLE, key,
+                      quote_literal(checksum))]
+
+
+def loaded_checksums(dbconn):
+    """Return the checksums of the data last loaded into the tables
+
+    :param dbconn: database connection
+    :return: dictionary of checksums, keyed by (schema, table) names
+    """
+    return dict(((row[0], row[1]), row[2]) for row in dbconn.fetchall(
+        "SELECT schema_name, table_name, checksum FROM %s.%s" % (
+            TRACKING_SCHEMA, TRACKING_TABLE)))
+
+
+def remove_chunks(table, dirpath):
+    """Remove the chunk files and manifest of a table, if any
+
+    :param table: the Table
+    :param dirpath: full path to the directory for the data files
+    """
+    path = chunks_path(table, dirpath)
+    manifest = read_chunks(path)
+    if manifest is None:
+        return
+    for chunk in manifest['chunks']:
+        chunkpath = os.path.join(dirpath, chunk['file'])
+        if os.path.exists(chunkpath):
+            os.remove(chunkpath)
+    os.remove(path)
+
+
+def quote_literal(val):
+    """Quote a string as an SQL literal
+
+    :param val: string
+    :return: quoted string
+    """
+    return "'%s'" % val.replace("'", "''")
+
+
+def range_condition(columns, lower, upper):
+    """Return the condition selecting a range of keys
+
+    :param columns: list of key column (quoted name, type) pairs
+    :param lower: list of key values, as text, of the first row in
+        the range, or None
+    :param upper: list of key values, as text, of the first row after
+        the range, or None
+    :return: SQL condition, or None if the range is not bounded
+    """
+    names = ", ".join(name for (name, type) in columns)
+    conds = []
+    for (bound, oper) in ((lower, '>='), (upper, '<')):
+        if bound is not None:
+            conds.append("(%s) %s (%s)" % (names, oper, ", ".join(
+                "%s::%s" % (quote_literal(val), type)
+                for (val, (name, type)) in zip(bound, columns))))
+    return " AND ".join(conds) or None
+
+
+def chunk_digest(dbconn, table, columns, where=None):
+    """Return a digest of the rows of a table in a range of keys
+
+    :param dbconn: database connection
+    :param table: the Table
+    :param columns: list of key column (quoted name, type) pairs
+    :param where: condition selecting the range, or None
+    :return: MD5 digest of the rows, in key order, as text (None if
+        there are no rows)
+    """
+    query = "SELECT md5(string_agg(md5(ROW(t.*)::text), '' ORDER BY %s)) " \
+        "FROM %s t" % (", ".join("t.%s" % name for (name, type) in columns),
+                       table.qualname())
+    if where is not None:
+        query += " WHERE " + where
+    return dbconn.fetchone(query)[0]
+
+
+def sample_boundaries(dbconn, table, columns, nchunks):
+    """Sample a table for the keys dividing it into chunks
+
+    :param dbconn: database connection
+    :param table: the Table
+    :param columns: list of key column (quoted name, type) pairs
+    :param nchunks: number of chunks wanted
+    :return: list of at most `nchunks` - 1 keys, as lists of text
+        values, in increasing order
+
+    About a hundred keys per chunk are sampled, using TABLESAMPLE if
+    available, and the boundaries are taken at regular intervals among
+    them, so that the chunks have roughly the same number of rows.
+    """
+    reltuples = dbconn.fetchone(
+        "SELECT reltuples FROM pg_class WHERE oid = %s::regclass",
+        (table.qualname(), ))[0]
+    pct = 100.0
+    if reltuples > 0:
+        pct = min(pct, 100.0 * SAMPLE_ROWS_PER_CHUNK * nchunks / reltuples)
+    names = ", ".join(name for (name, type) in columns)
+    keys = "ARRAY[%s]" % ", ".join(
+        "%s::text" % name for (name, type) in columns)
+    if dbconn.version >= MIN_TABLESAMPLE_VERSION:
+        query = "SELECT %s FROM %s TABLESAMPLE SYSTEM (%f) ORDER BY %s" % (
+            keys, table.qualname(), pct, names)
+    else:
+        query = "SELECT %s FROM %s WHERE random() < %f ORDER BY %s" % (
+            keys, table.qualname(), pct / 100, names)
+    sample = [row[0] for row in dbconn.fetchall(query)]
+    bounds = []
+    for i in range(1, nchunks):
+        if not sample:
+            break
+        key = sample[len(sample) * i // nchunks]
+        if not bounds or key != bounds[-1]:
+            bounds.append(key)
+    return bounds
+
+
+class ChunkedExport(object):
+    """Export of the data of a table in chunks of primary key ranges
+
+    Each chunk is output to its own file, e.g., ``table.t1.0003.data``,
+    listed in a manifest, ``table.t1.chunks``, in key order.  The
+    manifest records which chunks were completely written, so that an
+    export that was interrupted is resumed with the chunks that were
+    not, unless the format, compression, key or number of chunks
+    changed.  A complete export is started afresh.  Chunks output in
+    different runs are not consistent with each other.
+
+    For tables imported in 'merge' mode, the manifest also records a
+    digest of the rows of each chunk (see :func:`chunk_digest`), so
+    that the chunks whose rows are the same in the target database
+    can be skipped.
+    """
+
+    def __init__(self, table, dirpath, compression=None):
+        """Initialize the export
+
+        :param table: the Table, which must have a primary key
+        :param dirpath: full path to the directory for the data files
+        :param compression: compression method of the files
+        """
+        self.table = table
+        self.dirpath = dirpath
+        self.compression = None if compression == 'none' else compression
+        self.path = chunks_path(table, dirpath)
+        self.columns = table.key_columns()
+        self.manifest = None
+        self.lock = threading.Lock()
+
+    def _save(self):
+        replace_file(self.path, json.dumps(
+            self.manifest, indent=1, sort_keys=True).encode('utf-8'))
+
+    def plan(self, dbconn, nchunks):
+        """Return the chunks that remain to be exported
+
+        :param dbconn: database connection, to sample the table with
+        :param nchunks: number of chunks wanted
+        :return: list of chunks
+        """
+        format = getattr(self.table, '_copy_format', 'csv')
+        manifest = read_chunks(self.path)
+        if manifest is not None and not manifest['complete'] and (
+                manifest['format'], manifest['compression'],
+                manifest['columns'], manifest['requested']) == (
+                format, self.compression, [list(col) for col in self.columns],
+                nchunks):
+            self.manifest = manifest
+        else:
+            remove_chunks(self.table, self.dirpath)
+            for path in data_paths(self.table, self.dirpath):
+                if os.path.exists(path):
+                    os.remove(path)
+            bounds = sample_boundaries(dbconn, self.table, self.columns,
+                                       nchunks)
+            lowers = [None] + bounds
+            uppers = bounds + [None]
+            self.manifest = {
+                'format': format, 'compression': self.compression,
+                'columns': [list(col) for col in self.columns],
+                'requested': nchunks, 'complete': False,
+                'chunks': [{'file': self.table.extern_filename('%04d.%s' % (
+                    i, data_ext(self.compression, format))),
+                    'lower': lowers[i], 'upper': uppers[i], 'done': False}
+                    for i in range(len(lowers))]}
+            self._save()
+        return [chunk for chunk in self.manifest['chunks']
+                if not chunk['done']]
+
+    def run(self, dbconn, chunk):
+        """Export a chunk and record it in the manifest
+
+        :param dbconn: database connection
+        :param chunk: one of the chunks returned by :meth:`plan`
+        """
+        where = range_condition(self.columns, chunk['lower'], chunk['upper'])
+        self.table.data_export(dbconn, self.dirpath, self.compression,
+                               chunk['file'], where)
+        digest = None
+        if getattr(self.table, '_copy_mode', 'replace') == 'merge':
+            digest = chunk_digest(dbconn, self.table, self.columns, where)
+        with self.lock:
+            chunk['done'] = True
+            if digest is not None:
+                chunk['digest'] = digest
+            if all(chk['done'] for chk in self.manifest['chunks']):
+                self.manifest['complete'] = True
+            self._save()
+
+
+class DataExporter(object):
+    """Exporter of the data of static tables
+
+    With a single job, each table is exported as soon as it is added,
+    on the catalog connection, as was always done.  With more jobs,
+    the tables are queued and exported by :meth:`finish`: the catalog
+    connection, the leader, exports its snapshot, and that many worker
+    connections import it in a REPEATABLE READ transaction before
+    running the COPY statements concurrently.  All the tables are
+    therefore copied as of the same instant, although by different
+    sessions.  The leader's transaction is left open until all the
+    workers are done, since the snapshot can only be imported while it
+    lasts, and is then rolled back by :meth:`finish`.
+
+    The workers are threads: the COPY statements are executed by the
+    server, and their output is written while the threads wait for
+    further data.
+
+    Tables configured with a number of `chunks` and having a primary
+    key are exported by a :class:`ChunkedExport`, whose chunks are
+    distributed among the workers as if they were separate tables.
+
+    Tables configured to skip unchanged data are not exported if their
+    counters (see :func:`table_counters`), read before the data is
+    copied, and the checksum of their files are those recorded when
+    they were last exported.
+    """
+
+    def __init__(self, dbconn, connect, jobs=1, compression=None):
+        """Initialize the exporter
+
+        :param dbconn: catalog database connection (the leader)
+        :param connect: function returning a new, unconnected
+            DbConnection to the same database
+        :param jobs: number of connections to export the data with
+        :param compression: compression method of the data files
+        """
+        check_compression(compression)
+        self.dbconn = dbconn
+        self.connect = connect
+        self.jobs = jobs
+        self.compression = compression
+        if jobs > 1 and dbconn.version < MIN_SNAPSHOT_VERSION:
+            # snapshots cannot be shared: export serially
+            self.jobs = 1
+        self.tasks = []
+        self.states = []
+
+    def add(self, table, dirpath):
+        """Export, or queue for export, the data of a table
+
+        :param table: the Table to export
+        :param dirpath: full path to the directory for the data file
+        """
+        if getattr(table, '_copy_skip_unchanged', False):
+            state = self._export_state(table, dirpath)
+            if state is None:
+                return
+            self.states.append((table, dirpath, state))
+        nchunks = getattr(table, '_copy_chunks', None)
+        if nchunks and table.primary_key is not None:
+            export = ChunkedExport(table, dirpath, self.compression)
+            for chunk in export.plan(self.dbconn, nchunks):
+                self._task(lambda dbconn, chunk=chunk: export.run(
+                    dbconn, chunk))
+        else:
+            self._task(lambda dbconn: table.data_export(dbconn, dirpath,
+                                                        self.compression))
+
+    def _export_state(self, table, dirpath):
+        """Return the state to record once a table is exported
+
+        :param table: the Table
+        :param dirpath: full path to the directory for the data files
+        :return: dictionary, or None if the table need not be exported
+        """
+        state = {'counters': table_counters(self.dbconn, table),
+                 'format': getattr(table, '_copy_format', 'csv'),
+                 'compression': None if self.compression == 'none'
+                 else self.compression,
+                 'chunks': getattr(table, '_copy_chunks', None)}
+        last = read_state(state_path(table, dirpath))
+        if state['counters'] is None or last is None or any(
+                last.get(key) != val for (key, val) in state.items()):
+            return state
+        try:
+            paths = table.data_files(dirpath)
+        except ValueError:
+            return state
+        if files_checksum(paths) != last.get('checksum'):
+            return state
+        return None
+
+    def _task(self, task):
+        if self.jobs > 1:
+            self.tasks.append(task)
+        else:
+            task(self.dbconn)
+
+    def finish(self):
+        """Export the data of the queued tables and chunks in parallel
+
+        The first error raised by a worker is re-raised after all the
+        workers stopped.  Otherwise, the state of the tables exported
+        that skip unchanged data is then recorded.
+
+        In any case, the transaction of the leader, which ran the COPY
+        statements or exported the snapshot, is rolled back, so that
+        the locks on the tables copied are released.
+        """
+        try:
+            if self.tasks:
+                tasks = self.tasks
+                self.tasks = []
+                snapshot = self.dbconn.fetchone(
+                    "SELECT pg_export_snapshot()")[0]
+
+                def setup(dbconn):
+                    dbconn.execute("SET TRANSACTION ISOLATION LEVEL "
+                                   "REPEATABLE READ, READ ONLY").close()
+                    dbconn.execute("SET TRANSACTION SNAPSHOT '%s'" %
+                                   snapshot).close()
+
+                with timed('export data'):
+                    run_parallel(self.connect, self.jobs, tasks, setup)
+        finally:
+            self.dbconn.rollback()
+        for (table, dirpath, state) in self.states:
+            state['checksum'] = files_checksum(table.data_files(dirpath))
+            replace_file(state_path(table, dirpath), json.dumps(
+                state, indent=1, sort_keys=True).encode('utf-8'))
+        self.states = []
+
+
+def run_parallel(connect, jobs, tasks, setup=None):
+    """Run tasks concurrently, each worker with its own connection
+
+    :param connect: function returning a new, unconnected DbConnection
+    :param jobs: maximum number of workers
+    :param tasks: list of functions taking a connection as argument
+    :param setup: function to call with each connection first
+
+    The workers are threads, which take the tasks in order.  Once a
+    worker fails, the others take no more tasks, and the first error
+    is re-raised after all of them stopped.  The transaction of each
+    connection is rolled back at the end, so the tasks must commit
+    their own work.
+    """
+    if not tasks:
+        return
+    queue = Queue()
+    for task in tasks:
+        queue.put(task)
+    errors = []
+
+    def worker():
+        dbconn = connect()
+        try:
+            if setup is not None:
+                setup(dbconn)
+            while not errors:
+                try:
+                    task = queue.get_nowait()
+                except Empty:
+                    break
+                task(dbconn)
+            dbconn.rollback()
+        except (Exception, SystemExit) as exc:
+            # e.g., a failed connection exits: report it in the caller
+            errors.append(exc)
+        finally:
+            dbconn.close()
+
+    threads = [threading.Thread(target=worker)
+               for i in range(min(jobs, len(tasks)))]
+    for thread in threads:
+        thread.start()
+    for thread in threads:
+        thread.join()
+    if errors:
+        raise errors[0]
+
+
+class BulkLoad(object):
+    """Plan of the loading of data into tables, in parallel
+
+    Each table imported by yamltodb --bulk-load is emptied, with its
+    indexes and constraints other than the primary key dropped, in the
+    main transaction.  Its data is then copied by :meth:`run`, in four
+    phases, each starting once the previous one is over:
+
+    - the COPY statements of the tables, with one worker per table,
+    - the index builds, including those of unique constraints, with
+      one worker per index,
+    - the CHECK and FOREIGN KEY constraints, added as NOT VALID, one
+      at a time since they lock the tables they are on,
+    - the validation of those constraints, in parallel.
+
+    Each statement is committed when done: unlike the normal import,
+    the bulk load is not atomic.
+    """
+
+    def __init__(self):
+        self.loads = []
+        self.indexes = []
+        self.constraints = []
+        self.validations = []
+        self.claimed = set()
+
+    def claim(self, constr):
+        """Claim the dropping and adding back of a constraint
+
+        :param constr: the constraint
+        :return: whether the constraint was not already claimed
+
+        A foreign key between two tables that are both loaded is only
+        dropped and added back once.
+        """
+        key = (constr.schema, constr.table, constr.name)
+        if key in self.claimed:
+            return False
+        self.claimed.add(key)
+        return True
+
+    def add(self, loads, indexes, constraints, validations):
+        """Add the statements loading a table
+
+        :param loads: statements copying the data into the table
+        :param indexes: lists of statements building each index
+        :param constraints: statements adding constraints as NOT VALID
+        :param validations: statements validating those constraints
+        """
+        self.loads.append(loads)
+        self.indexes.extend(indexes)
+        self.constraints.extend(constraints)
+        self.validations.extend(validations)
+
+    def statements(self):
+        """Return the statements of the plan, in the order to run them
+
+        :return: list of SQL statements
+        """
+        return [stmt for stmts in self.loads + self.indexes
+                for stmt in stmts] + self.constraints + self.validations
+
+    def run(self, connect, jobs=1):
+        """Run the statements of the plan, over several connections
+
+        :param connect: function returning a new, unconnected
+            DbConnection to the target database
+        :param jobs: number of connections to run the statements with
+        """
+        def setup(dbconn):
+            dbconn.connect()
+            dbconn.conn.autocommit = True
+
+        def task(stmts):
+            def run_stmts(dbconn):
+                for stmt in stmts:
+                    execute_stmt(dbconn, stmt)
+            return run_stmts
+
+        with timed('bulk load data'):
+            run_parallel(connect, jobs,
+                         [task(stmts) for stmts in self.loads], setup)
+        with timed('bulk build indexes'):
+            run_parallel(connect, jobs,
+                         [task(stmts) for stmts in self.indexes], setup)
+        with timed('bulk add constraints'):
+            run_parallel(connect, 1, [task(self.constraints)], setup)
+        with timed('bulk validate constraints'):
+            run_parallel(connect, jobs, [task([stmt])
+                                         for stmt in self.validations], setup)
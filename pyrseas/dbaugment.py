@@ -6,12 +6,11 @@ from __future__ import print_function
 import sys
 from argparse import FileType
 
-import yaml
-
 from pyrseas import __version__
-from pyrseas.yamlutil import yamldump
+from pyrseas.yamlutil import yamldump, yamlload
 from pyrseas.augmentdb import AugmentDatabase
 from pyrseas.cmdargs import cmd_parser, parse_args
+from pyrseas.timings import start_collector, timed
 
 
 def main():
@@ -32,15 +31,18 @@ def main():
     cfg = parse_args(parser)
     output = cfg['files']['output']
     options = cfg['options']
+    start_collector(options)
     augdb = AugmentDatabase(cfg)
-    augmap = yaml.safe_load(options.spec)
+    augmap = yamlload(options.spec)
     try:
-        outmap = augdb.apply(augmap)
+        with timed('augment'):
+            outmap = augdb.apply(augmap)
     except BaseException as exc:
         if type(exc) != KeyError:
             raise
         sys.exit("ERROR: %s" % str(exc))
-    print(yamldump(outmap), file=output or sys.stdout)
+    with timed('output map'):
+        print(yamldump(outmap), file=output or sys.stdout)
     if output:
         output.close()
 
@@ -13,9 +13,9 @@ import string
 from functools import wraps
 
 from pyrseas.lib.pycompat import PY2, strtypes
-from pyrseas.yamlutil import yamldump
+from pyrseas.timings import timed
 from .privileges import privileges_to_map, add_grant, diff_privs
-from .privileges import privileges_from_map
+from .privileges import privileges_from_map, acl_items
 
 
 VALID_FIRST_CHARS = string.ascii_lowercase + '_'
@@ -105,6 +105,70 @@ def split_func_args(obj):
     return name, args
 
 
+SQL_TOKENS = re.compile(r"""
+      (?P<comment>--[^\n]*|/\*.*?\*/)
+    | (?P<literal>[Ee]'(?:[^'\\]|\\.|'')*'
+        | '(?:[^']|'')*'
+        | "(?:[^"]|"")*"
+        | (?P<dollar>\$(?:[A-Za-z_][A-Za-z_0-9]*)?\$).*?(?P=dollar))
+    | (?P<word>[A-Za-z_0-9][A-Za-z_0-9$.]*)
+    | (?P<space>\s+)
+    | (?P<punct>[(),;\[\]])
+    | (?P<oper>.)""", re.S | re.X)
+
+
+def normalize_sql(text):
+    """Return a canonical form of SQL text for comparisons
+
+    :param text: SQL text, e.g., a view definition or a function body
+    :return: string
+
+    Comments are removed, whitespace is collapsed and dropped next to
+    punctuation, unquoted words are folded to lowercase and a trailing
+    semicolon is removed.  String literals, quoted identifiers and
+    dollar-quoted strings are left unchanged.
+    """
+    if text is None:
+        return None
+    tokens = []
+    for match in SQL_TOKENS.finditer(text):
+        kind = match.lastgroup
+        if kind == 'dollar':
+            kind = 'literal'
+        if kind in ('comment', 'space'):
+            if tokens and tokens[-1][0] != 'space':
+                tokens.append(('space', ' '))
+            continue
+        value = match.group(kind)
+        if kind == 'word':
+            value = value.lower()
+        tokens.append((kind, value))
+    while tokens and (tokens[-1][0] == 'space' or tokens[-1] == (
+            'punct', ';')):
+        tokens.pop()
+    result = []
+    for i, (kind, value) in enumerate(tokens):
+        if kind == 'space':
+            if i == 0:
+                continue
+            (before, after) = (tokens[i - 1][0], tokens[i + 1][0])
+            if 'punct' in (before, after) or \
+                    (before == 'oper') != (after == 'oper'):
+                continue
+        result.append(value)
+    return ''.join(result)
+
+
+class DeferredStmt(str):
+    """Marker for SQL statements to be run after the main transaction
+
+    Statements such as ``VALIDATE CONSTRAINT`` only need weak locks but
+    may take a long time.  They are collected at the end of the
+    statement list so that they can be executed (and committed)
+    separately, once the schema changes proper have been committed.
+    """
+
+
 def commentable(func):
     """Decorator to add comments to various objects"""
     @wraps(func)
@@ -139,6 +203,22 @@ def ownable(func):
     return add_alter
 
 
+def map_value(val):
+    """Copy a value for an object map, without copying database objects
+
+    :param val: attribute value
+    :return: copy of the value
+
+    Lists and dictionaries are copied recursively.  Other values,
+    including tuples and database objects, are returned as they are.
+    """
+    if isinstance(val, list):
+        return [map_value(v) for v in val]
+    if isinstance(val, dict):
+        return dict((k, map_value(v)) for (k, v) in val.items())
+    return val
+
+
 class DbObject(object):
     "A single object in a database catalog, e.g., a schema, a table, a column"
 
@@ -148,6 +228,12 @@ class DbObject(object):
     See description of :meth:`key` for further details.
     """
 
+    unmapped = ('oid', 'depends_on')
+    """Attributes that are never output by :meth:`to_map` as is
+
+    The `depends_on` attribute is only output in part, as external keys.
+    """
+
     @property
     def objtype(self):
         """Type of object as an uppercase string, for SQL syntax generation
@@ -195,7 +281,7 @@ class DbObject(object):
         """
         self.owner = owner
         if isinstance(privileges, strtypes):
-            privileges = privileges.split(',')
+            privileges = acl_items(privileges)
         self.privileges = privileges or []
 
     def __repr__(self):
@@ -326,7 +412,7 @@ class DbObject(object):
         """
         return quote_id(self.__dict__[self.keylist[0]])
 
-    def to_map(self, db, no_owner=False, no_privs=False, deepcopy=True):
+    def to_map(self, db, no_owner=False, no_privs=False):
         """Convert an object to a YAML-suitable format
 
         :param db: db used to tie the objects together
@@ -335,15 +421,18 @@ class DbObject(object):
         :return: dictionary
 
         The return value, a Python dictionary, is equivalent to a YAML
-        or JSON object.
+        or JSON object.  It is built from the object attributes,
+        excluding those in :attr:`keylist`, the private ones (starting
+        with an underscore) and those in :attr:`unmapped`.  Lists and
+        dictionaries are copied (see :func:`map_value`), so that
+        subclasses can adjust them in place, but the database objects
+        they may refer to are not.
         """
-        import copy
-        if deepcopy:
-            dct = copy.deepcopy(self.__dict__)
-        else:
-            dct = self.__dict__.copy()
-        for key in self.keylist:
-            del dct[key]
+        excluded = self._map_excluded()
+        dct = {}
+        for (key, val) in self.__dict__.items():
+            if key[0] != '_' and key not in excluded:
+                dct[key] = map_value(val)
         if self.description is None:
             del dct['description']
         if no_owner or self.owner is None:
@@ -353,37 +442,35 @@ class DbObject(object):
         else:
             dct['privileges'] = self.map_privs()
 
-        # Never dump the oid
-        dct.pop('oid', None)
-
         # Only dump dependencies that can't be inferred from the context
-        deps = set(dct.pop('depends_on', ()))
+        deps = set(self.__dict__.get('depends_on', ()))
         deps -= self.get_implied_deps(db)
         if deps:
             dct['depends_on'] = sorted([dep.extern_key() for dep in deps])
 
-        # Drop any private attributes
-        for k in list(dct.keys()):
-            if k.startswith('_'):
-                del dct[k]
-
         return dct
 
+    @classmethod
+    def _map_excluded(cls):
+        """Return the names of the attributes not mapped by :meth:`to_map`
+
+        :return: frozenset
+
+        The set is computed once per class.
+        """
+        excluded = cls.__dict__.get('_map_excluded_attrs')
+        if excluded is None:
+            excluded = frozenset(cls.keylist) | frozenset(cls.unmapped)
+            cls._map_excluded_attrs = excluded
+        return excluded
+
     def map_privs(self):
         """Return a list of access privileges on the current object
 
         :return: list
         """
-        privlist = []
-        for prv in self.privileges:
-            if prv:
-                privlist.append(privileges_to_map(prv, self.allprivs,
-                                                  self.owner))
-        sorted_privlist = []
-        for sortedItem in sorted([list(i.keys())[0] for i in privlist]):
-            sorted_privlist.append([item for item in privlist
-                                    if list(item.keys())[0] == sortedItem][0])
-        return sorted_privlist
+        return [privileges_to_map(acl, self.allprivs, self.owner) for acl
+                in sorted(self.privileges, key=lambda acl: acl.grantee)]
 
     def set_oldname(self, inobj):
         """Set oldname attribute if present in the input YAML map
@@ -582,6 +669,41 @@ class DbSchemaObject(DbObject):
         """
         return super(DbSchemaObject, self).extern_filename(ext, True)
 
+    def diff_options(self, newopts):
+        """Compare storage parameter lists and generate SET or RESET clause
+
+        :newopts: list of new options
+        :return: SQL SET / RESET clauses
+
+        Generate ([SET|RESET storage_parameter=value) clauses from two
+        lists in the form of 'key=value' strings.
+        """
+        def to_dict(optlist):
+            return dict(opt.split('=', 1) for opt in optlist)
+
+        oldopts = {}
+        if self.options is not None:
+            oldopts = to_dict(self.options)
+        newopts = to_dict(newopts)
+        setclauses = []
+        for key, val in list(newopts.items()):
+            if key not in oldopts:
+                setclauses.append("%s=%s" % (key, val))
+            elif val != oldopts[key]:
+                setclauses.append("%s=%s" % (key, val))
+        resetclauses = []
+        for key, val in list(oldopts.items()):
+            if key not in newopts:
+                resetclauses.append("%s" % key)
+        clauses = ''
+        if setclauses:
+            clauses = "SET (%s)" % ', '.join(setclauses)
+            if resetclauses:
+                clauses += ', '
+        if resetclauses:
+            clauses += "RESET (%s)" % ', '.join(resetclauses)
+        return clauses
+
     def rename(self, oldname):
         """Return SQL statement to RENAME the schema object
 
@@ -630,7 +752,8 @@ class DbObjectDict(dict):
         self.by_oid = {}
         self.dbconn = dbconn
         if dbconn:
-            self._from_catalog()
+            with timed('fetch %s' % type(self).__name__):
+                self._from_catalog()
 
     def _from_catalog(self):
         """Initialize the dictionary by querying the catalogs
@@ -653,8 +776,8 @@ class DbObjectDict(dict):
         :return: dictionary
 
         Invokes the `to_map` method of each object to construct the
-        dictionary.  If `opts` specifies a directory, the objects are
-        written to files in that directory.
+        dictionary.  If `opts` specifies multiple files, the objects
+        are output to files through the `opts.writer`.
         """
         objdict = {}
         for objkey in sorted(self.keys()):
@@ -664,12 +787,12 @@ class DbObjectDict(dict):
                 extkey = obj.extern_key()
                 outobj = {extkey: objmap}
                 if opts.multiple_files:
-                    filepath = obj.extern_filename()
-                    with open(os.path.join(opts.metadata_dir, filepath),
-                              'a') as f:
-                        f.write(yamldump(outobj))
+                    filepath = obj.extern_filename(opts.writer.format.ext)
+                    opts.writer.add(filepath, outobj)
                     outobj = {extkey: filepath}
                 objdict.update(outobj)
+        if opts.multiple_files:
+            opts.writer.checkpoint()
         return objdict
 
     def fetch(self):
@@ -6,11 +6,13 @@
     This module defines two classes: Column derived from
     DbSchemaObject and ColumnDict derived from DbObjectDict.
 """
-from . import DbObjectDict, DbSchemaObject, quote_id
+from . import DbObjectDict, DbSchemaObject, DeferredStmt, quote_id
+from . import MAX_PG_IDENT_LEN
 from .privileges import privileges_from_map, add_grant, diff_privs
 
 
 IDENTITY_TYPES = {'a': 'always', 'd': 'by default'}
+GENERATED_TYPES = {'s': 'stored'}
 
 
 class Column(DbSchemaObject):
@@ -22,7 +24,7 @@ class Column(DbSchemaObject):
     def __init__(self, name, schema, table, number, type, description=None,
                  privileges=[], not_null=True, default=None, identity=None,
                  collation=None, statistics=None, inherited=False,
-                 dropped=False):
+                 dropped=False, generated=None):
         """Initialize the column
 
         :param name: column/attribute name (from attname)
@@ -39,6 +41,7 @@ class Column(DbSchemaObject):
         :param statistics: statistics detail level (from attstattarget)
         :param inherited: inherited indicator (from attinhcount)
         :param dropped: dropped indicator (from attisdropped)
+        :param generated: type of generated column (from attgenerated)
         """
         super(Column, self).__init__(name, schema, description)
         self._init_own_privs(None, privileges)
@@ -55,6 +58,14 @@ class Column(DbSchemaObject):
             self.identity = identity
         assert self.identity is None or \
             self.identity in IDENTITY_TYPES.values()
+        if generated == '' or generated is None:
+            self.generated = None
+        elif len(generated) == 1:
+            self.generated = GENERATED_TYPES[generated]
+        else:
+            self.generated = generated
+        assert self.generated is None or \
+            self.generated in GENERATED_TYPES.values()
         self.collation = collation
         self.statistics = statistics
         self.inherited = inherited
@@ -69,7 +80,7 @@ class Column(DbSchemaObject):
                    attnum AS number, format_type(atttypid, atttypmod) AS type,
                    attnotnull AS not_null, attinhcount > 0 AS inherited,
                    pg_get_expr(adbin, adrelid) AS default, %s AS identity,
-                   attstattarget AS statistics,
+                   %s AS generated, attstattarget AS statistics,
                    collname AS collation, attisdropped AS dropped,
                    array_to_string(attacl, ',') AS privileges,
                    col_description(c.oid, attnum) AS description
@@ -83,9 +94,11 @@ class Column(DbSchemaObject):
               AND attnum > 0
            ORDER BY nspname, relname, attnum"""
         if dbversion < 100000:
-            return qry % ("NULL")
+            return qry % ("NULL", "NULL")
+        elif dbversion < 120000:
+            return qry % ("attidentity", "NULL")
         else:
-            return qry % ("attidentity")
+            return qry % ("attidentity", "attgenerated")
 
     @staticmethod
     def from_map(name, table, num, inobj):
@@ -103,7 +116,7 @@ class Column(DbSchemaObject):
             inobj.pop('not_null', False), inobj.pop('default', None),
             inobj.pop('identity', None), inobj.pop('collation', None),
             inobj.pop('statistics', None), inobj.pop('inherited', False),
-            inobj.pop('dropped', False))
+            inobj.pop('dropped', False), inobj.pop('generated', None))
         obj.set_oldname(inobj)
         if len(obj.privileges) > 0:
             if table.owner is None:
@@ -121,7 +134,7 @@ class Column(DbSchemaObject):
         """
         if self.dropped:
             return None
-        dct = super(Column, self).to_map(db, False, no_privs, deepcopy=False)
+        dct = super(Column, self).to_map(db, False, no_privs)
         del dct['number'], dct['name'], dct['dropped']
         if not self.not_null:
             dct.pop('not_null')
@@ -129,6 +142,8 @@ class Column(DbSchemaObject):
             dct.pop('default')
         if self.identity is None:
             dct.pop('identity')
+        if self.generated is None:
+            dct.pop('generated')
         if self.collation is None or self.collation == 'default':
             dct.pop('collation')
         if not self.inherited:
@@ -145,7 +160,10 @@ class Column(DbSchemaObject):
         stmt = "%s %s" % (quote_id(self.name), self.type)
         if self.not_null:
             stmt += ' NOT NULL'
-        if self.default is not None:
+        if self.generated is not None:
+            stmt += " GENERATED ALWAYS AS (%s) %s" % (
+                self.default, self.generated.upper())
+        elif self.default is not None:
             stmt += ' DEFAULT ' + self.default
         if self.identity is not None:
             stmt += " GENERATED %s AS IDENTITY" % self.identity.upper()
@@ -216,21 +234,73 @@ class Column(DbSchemaObject):
         self.name = newname
         return stmt
 
+    def set_not_null_online(self, oldtable=None):
+        """Return statements to SET NOT NULL without a long exclusive lock
+
+        :param oldtable: the existing table, if any
+        :return: tuple of partial SQL statement and list of statements
+
+        A CHECK (col IS NOT NULL) constraint is added as NOT VALID and
+        validated after the main transaction, which only needs a SHARE
+        UPDATE EXCLUSIVE lock.  Postgres 12 and later then skip the
+        table scan for SET NOT NULL, after which the CHECK is dropped.
+
+        The CHECK is named after the table and column, truncated if
+        needed, with a numeric suffix if a constraint of the existing
+        or the new table already has that name.
+        """
+        names = set()
+        for table in (oldtable, self._table):
+            if table is None:
+                continue
+            names.update(table.check_constraints, table.foreign_keys,
+                         table.unique_constraints)
+            if table.primary_key is not None:
+                names.add(table.primary_key.name)
+        # the CHECKs for other columns of the table
+        if not hasattr(self._table, '_not_null_checks'):
+            self._table._not_null_checks = []
+        checks = self._table._not_null_checks
+        names.update(checks)
+        base = "%s_%s_not_null" % (self.table, self.name)
+        name = base[:MAX_PG_IDENT_LEN]
+        suffix = 0
+        while name in names:
+            suffix += 1
+            name = "%s%d" % (base[:MAX_PG_IDENT_LEN - len(str(suffix))],
+                             suffix)
+        checks.append(name)
+        cnsname = quote_id(name)
+        tblname = self._table.qualname()
+        return ("ADD CONSTRAINT %s CHECK (%s IS NOT NULL) NOT VALID" % (
+            cnsname, quote_id(self.name)), [
+                DeferredStmt("ALTER TABLE %s VALIDATE CONSTRAINT %s" % (
+                    tblname, cnsname)),
+                DeferredStmt("ALTER TABLE %s ALTER COLUMN %s SET NOT NULL" % (
+                    tblname, quote_id(self.name))),
+                DeferredStmt("ALTER TABLE %s DROP CONSTRAINT %s" % (
+                    tblname, cnsname))])
+
     def alter(self, incol):
         """Generate SQL to transform an existing column
 
         :param insequence: a YAML map defining the new column
-        :return: list of partial SQL statements
+        :return: tuple of partial SQL statements and list of statements
 
         Compares the column to an input column and generates partial
         SQL statements to transform it into the one represented by the
         input.
         """
         stmts = []
+        deferred = []
         base = "ALTER COLUMN %s " % quote_id(self.name)
         # check NOT NULL
         if not self.not_null and incol.not_null:
-            stmts.append(base + "SET NOT NULL")
+            if getattr(incol, '_online', False):
+                (stmt, deferred) = incol.set_not_null_online(self._table)
+                stmts.append(stmt)
+            else:
+                stmts.append(base + "SET NOT NULL")
         if self.not_null and not incol.not_null:
             stmts.append(base + "DROP NOT NULL")
         # check data types
@@ -241,14 +311,15 @@ class Column(DbSchemaObject):
         if self.type != incol.type:
             # validate type conversion?
             stmts.append(base + "TYPE %s" % incol.type)
-        # check DEFAULTs
-        if self.default is None and incol.default is not None:
-            stmts.append(base + "SET DEFAULT %s" % incol.default)
-        if self.default is not None:
-            if incol.default is None:
-                stmts.append(base + "DROP DEFAULT")
-            elif self.default != incol.default:
+        # check DEFAULTs (the expression of a generated column is not one)
+        if self.generated is None and incol.generated is None:
+            if self.default is None and incol.default is not None:
                 stmts.append(base + "SET DEFAULT %s" % incol.default)
+            if self.default is not None:
+                if incol.default is None:
+                    stmts.append(base + "DROP DEFAULT")
+                elif self.default != incol.default:
+                    stmts.append(base + "SET DEFAULT %s" % incol.default)
         # check STATISTICS
         if self.statistics is not None:
             if self.statistics == -1 and (incol.statistics is not None
@@ -258,7 +329,7 @@ class Column(DbSchemaObject):
                                           or incol.statistics == -1):
                 stmts.append(base + "SET STATISTICS -1")
 
-        return (", ".join(stmts), self.diff_description(incol))
+        return (", ".join(stmts), self.diff_description(incol) + deferred)
 
 
 class ColumnDict(DbObjectDict):
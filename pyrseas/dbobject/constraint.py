@@ -12,7 +12,7 @@
           Perhaps the latter should inherit from the former.
 """
 from pyrseas.lib.pycompat import u
-from . import DbObjectDict, DbSchemaObject
+from . import DbObjectDict, DbSchemaObject, DeferredStmt
 from . import quote_id, split_schema_obj, commentable
 from .index import Index
 
@@ -82,6 +82,17 @@ class Constraint(DbSchemaObject):
         return ["ALTER %s %s DROP CONSTRAINT %s" % (
             self._table.objtype, self._table.qualname(), quote_id(self.name))]
 
+    def validate(self):
+        """Return statement to validate a constraint added as NOT VALID
+
+        :return: deferred SQL statement
+
+        The validation only needs a SHARE UPDATE EXCLUSIVE lock, so it
+        is deferred until after the main transaction.
+        """
+        return DeferredStmt("ALTER %s %s VALIDATE CONSTRAINT %s" % (
+            self._table.objtype, self._table.qualname(), quote_id(self.name)))
+
     def comment(self):
         """Return SQL statement to create COMMENT on constraint
 
@@ -202,9 +213,12 @@ class CheckConstraint(Constraint):
             expr = "(%s)" % self.expression
         else:
             expr = self.expression
-        return ["ALTER %s %s ADD CONSTRAINT %s %s %s" % (
+        stmt = "ALTER %s %s ADD CONSTRAINT %s %s %s" % (
             self._table.objtype, self._table.qualname(), quote_id(self.name),
-            self.objtype, expr)]
+            self.objtype, expr)
+        if getattr(self, '_online', False):
+            return [stmt + " NOT VALID", self.validate()]
+        return [stmt]
 
     def drop(self):
         if self.inherited:
@@ -530,11 +544,14 @@ class ForeignKey(Constraint):
         if self.deferred:
             actions += " INITIALLY DEFERRED"
 
-        return "ALTER TABLE %s ADD CONSTRAINT %s FOREIGN KEY (%s) " \
+        stmt = "ALTER TABLE %s ADD CONSTRAINT %s FOREIGN KEY (%s) " \
             "REFERENCES %s (%s)%s%s" % (
                 self._table.qualname(), quote_id(self.name),
                 self.key_columns(), self._references.qualname(),
                 self.ref_columns(), match, actions)
+        if getattr(self, '_online', False):
+            return [stmt + " NOT VALID", self.validate()]
+        return [stmt]
 
     def alter(self, infk):
         """Generate SQL to transform an existing foreign key
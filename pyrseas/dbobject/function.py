@@ -11,6 +11,7 @@ from pyrseas.lib.pycompat import PY2
 from pyrseas.yamlutil import MultiLineStr
 from . import DbObjectDict, DbSchemaObject
 from . import commentable, ownable, grantable, split_schema_obj
+from . import normalize_sql
 
 VOLATILITY_TYPES = {'i': 'immutable', 's': 'stable', 'v': 'volatile'}
 PARALLEL_SAFETY = {'r': 'restricted', 's': 'safe', 'u': 'unsafe'}
@@ -30,6 +31,25 @@ def split_schema_func(schema, func):
         return fnc
 
 
+def normalize_source(source, language):
+    """Return a canonical form of a function's source for comparisons
+
+    :param source: function source (from prosrc)
+    :param language: implementation language
+    :return: string
+
+    SQL and PL/pgSQL sources are normalized as SQL text.  For other
+    languages, where whitespace may be significant, only trailing
+    whitespace and leading or trailing blank lines are ignored.
+    """
+    if source is None:
+        return None
+    if language in ('sql', 'plpgsql'):
+        return normalize_sql(source)
+    lines = [line.rstrip() for line in source.split('\n')]
+    return '\n'.join(lines).strip('\n')
+
+
 def join_schema_func(func):
     """Join the schema and function, if needed, to form a qualified name
 
@@ -330,10 +350,14 @@ class Function(Proc):
 
         Compares the function to an input function and generates SQL
         statements to transform it into the one represented by the
-        input.
+        input.  The sources are compared after normalization (see
+        :func:`normalize_source`) so that differences only in
+        formatting or comments do not replace the function.
         """
         stmts = []
-        if self.source != infunction.source and infunction.source is not None:
+        if infunction.source is not None and \
+                normalize_source(self.source, self.language) != \
+                normalize_source(infunction.source, infunction.language):
             stmts.append(self.create(
                 dbversion=dbversion,
                 returns=infunction.returns,
@@ -6,8 +6,8 @@
     This defines two classes, Index and IndexDict, derived
     from DbSchemaObject and DbObjectDict, respectively.
 """
-from . import DbObjectDict, DbSchemaObject
-from . import quote_id, commentable
+from . import DbObjectDict, DbSchemaObject, DeferredStmt
+from . import quote_id, commentable, MAX_PG_IDENT_LEN
 
 
 def split_exprs(idx_exprs):
@@ -41,6 +41,31 @@ def split_exprs(idx_exprs):
     return [idx_exprs[start:end] for start, end in splits]
 
 
+def key_definitions(defn):
+    """Helper function to extract the key list from pg_get_indexdef()
+
+    The parenthesized list of keys after the access method is returned
+    without the parentheses, and without the INCLUDE, WITH (storage
+    parameters) and WHERE clauses that may follow it.
+    """
+    _, _, keydefs = defn.partition(' USING ')
+    keydefs = keydefs[keydefs.find(' (') + 2:]
+    level = 0
+    in_literal = False
+    for i, c in enumerate(keydefs):
+        if c == "'":
+            in_literal = not in_literal
+        elif in_literal:
+            continue
+        elif c == '(':
+            level += 1
+        elif c == ')':
+            if level == 0:
+                return keydefs[:i]
+            level -= 1
+    return keydefs
+
+
 class Index(DbSchemaObject):
     """A physical index definition, other than a primary key or unique
     constraint index.
@@ -57,7 +82,7 @@ class Index(DbSchemaObject):
     def __init__(self, name, schema, table, description, unique=False,
                  access_method='btree', keys=[], predicate=None,
                  tablespace=None, cluster=False, keyexprs=None, defn=None,
-                 oid=None):
+                 options=None, oid=None):
         """Initialize the index
 
         :param name: index name (from relname)
@@ -72,6 +97,7 @@ class Index(DbSchemaObject):
         :param cluster: clustered indicator (from indisclustered)
         :param keyexprs: list of expressions (from indexprs)
         :param defn: index definition (from pg_get_indexdef)
+        :param options: storage parameters (from reloptions)
         """
         super(Index, self).__init__(name, schema, description)
         self.table = self.unqualify(table)
@@ -84,6 +110,7 @@ class Index(DbSchemaObject):
         self.predicate = predicate
         self.tablespace = tablespace
         self.cluster = cluster
+        self.options = options
         self.oid = oid
 
     @staticmethod
@@ -96,6 +123,7 @@ class Index(DbSchemaObject):
                    pg_get_expr(indpred, indrelid) AS predicate,
                    pg_get_indexdef(indexrelid) AS defn,
                    spcname AS tablespace, indisclustered AS cluster,
+                   c.reloptions AS options,
                    obj_description (c.oid, 'pg_class') AS description, c.oid
             FROM pg_index i JOIN pg_class c ON (indexrelid = c.oid)
                  JOIN pg_namespace ON (relnamespace = pg_namespace.oid)
@@ -127,16 +155,15 @@ class Index(DbSchemaObject):
             name, table.schema, table.name, inobj.pop('description', None),
             inobj.pop('unique', False), inobj.pop('access_method', 'btree'),
             inobj.pop(keys, []), inobj.pop('predicate', None),
-            inobj.pop('tablespace', None), inobj.pop('cluster', False))
+            inobj.pop('tablespace', None), inobj.pop('cluster', False),
+            options=inobj.pop('options', None))
         if 'depends_on' in inobj:
             obj.depends_on.extend(inobj['depends_on'])
         obj.set_oldname(inobj)
         return obj
 
     def _parse_keys(self, keycols, exprs, defn):
-        keydefs, _, _ = defn.partition(' WHERE ')
-        _, _, keydefs = keydefs.partition(' USING ')
-        keydefs = keydefs[keydefs.find(' (') + 2:-1]
+        keydefs = key_definitions(defn)
         # split expressions
         if exprs is not None:
             exprs = split_exprs(exprs)
@@ -227,43 +254,110 @@ class Index(DbSchemaObject):
             dct.pop('access_method')
         if not self.unique:
             dct.pop('unique')
-        for attr in ['predicate', 'tablespace']:
+        for attr in ['predicate', 'tablespace', 'options']:
             if getattr(self, attr) is None:
                 dct.pop(attr)
         if not self.cluster:
             dct.pop('cluster')
         return {self.name: dct}
 
-    @commentable
-    def create(self, dbversion=None):
-        """Return a SQL statement to CREATE the index
+    def same_definition(self, other):
+        """Is the index defined identically to another (except name)?
 
-        :return: SQL statements
+        :param other: the other index
+        :return: boolean
+        """
+        for attr in ('table', 'access_method', 'unique', 'keys', 'predicate',
+                     'tablespace', 'cluster', 'description'):
+            if getattr(self, attr) != getattr(other, attr):
+                return False
+        return sorted(self.options or []) == sorted(other.options or [])
+
+    def _create_stmt(self, name=None, concurrently=False):
+        """Return the CREATE INDEX statement
+
+        :param name: index name, if different from the current name
+        :param concurrently: build the index concurrently
+        :return: SQL statement
         """
-        stmts = []
-
-        # indexes defined by constraints are not to be dealt with as indexes
-        if getattr(self, '_for_constraint', None):
-            return stmts
-
         acc = ''
         if self.access_method != 'btree':
             acc = 'USING %s ' % self.access_method
+        opts = ''
+        if self.options is not None:
+            opts = '\n    WITH (%s)' % ', '.join(self.options)
         tblspc = ''
         if self.tablespace is not None:
             tblspc = '\n    TABLESPACE %s' % self.tablespace
         pred = ''
         if self.predicate is not None:
             pred = '\n    WHERE %s' % self.predicate
-        stmts.append("CREATE %sINDEX %s ON %s %s(%s)%s%s" % (
-            'UNIQUE ' if self.unique else '', quote_id(self.name),
+        return "CREATE %sINDEX %s%s ON %s %s(%s)%s%s%s" % (
+            'UNIQUE ' if self.unique else '',
+            'CONCURRENTLY ' if concurrently else '',
+            quote_id(name or self.name),
             self.qualname(self.schema, self.table), acc,
-            self.key_expressions(), tblspc, pred))
+            self.key_expressions(), opts, tblspc, pred)
+
+    @commentable
+    def create(self, dbversion=None):
+        """Return a SQL statement to CREATE the index
+
+        :return: SQL statements
+        """
+        stmts = []
+
+        # indexes defined by constraints are not to be dealt with as indexes
+        if getattr(self, '_for_constraint', None):
+            return stmts
+
+        if getattr(self, '_online', False):
+            stmts.append(DeferredStmt(self._create_stmt(concurrently=True)))
+            if self.cluster:
+                stmts.append(DeferredStmt("ALTER TABLE %s CLUSTER ON %s" % (
+                    self.qualname(self.schema, self.table),
+                    quote_id(self.name))))
+            return stmts
+        stmts.append(self._create_stmt())
         if self.cluster:
             stmts.append("CLUSTER %s USING %s" % (
                 self.qualname(self.schema, self.table), quote_id(self.name)))
         return stmts
 
+    def comment(self):
+        """Return SQL statement to create a COMMENT on the index
+
+        :return: SQL statement, deferred if the index is built online
+        """
+        stmt = super(Index, self).comment()
+        if getattr(self, '_online', False):
+            return DeferredStmt(stmt)
+        return stmt
+
+    def rebuild_online(self, inindex):
+        """Return statements to replace the index without blocking writes
+
+        :param inindex: the new index definition
+        :return: list of deferred SQL statements
+
+        The replacement is built concurrently under a temporary name.
+        The current index is then dropped and the new one renamed,
+        clustered on and given its description, if any.
+        """
+        tmpname = "%s_ccnew" % self.name[:MAX_PG_IDENT_LEN - 6]
+        stmts = [DeferredStmt(inindex._create_stmt(tmpname, True)),
+                 DeferredStmt("DROP INDEX CONCURRENTLY %s" %
+                              self.identifier()),
+                 DeferredStmt("ALTER INDEX %s RENAME TO %s" % (
+                     self.qualname(self.schema, tmpname),
+                     quote_id(self.name)))]
+        if inindex.cluster:
+            stmts.append(DeferredStmt("ALTER TABLE %s CLUSTER ON %s" % (
+                self.qualname(self.schema, self.table), quote_id(self.name))))
+        if inindex.description is not None:
+            stmts.append(DeferredStmt(inindex.comment()))
+        return stmts
+
     def alter(self, inindex):
         """Generate SQL to transform an existing index
 
@@ -272,7 +366,8 @@ class Index(DbSchemaObject):
 
         Compares the index to an input index and generates SQL
         statements to transform it into the one represented by the
-        input.
+        input.  Changes to storage parameters, tablespace or
+        clustering do not require the index to be rebuilt.
         """
         stmts = []
 
@@ -283,13 +378,21 @@ class Index(DbSchemaObject):
         if self.access_method != inindex.access_method \
                 or self.unique != inindex.unique \
                 or self.keys != inindex.keys:
+            if getattr(inindex, '_online', False):
+                # the description is set on the replacement
+                stmts.append(self.rebuild_online(inindex))
+                return stmts
             stmts.append("DROP INDEX %s" % self.qualname())
             self.access_method = inindex.access_method
             self.unique = inindex.unique
             self.keys = inindex.keys
+            self.options = inindex.options
             stmts.append(self.create())
 
         base = "ALTER INDEX %s\n    " % self.qualname()
+        diff_opts = self.diff_options(inindex.options or [])
+        if diff_opts:
+            stmts.append(base + diff_opts)
         if inindex.tablespace is not None:
             if self.tablespace is not None \
                     or self.tablespace != inindex.tablespace:
@@ -351,3 +454,40 @@ class IndexDict(DbObjectDict):
             inobj = inindexes[i]
             self[(table.schema, table.name, i)] = Index.from_map(
                 i, table, inobj)
+
+    def detect_renames(self, olddict):
+        """Flag new indexes that only differ in name from a current one
+
+        :param olddict: dictionary of the current indexes
+
+        A new index that is not in `olddict` and is defined exactly
+        like a current index, on the same table, which is missing from
+        the new dictionary, is treated as if it had been specified
+        with an `oldname`, so that it is renamed instead of recreated.
+        This is only done if the match is unambiguous: no other new
+        index matches that current index, and no other current index
+        matches that new index.  Otherwise, the indexes are dropped and
+        created as usual.
+        """
+        dropped = {}
+        for key, old in list(olddict.items()):
+            if key not in self and not getattr(old, '_for_constraint', None):
+                dropped.setdefault((old.schema, old.table), []).append(old)
+        if not dropped:
+            return
+        added = {}
+        for key in sorted(self.keys()):
+            new = self[key]
+            if key in olddict or getattr(new, 'oldname', None) or \
+                    getattr(new, '_for_constraint', None):
+                continue
+            added.setdefault((new.schema, new.table), []).append(new)
+        for tblkey, news in list(added.items()):
+            olds = dropped.get(tblkey, [])
+            for new in news:
+                matches = [old for old in olds if new.same_definition(old)]
+                if len(matches) != 1:
+                    continue
+                if len([other for other in news
+                        if other.same_definition(matches[0])]) == 1:
+                    new.oldname = matches[0].name
@@ -5,78 +5,162 @@
 
     This defines functions for dealing with access privileges.
 """
+from collections import namedtuple
 
 PRIVCODES = {'a': 'insert', 'r': 'select', 'w': 'update', 'd': 'delete',
              'D': 'truncate', 'x': 'references', 't': 'trigger',
              'X': 'execute', 'U': 'usage', 'C': 'create'}
 PRIVILEGES = dict((v, k) for k, v in list(PRIVCODES.items()))
+# bits are assigned in sorted code order, which is also the order in
+# which privileges are listed in GRANT/REVOKE statements and YAML maps
+PRIVBITS = [(code, 1 << i) for i, code in enumerate(sorted(PRIVCODES.keys()))]
+PRIVMASKS = dict(PRIVBITS)
 
 
-def _split_privs(privspec):
-    """Split the aclitem into three parts
+def privmask(privcodes):
+    """Convert a string of privilege codes to a bitmask
 
-    :param privspec: privilege specification (aclitem)
-    :return: tuple with grantee, privilege codes and granto
+    :param privcodes: string of privilege codes, e.g., 'arwdDxt'
+    :return: integer
     """
-    (usr, prvgrant) = privspec.split('=')
-    if usr == '':
-        usr = 'PUBLIC'
-    (privcodes, grantor) = prvgrant.split('/')
-    return (usr, privcodes, grantor)
+    mask = 0
+    for code in privcodes:
+        mask |= PRIVMASKS.get(code, 0)
+    return mask
 
 
-def _expand_priv_lists(obj, privcodes, subobj):
-    """Convert privilege code strings to expanded lists
+class AclItem(namedtuple('AclItem', 'grantee grantor privs grantable')):
+    """A parsed access privilege item (aclitem)
+
+    The grantee (PUBLIC for all roles) and grantor are role names.
+    The privileges and those held WITH GRANT OPTION are bitmasks (see
+    :data:`PRIVBITS`).  Instances are created once, when privileges
+    are fetched from the catalogs or read from the YAML map.
+    """
+    __slots__ = ()
+
+    @classmethod
+    def parse(cls, privspec):
+        """Create an AclItem from its Postgres text representation
+
+        :param privspec: privilege specification (aclitem)
+        :return: AclItem
+
+        Access privileges are specified as aclitem's as follows:
+        <grantee>=<privlist>/<grantor>.  The grantee and grantor are
+        user names.  The privlist is a set of single letter codes,
+        each letter optionally followed by an asterisk to indicate
+        WITH GRANT OPTION.
+        """
+        (usr, prvgrant) = privspec.split('=')
+        (privcodes, grantor) = prvgrant.split('/')
+        privs = grantable = 0
+        for i, code in enumerate(privcodes):
+            bit = PRIVMASKS.get(code, 0)
+            privs |= bit
+            if privcodes[i + 1:i + 2] == '*':
+                grantable |= bit
+        return cls(usr or 'PUBLIC', grantor, privs, grantable)
+
+    def __str__(self):
+        codes = ''
+        for code, bit in PRIVBITS:
+            if self.privs & bit:
+                codes += code
+                if self.grantable & bit:
+                    codes += '*'
+        return "%s=%s/%s" % ('' if self.grantee == 'PUBLIC' else
+                             self.grantee, codes, self.grantor)
+
+
+def acl_items(privileges):
+    """Parse a list or comma-separated string of aclitems
+
+    :param privileges: aclitem strings, e.g., from array_to_string
+    :return: list of AclItem
+    """
+    if not isinstance(privileges, list):
+        privileges = privileges.split(',')
+    return [priv if isinstance(priv, AclItem) else AclItem.parse(priv)
+            for priv in privileges if priv]
+
+
+def _is_all(acl, allmask):
+    """Check whether the item is equivalent to ALL privileges
+
+    :param acl: AclItem
+    :param allmask: bitmask of privileges equal to ALL
+    :return: boolean
+    """
+    return acl.privs == allmask and not acl.grantable and \
+        allmask & (allmask - 1) != 0
+
+
+def _expand_priv_lists(obj, acl, subobj):
+    """Convert privilege bitmasks to expanded lists
 
     :param obj: the object on which the privilege is granted
-    :param privcodes: string of privilege codes
+    :param acl: AclItem
     :param subobj: sub-object name (e.g., column name)
     :return: tuple of lists with decoded privileges
     """
     privs = []
     wgo = []
-    if privcodes == obj.allprivs and len(obj.allprivs) > 1:
+    if _is_all(acl, privmask(obj.allprivs)):
         privs = ['ALL']
     else:
         if subobj:
             subobj = ' (%s)' % subobj
-        for code in sorted(PRIVCODES.keys()):
-            if code in privcodes:
+        for code, bit in PRIVBITS:
+            if acl.privs & bit:
                 priv = PRIVCODES[code].upper() + subobj
-                if code + '*' in privcodes:
+                if acl.grantable & bit:
                     wgo.append(priv)
                 else:
                     privs.append(priv)
     return (privs, wgo)
 
 
-def privileges_to_map(privspec, allprivs, owner):
+class GrantStmt(str):
+    """A GRANT statement on a single object
+
+    Besides the SQL text, the instance records the object, grantee,
+    privileges (as listed in the statement and as a bitmask) and
+    whether they are granted WITH GRANT OPTION, so that GRANTs on many
+    objects can later be consolidated.
+    """
+
+    def __new__(cls, stmt, obj, grantee, privs, mask, grant_option):
+        self = super(GrantStmt, cls).__new__(cls, stmt)
+        self.obj = obj
+        self.grantee = grantee
+        self.privs = privs
+        self.privmask = mask
+        self.grant_option = grant_option
+        return self
+
+
+def privileges_to_map(acl, allprivs, owner):
     """Map a set of privileges in PostgreSQL format to YAML-suitable format
 
-    :param privspec: privilege specification
+    :param acl: privilege specification (AclItem)
     :param allprivs: privilege list equal to ALL
     :param owner: object owner
     :return: dictionary
-
-    Access privileges are specified as aclitem's as follows:
-    <grantee>=<privlist>/<grantor>.  The grantee and grantor are user
-    names.  The privlist is a set of single letter codes, each letter
-    optionally followed by an asterisk to indicate WITH GRANT OPTION.
     """
-    (usr, privcodes, grantor) = _split_privs(privspec)
     privs = []
-    if privcodes == allprivs and len(allprivs) > 1:
+    if _is_all(acl, privmask(allprivs)):
         privs = ['all']
     else:
-        for code in sorted(PRIVCODES.keys()):
-            if code in privcodes:
+        for code, bit in PRIVBITS:
+            if acl.privs & bit:
                 priv = PRIVCODES[code]
-                if code + '*' in privcodes:
+                if acl.grantable & bit:
                     priv = {priv: {'grantable': True}}
                 privs.append(priv)
-    if owner and grantor != owner:
-        privs = {'privs': privs, 'grantor': grantor}
-    return {usr: privs}
+    if owner and acl.grantor != owner:
+        privs = {'privs': privs, 'grantor': acl.grantor}
+    return {acl.grantee: privs}
 
 
 def privileges_from_map(privlist, allprivs, owner):
@@ -85,7 +169,7 @@ def privileges_from_map(privlist, allprivs, owner):
     :param privspec: privilege specification
     :param allprivs: privilege list equal to ALL
     :param owner: object owner
-    :return: list
+    :return: list of AclItem
     """
     retlist = []
     for priv in privlist:
@@ -95,109 +179,113 @@ def privileges_from_map(privlist, allprivs, owner):
         if 'grantor' in privs:
             grantor = privs['grantor']
             privs = privs['privs']
-        if usr == 'PUBLIC':
-            usr = ''
-        prvcodes = ''
+        mask = grantable = 0
         if privs == ['all']:
-            prvcodes = allprivs
+            mask = privmask(allprivs)
         else:
             for prv in privs:
                 if isinstance(prv, dict):
                     key = list(prv.keys())[0]
                 else:
                     key = prv
-                if key in PRIVILEGES:
-                    prvcodes += PRIVILEGES[key]
+                bit = PRIVMASKS.get(PRIVILEGES.get(key), 0)
+                mask |= bit
                 if isinstance(prv, dict) and isinstance(prv[key], dict) and \
                         'grantable' in prv[key] and prv[key]['grantable']:
-                    prvcodes += '*'
-        retlist.append("%s=%s/%s" % (usr, prvcodes, grantor))
+                    grantable |= bit
+        retlist.append(AclItem(usr, grantor, mask, grantable))
     return retlist
 
 
-def add_grant(obj, privspec, subobj=''):
+def add_grant(obj, acl, subobj=''):
     """Return GRANT statements on the object based on the privilege spec
 
     :param obj: the object on which the privilege is granted
-    :param privspec: the privilege specification (aclitem)
+    :param acl: the privilege specification (AclItem)
     :param subobj: sub-object name (e.g., column name)
     :return: list of GRANT statements
     """
-    (usr, privcodes, grantor) = _split_privs(privspec)
-    (privs, wgo) = _expand_priv_lists(obj, privcodes, subobj)
+    (privs, wgo) = _expand_priv_lists(obj, acl, subobj)
     objtype = obj.objtype
     if hasattr(obj, 'privobjtype'):
         objtype = obj.privobjtype
     stmts = []
     if privs:
-        stmts.append("GRANT %s ON %s %s TO %s" % (
-            ', '.join(privs), objtype, obj.identifier(), usr))
+        stmt = "GRANT %s ON %s %s TO %s" % (
+            ', '.join(privs), objtype, obj.identifier(), acl.grantee)
+        if not subobj:
+            stmt = GrantStmt(stmt, obj, acl.grantee, ', '.join(privs),
+                             acl.privs & ~acl.grantable, False)
+        stmts.append(stmt)
     if wgo:
-        stmts.append("GRANT %s ON %s %s TO %s WITH GRANT OPTION" % (
-            ', '.join(wgo), objtype, obj.identifier(), usr))
+        stmt = "GRANT %s ON %s %s TO %s WITH GRANT OPTION" % (
+            ', '.join(wgo), objtype, obj.identifier(), acl.grantee)
+        if not subobj:
+            stmt = GrantStmt(stmt, obj, acl.grantee, ', '.join(wgo),
+                             acl.grantable, True)
+        stmts.append(stmt)
     return stmts
 
 
-def add_revoke(obj, privspec, subobj=''):
+def add_revoke(obj, acl, subobj=''):
     """Return REVOKE statements on the object based on the privilege spec
 
     :param obj: the object on which the privilege is to be revoked
-    :param privspec: the privilege specification (aclitem)
+    :param acl: the privilege specification (AclItem)
     :param subobj: sub-object name (e.g., column name)
     :return: list of REVOKE statements
     """
-    (usr, privcodes, grantor) = _split_privs(privspec)
-    (privs, wgo) = _expand_priv_lists(obj, privcodes, subobj)
+    (privs, wgo) = _expand_priv_lists(obj, acl, subobj)
     objtype = obj.objtype
     if hasattr(obj, 'privobjtype'):
         objtype = obj.privobjtype
     stmts = []
     if wgo:
         stmts.append("REVOKE %s ON %s %s FROM %s" % (
-            ', '.join(wgo), objtype, obj.identifier(), usr))
+            ', '.join(wgo), objtype, obj.identifier(), acl.grantee))
     if privs:
         stmts.append("REVOKE %s ON %s %s FROM %s" % (
-            ', '.join(privs), objtype, obj.identifier(), usr))
+            ', '.join(privs), objtype, obj.identifier(), acl.grantee))
     return stmts
 
 
+def holds_privileges(obj, grantee, mask, grant_option=False):
+    """Check whether a grantee holds privileges granted by the owner
+
+    :param obj: the object on which the privileges are granted
+    :param grantee: the role name or PUBLIC
+    :param mask: bitmask of privileges
+    :param grant_option: privileges must be held WITH GRANT OPTION
+    :return: boolean
+    """
+    for acl in obj.privileges:
+        if acl.grantee == grantee and acl.grantor == obj.owner:
+            held = acl.grantable if grant_option else acl.privs
+            return held & mask == mask
+    return False
+
+
 def diff_privs(currobj, currlist, newobj, newlist, subobj=''):
     """Return GRANT or REVOKE statements to adjust object privileges
 
     :param currobj: current object
-    :param currlist: list of current privileges
+    :param currlist: list of current privileges (AclItem)
     :param newobj: new object
-    :param newlist: list of new privileges
+    :param newlist: list of new privileges (AclItem)
     :param subobj: sub-object (e.g., column name)
     :return: list of GRANT and REVOKE statements
     """
-    def rejoin(privdict, usr, grantor):
-        return '%s=%s/%s' % ('' if usr == 'PUBLIC' else usr,
-                             privdict[(usr, grantor)], grantor)
-
     stmts = []
-    currprivs = {}
-    newprivs = {}
-    for privspec in currlist:
-        if privspec:
-            (usr, privcodes, grantor) = _split_privs(privspec)
-            currprivs[(usr, grantor)] = privcodes
-    for privspec in newlist:
-        if privspec:
-            (usr, privcodes, grantor) = _split_privs(privspec)
-            newprivs[(usr, grantor)] = privcodes
-    for (usr, gtor) in currprivs:
-        if (usr, gtor) not in newprivs:
-            stmts.append(add_revoke(currobj, rejoin(currprivs, usr, gtor),
-                                    subobj))
-    for (usr, gtor) in newprivs:
-        if (usr, gtor) not in currprivs:
-            stmts.append(add_grant(newobj, rejoin(newprivs, usr, gtor),
-                                   subobj))
-        else:
-            if sorted(currprivs[(usr, gtor)]) != sorted(newprivs[(usr, gtor)]):
-                stmts.append(add_revoke(currobj, rejoin(currprivs, usr, gtor),
-                                        subobj))
-                stmts.append(add_grant(newobj, rejoin(newprivs, usr, gtor),
-                                       subobj))
+    currprivs = dict(((acl.grantee, acl.grantor), acl) for acl in currlist)
+    newprivs = dict(((acl.grantee, acl.grantor), acl) for acl in newlist)
+    for key in currprivs:
+        if key not in newprivs:
+            stmts.append(add_revoke(currobj, currprivs[key], subobj))
+    for key in newprivs:
+        if key not in currprivs:
+            stmts.append(add_grant(newobj, newprivs[key], subobj))
+        elif (currprivs[key].privs, currprivs[key].grantable) != \
+                (newprivs[key].privs, newprivs[key].grantable):
+            stmts.append(add_revoke(currobj, currprivs[key], subobj))
+            stmts.append(add_grant(newobj, newprivs[key], subobj))
     return stmts
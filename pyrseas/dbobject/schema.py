@@ -8,7 +8,8 @@
 """
 import os
 
-from pyrseas.yamlutil import yamldump
+from pyrseas.datacopy import check_format, check_mode, check_order
+from pyrseas.datacopy import tracking_stmts
 from . import DbObjectDict, DbObject
 from . import quote_id, commentable, ownable, grantable
 from .dbtype import BaseType, Composite, Domain, Enum, Range
@@ -147,29 +148,30 @@ class Schema(DbObject):
             dir = self.extern_dir(opts.data_dir)
             if not os.path.exists(dir):
                 os.mkdir(dir)
+            exporter = getattr(opts, 'data_exporter', None)
             for tbl in self.datacopy:
-                self.tables[tbl].data_export(dbschemas.dbconn, dir)
+                if exporter is not None:
+                    exporter.add(self.tables[tbl], dir)
+                else:
+                    self.tables[tbl].data_export(dbschemas.dbconn, dir)
 
         if opts.multiple_files:
-            dir = self.extern_dir(opts.metadata_dir)
-            if not os.path.exists(dir):
-                os.mkdir(dir)
+            dir = self.extern_dir()
+            ext = opts.writer.format.ext
             filemap = {}
             for obj, objmap in schobjs:
                 if objmap is not None:
                     extkey = obj.extern_key()
-                    filepath = os.path.join(dir, obj.extern_filename())
-                    with open(filepath, 'a') as f:
-                        f.write(yamldump({extkey: objmap}))
-                    outobj = {extkey:
-                              os.path.relpath(filepath, opts.metadata_dir)}
-                    filemap.update(outobj)
-            # always write the schema YAML file
-            filepath = self.extern_filename()
+                    filepath = os.path.normpath(opts.writer.object_path(
+                        dir, obj.extern_filename(ext)))
+                    opts.writer.add(filepath, {extkey: objmap})
+                    filemap.update({extkey: filepath})
+            # always write the schema file
+            filepath = self.extern_filename(ext)
             extkey = self.extern_key()
-            with open(os.path.join(opts.metadata_dir, filepath), 'a') as f:
-                f.write(yamldump({extkey: schbase}))
+            opts.writer.add(filepath, {extkey: schbase})
             filemap.update(schema=filepath)
+            opts.writer.checkpoint()
             return {extkey: filemap}
 
         schmap = dict((obj.extern_key(), objmap) for obj, objmap in schobjs
@@ -199,8 +201,16 @@ class Schema(DbObject):
         stmts = []
         if hasattr(self, 'datacopy') and self.datacopy:
             dir = self.extern_dir(opts.data_dir)
+            unchanged = getattr(opts, 'unchanged_tables', ())
+            loaded = getattr(opts, 'loaded_checksums', {})
             for tbl in self.datacopy:
-                stmts.append(self.tables[tbl].data_import(dir))
+                dbconn = None
+                if (self.name, tbl) in unchanged:
+                    dbconn = opts.dbconn
+                stmts.append(self.tables[tbl].data_import(
+                    dir, getattr(opts, 'server_version', None),
+                    getattr(opts, 'bulk_loader', None), dbconn,
+                    loaded.get((self.name, tbl))))
         return stmts
 
     def drop(self):
@@ -325,7 +335,18 @@ class SchemaDict(DbObjectDict):
             targ = getattr(db, objtype)
             for keys in targ:
                 link_one(targ, objtype, keys)
+        # the data format and import mode may be given for all tables,
+        # and for each table
+        format = datacopy.get('format', 'csv')
+        check_format(format)
+        mode = datacopy.get('mode', 'replace')
+        check_mode(mode)
+        skip = datacopy.get('skip_unchanged', False)
+        order = datacopy.get('order', 'sort')
+        check_order(order)
         for key in datacopy:
+            if key in ('format', 'mode', 'skip_unchanged', 'order'):
+                continue
             if not key.startswith('schema '):
                 raise KeyError("Unrecognized object type: %s" % key)
             sch = key[7:]
@@ -335,8 +356,24 @@ class SchemaDict(DbObjectDict):
             if not hasattr(schema, 'datacopy'):
                 schema.datacopy = []
             for tbl in datacopy[key]:
+                tblopts = {}
+                if isinstance(tbl, dict):
+                    (tbl, tblopts) = list(tbl.items())[0]
+                    tblopts = tblopts or {}
+                tblformat = tblopts.get('format', format)
+                check_format(tblformat)
+                tblmode = tblopts.get('mode', mode)
+                check_mode(tblmode)
+                tblorder = tblopts.get('order', order)
+                check_order(tblorder)
                 if hasattr(schema, 'tables') and tbl in schema.tables:
                     schema.datacopy.append(tbl)
+                    schema.tables[tbl]._copy_format = tblformat
+                    schema.tables[tbl]._copy_chunks = tblopts.get('chunks')
+                    schema.tables[tbl]._copy_mode = tblmode
+                    schema.tables[tbl]._copy_order = tblorder
+                    schema.tables[tbl]._copy_skip_unchanged = tblopts.get(
+                        'skip_unchanged', skip)
 
     def to_map(self, db, opts):
         """Convert the schema dictionary to a regular dictionary
@@ -348,20 +385,35 @@ class SchemaDict(DbObjectDict):
         dictionary of schemas.
         """
         schemas = {}
-        selschs = getattr(opts, 'schemas', [])
-        for sch in self:
-            if not selschs or sch in selschs:
-                if hasattr(opts, 'excl_schemas') and opts.excl_schemas \
-                        and sch in opts.excl_schemas:
-                    continue
-                schemas.update(self[sch].to_map(db, self, opts))
+        for sch in self.selected(opts):
+            schemas.update(sch.to_map(db, self, opts))
 
         return schemas
 
+    def selected(self, opts):
+        """Return the schemas to be mapped
+
+        :param opts: options to include/exclude schemas
+        :return: list of schemas
+        """
+        selschs = getattr(opts, 'schemas', [])
+        exclschs = getattr(opts, 'excl_schemas', None)
+        return [self[sch] for sch in self
+                if (not selschs or sch in selschs) and
+                not (exclschs and sch in exclschs)]
+
     def data_import(self, opts):
         """Iterate over schemas with tables to be imported
 
         :param opts: options to include/exclude schemas/tables, etc.
         :return: list of SQL statements
+
+        If any table skips unchanged data, the table recording the data
+        loaded is created first, if needed.
         """
-        return [self[sch].data_import(opts) for sch in self]
+        stmts = [self[sch].data_import(opts) for sch in self]
+        for sch in self.values():
+            if any(getattr(sch.tables[tbl], '_copy_skip_unchanged', False)
+                   for tbl in getattr(sch, 'datacopy', [])):
+                return tracking_stmts() + stmts
+        return stmts
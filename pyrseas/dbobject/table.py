@@ -12,8 +12,14 @@ import re
 import os
 import sys
 
-from pyrseas.lib.pycompat import PY2
-from . import DbObjectDict, DbSchemaObject, split_schema_obj
+from pyrseas.lib.pycompat import PY2, strtypes
+from pyrseas.datacopy import copy_program, copy_to_file, data_ext, data_paths
+from pyrseas.datacopy import binary_compatible, is_binary_file
+from pyrseas.datacopy import read_binary_header, chunks_path, read_chunks
+from pyrseas.datacopy import remove_chunks, range_condition, chunk_digest
+from pyrseas.datacopy import files_checksum, record_load_stmts
+from pyrseas.datacopy import sort_csv_file
+from . import DbObjectDict, DbSchemaObject, DeferredStmt, split_schema_obj
 from . import quote_id, commentable, ownable, grantable
 from .constraint import CheckConstraint, PrimaryKey
 from .constraint import ForeignKey, UniqueConstraint
@@ -34,6 +40,18 @@ def seq_min_value(seq):
     return " MINVALUE %d" % seq.min_value
 
 
+def text_cast(expr, type):
+    """Return an expression converting a value through its text form
+
+    :param expr: SQL expression
+    :param type: type to convert to, or None to leave the value as is
+    :return: SQL expression
+    """
+    if type is None:
+        return expr
+    return "%s::text::%s" % (expr, type)
+
+
 class DbClass(DbSchemaObject):
     """A table, sequence or view
 
@@ -627,41 +645,6 @@ class Table(DbClass):
             stmts.append("DROP TABLE %s" % self.identifier())
         return stmts
 
-    def diff_options(self, newopts):
-        """Compare options lists and generate SQL SET or RESET clause
-
-        :newopts: list of new options
-        :return: SQL SET / RESET clauses
-
-        Generate ([SET|RESET storage_parameter=value) clauses from two
-        lists in the form of 'key=value' strings.
-        """
-        def to_dict(optlist):
-            return dict(opt.split('=', 1) for opt in optlist)
-
-        oldopts = {}
-        if self.options is not None:
-            oldopts = to_dict(self.options)
-        newopts = to_dict(newopts)
-        setclauses = []
-        for key, val in list(newopts.items()):
-            if key not in oldopts:
-                setclauses.append("%s=%s" % (key, val))
-            elif val != oldopts[key]:
-                setclauses.append("%s=%s" % (key, val))
-        resetclauses = []
-        for key, val in list(oldopts.items()):
-            if key not in newopts:
-                resetclauses.append("%s" % key)
-        clauses = ''
-        if setclauses:
-            clauses = "SET (%s)" % ', '.join(setclauses)
-            if resetclauses:
-                clauses += ', '
-        if resetclauses:
-            clauses += "RESET (%s)" % ', '.join(resetclauses)
-        return clauses
-
     def alter(self, intable):
         """Generate SQL to transform an existing table
 
@@ -743,42 +726,444 @@ class Table(DbClass):
 
         return stmts
 
-    def data_export(self, dbconn, dirpath):
+    def data_export(self, dbconn, dirpath, compression=None, filename=None,
+                    where=None):
         """Copy table data out to a file
 
         :param dbconn: database connection to use
         :param dirpath: full path to the directory for the file to be created
+        :param compression: compression method of the file, if any
+        :param filename: name of the file for a chunk of the data
+        :param where: condition selecting the rows of the chunk
+
+        The data is copied in the format configured for the table, CSV
+        by default.  The file of a chunk is written under a temporary
+        name, and renamed when complete.
+
+        The rows are ordered as configured for the table:
+
+        - 'sort' (the default): sorted by the server, on the primary
+          key or else on all the columns,
+        - 'index': on a unique key (see :meth:`order_key`), with sorts
+          disabled so that the server reads the rows in index order,
+        - 'client': copied unsorted, and then sorted by their text
+          (see :func:`~pyrseas.datacopy.sort_csv_file`).
+
+        Without a unique key, the 'index' order falls back to 'client',
+        and binary data, which cannot be sorted by the client, to
+        'sort'.
         """
-        filepath = os.path.join(dirpath, self.extern_filename('data'))
-        if self.primary_key is not None:
-            order_by = [self.columns[col - 1].name
-                        for col in self.primary_key.columns]
+        format = getattr(self, '_copy_format', 'csv')
+        if filename is None:
+            filepath = os.path.join(dirpath, self.extern_filename(
+                data_ext(compression, format)))
         else:
-            order_by = ['%d' % (n + 1) for n in range(len(self.columns))]
-        dbconn.sql_copy_to(
-            "COPY (SELECT * FROM %s ORDER BY %s) TO STDOUT WITH CSV" % (
-                self.qualname(), ', '.join(order_by)), filepath)
+            filepath = os.path.join(dirpath, '.tmp.' + filename)
+        order = getattr(self, '_copy_order', 'sort')
+        if order == 'index':
+            order_by = self.order_key()
+            if order_by is None:
+                order = 'client'
+        if order == 'client' and format == 'binary':
+            order = 'sort'
+        if order == 'sort':
+            if self.primary_key is not None:
+                order_by = [self.columns[col - 1].name
+                            for col in self.primary_key.columns]
+            else:
+                order_by = ['%d' % (n + 1)
+                            for n in range(len(self.data_columns()))]
+        if [col for col in self.columns if col.generated is not None]:
+            # generated columns are not copied
+            select = ", ".join(quote_id(name)
+                               for (name, type) in self.data_columns())
+        else:
+            select = "*"
+        query = "SELECT %s FROM %s%s" % (
+            select, self.qualname(),
+            '' if where is None else " WHERE " + where)
+        if order != 'client':
+            query += " ORDER BY %s" % ', '.join(order_by)
+        if order == 'index':
+            dbconn.execute("SET enable_sort = off").close()
+        try:
+            if format == 'binary':
+                copy_to_file(dbconn, "COPY (%s) TO STDOUT WITH "
+                             "(FORMAT binary)" % query, filepath,
+                             self.data_columns())
+            elif order == 'client':
+                unsorted = filepath + '.unsorted'
+                try:
+                    copy_to_file(dbconn, "COPY (%s) TO STDOUT WITH CSV" %
+                                 query, unsorted)
+                    sort_csv_file(unsorted, filepath)
+                finally:
+                    if os.path.exists(unsorted):
+                        os.remove(unsorted)
+            else:
+                copy_to_file(dbconn, "COPY (%s) TO STDOUT WITH CSV" % query,
+                             filepath)
+        finally:
+            if order == 'index':
+                dbconn.execute("RESET enable_sort").close()
+        if filename is not None:
+            os.rename(filepath, os.path.join(dirpath, filename))
+            return
+        # remove files output previously with another compression, or
+        # in chunks
+        for path in data_paths(self, dirpath):
+            if path != filepath and os.path.exists(path):
+                os.remove(path)
+        remove_chunks(self, dirpath)
+
+    def order_key(self):
+        """Return the columns of a unique key to order the rows by
+
+        :return: list of quoted column names, or None
+
+        The key is the primary key or, failing that, the unique
+        constraint or plain, unique B-tree index with the fewest
+        columns, all of them NOT NULL.
+        """
+        if self.primary_key is not None:
+            return [quote_id(self.columns[col - 1].name)
+                    for col in self.primary_key.columns]
+        notnull = set(quote_id(col.name) for col in self.columns
+                      if col.not_null and not col.dropped)
+        keys = []
+        for constr in self.unique_constraints.values():
+            keys.append([quote_id(self.columns[col - 1].name)
+                         if isinstance(col, int) else quote_id(col)
+                         for col in constr.columns])
+        for idx in self.indexes.values():
+            if idx.unique and idx.access_method == 'btree' and \
+                    idx.predicate is None and \
+                    all(isinstance(col, strtypes) for col in idx.keys):
+                keys.append([quote_id(col) for col in idx.keys])
+        keys = [key for key in keys if all(col in notnull for col in key)]
+        if not keys:
+            return None
+        return min(keys, key=len)
+
+    def key_columns(self):
+        """Return the names and types of the primary key columns
 
-    def data_import(self, dirpath):
+        :return: list of (quoted name, type) tuples
+
+        The key columns are attribute numbers for tables read from the
+        catalogs, but names for those in the input map.
+        """
+        columns = []
+        for col in self.primary_key.columns:
+            if isinstance(col, int):
+                col = self.columns[col - 1]
+            else:
+                col = [c for c in self.columns
+                       if c.name == col and not c.dropped][0]
+            columns.append((quote_id(col.name), col.type))
+        return columns
+
+    def data_columns(self):
+        """Return the names and types of the columns holding data
+
+        :return: list of (name, type) tuples
+
+        Generated columns are excluded, since their values are
+        computed by the server.
+        """
+        return [(col.name, col.type) for col in self.columns
+                if not col.dropped and col.generated is None]
+
+    def _overriding(self, cols):
+        """Return the clause needed to insert into identity columns
+
+        :param cols: list of (quoted name, type) of the columns
+        :return: OVERRIDING clause, or an empty string
+        """
+        names = [name for (name, type) in cols]
+        if [col for col in self.columns if col.identity == 'always'
+                and quote_id(col.name) in names]:
+            return " OVERRIDING SYSTEM VALUE"
+        return ''
+
+    def data_files(self, dirpath):
+        """Return the data files of the table, most recent output first
+
+        :param dirpath: full path for the directory for the files
+        :return: list of file paths
+
+        If the data was exported more than once, with different
+        formats or compression methods, or in chunks, the files most
+        recently output are used.  The files of the chunks are listed
+        in key order.  If there are no files, the path of an
+        uncompressed file in the configured format is returned.
+        """
+        paths = data_paths(self, dirpath)
+        existing = [path for path in paths if os.path.exists(path)]
+        manifest_path = chunks_path(self, dirpath)
+        if os.path.exists(manifest_path) and not [
+                path for path in existing if os.path.getmtime(path) >
+                os.path.getmtime(manifest_path)]:
+            manifest = read_chunks(manifest_path)
+            if not manifest['complete']:
+                raise ValueError("The data of table %s was not completely "
+                                 "exported" % self.qualname())
+            return [os.path.join(dirpath, chunk['file'])
+                    for chunk in manifest['chunks']]
+        if existing:
+            return [max(existing, key=os.path.getmtime)]
+        return [os.path.join(dirpath, self.extern_filename(data_ext(
+            None, getattr(self, '_copy_format', 'csv'))))]
+
+    def _copy_stmts(self, filepaths, version, merge=False, where=None):
+        """Generate the statements copying data files into the table
+
+        :param filepaths: list of paths of the data files
+        :param version: version number of the target server
+        :param merge: merge the data with the existing rows
+        :param where: condition on the key of the existing rows to
+            merge the data with (default all)
+        :return: list of SQL statements
+
+        Binary data is copied as is only if it was copied out of
+        columns of the same types, on a server of the same or an
+        earlier major version.  Otherwise, it is copied into a
+        temporary table with the original column types, from which
+        the values of the columns whose types differ are converted
+        through their text representation, i.e., as if the data had
+        been exported and loaded in CSV format: a value that the
+        target type does not accept is an error, rather than being
+        coerced by a cast between the two types, which may not exist.
+        Data to be merged is also copied into a temporary table first.
+        """
+        stmts = []
+        temp = "pg_temp.%s" % quote_id("%s_%s_data" % (
+            self.schema, self.name))
+        target = self.qualname()
+        options = "' csv"
+        header = None
+        if is_binary_file(filepaths[0]):
+            options = "' with (format binary)"
+            if os.path.exists(filepaths[0]):
+                header = read_binary_header(filepaths[0])
+            if binary_compatible(header, self.data_columns(), version):
+                header = None
+            else:
+                target = temp
+                stmts.append("CREATE TEMPORARY TABLE %s (%s)" % (
+                    target, ", ".join("%s %s" % (quote_id(name), type)
+                                      for (name, type) in header['columns'])))
+        if merge and target != temp:
+            target = temp
+            if [col for col in self.columns if col.generated is not None]:
+                # the data of generated columns is not in the files
+                stmts.append("CREATE TEMPORARY TABLE %s (%s)" % (
+                    target, ", ".join("%s %s" % (quote_id(name), type)
+                                      for (name, type)
+                                      in self.data_columns())))
+            else:
+                stmts.append("CREATE TEMPORARY TABLE %s (LIKE %s)" % (
+                    target, self.qualname()))
+        for filepath in filepaths:
+            program = copy_program(filepath)
+            if program is None:
+                stmts.append(("\\copy ", target, " from '", filepath,
+                              options))
+            else:
+                # decompressed by psql as it reads the file
+                stmts.append(("\\copy ", target,
+                              " from program '%s " % program, filepath,
+                              options))
+        if target == temp:
+            if header is None:
+                cols = [(quote_id(name), None)
+                        for (name, type) in self.data_columns()]
+            else:
+                srctypes = dict(header['columns'])
+                cols = [(quote_id(name),
+                         None if srctypes[name] == type else type)
+                        for (name, type) in self.data_columns()
+                        if name in srctypes]
+            if merge:
+                stmts.extend(self._merge_stmts(temp, cols, where))
+            else:
+                stmts.append("INSERT INTO %s (%s)%s SELECT %s FROM %s" % (
+                    self.qualname(), ", ".join(name for (name, type) in cols),
+                    self._overriding(cols),
+                    ", ".join(text_cast(name, type) for (name, type) in cols),
+                    temp))
+            stmts.append("DROP TABLE %s" % temp)
+        return stmts
+
+    def _merge_stmts(self, temp, cols, where=None):
+        """Generate the statements merging a temporary table's rows
+
+        :param temp: name of the temporary table holding the data
+        :param cols: list of (quoted name, type) of the columns to
+            merge, with the type to convert the values to, through
+            their text representation, or None
+        :param where: condition on the key of the existing rows to
+            merge the data with (default all)
+        :return: list of SQL statements
+
+        The existing rows whose primary key is not found in the data
+        are deleted, those whose values differ are updated, and the
+        rows not found in the table are inserted.  Rows that did not
+        change are not touched.  The values of GENERATED ALWAYS
+        identity columns are inserted, overriding those of the
+        sequence, but cannot be updated: they are only compared when
+        part of the primary key.
+        """
+        def source(name, type):
+            return text_cast("s.%s" % name, type)
+
+        keys = [name for (name, type) in self.key_columns()]
+        exprs = dict((name, source(name, type)) for (name, type) in cols)
+        match = "(%s) = (%s)" % (", ".join("t.%s" % name for name in keys),
+                                 ", ".join(exprs[name] for name in keys))
+        always = [quote_id(col.name) for col in self.columns
+                  if col.identity == 'always']
+        others = [name for (name, type) in cols
+                  if name not in keys and name not in always]
+        stmts = ["ANALYZE %s" % temp]
+        stmts.append("DELETE FROM %s t WHERE %sNOT EXISTS (SELECT 1 FROM %s "
+                     "s WHERE %s)" % (self.qualname(), '' if where is None
+                                      else where + " AND ", temp, match))
+        if others:
+            # compared as text, since some types have no equality operator
+            stmts.append(
+                "UPDATE %s t SET %s FROM %s s WHERE %s AND ROW(%s)::text "
+                "IS DISTINCT FROM ROW(%s)::text" % (
+                    self.qualname(), ", ".join("%s = %s" % (name, exprs[name])
+                                               for name in others),
+                    temp, match, ", ".join("t.%s" % name for name in others),
+                    ", ".join(exprs[name] for name in others)))
+        stmts.append("INSERT INTO %s (%s)%s SELECT %s FROM %s s WHERE NOT "
+                     "EXISTS (SELECT 1 FROM %s t WHERE %s)" % (
+                         self.qualname(), ", ".join(name for (name, type)
+                                                    in cols),
+                         self._overriding(cols),
+                         ", ".join(exprs[name] for (name, type) in cols),
+                         temp, self.qualname(), match))
+        return stmts
+
+    def _merge_parts(self, dirpath, dbconn=None):
+        """Return the data files to merge and the key ranges they hold
+
+        :param dirpath: full path for the directory for the files
+        :param dbconn: connection to the target database, to compare
+            the digests of the chunks with, if the table exists there
+            with the same columns and key
+        :return: list of (list of file paths, condition) tuples
+
+        The files of a table exported in chunks are merged one by one,
+        each with the existing rows in its key range.  A chunk whose
+        digest, recorded at export, is that of the existing rows in its
+        range is skipped.
+        """
+        filepaths = self.data_files(dirpath)
+        manifest = read_chunks(chunks_path(self, dirpath))
+        columns = self.key_columns()
+        if manifest is None or filepaths != [
+                os.path.join(dirpath, chunk['file'])
+                for chunk in manifest['chunks']] or \
+                manifest['columns'] != [list(col) for col in columns]:
+            return [(filepaths, None)]
+        parts = []
+        for (filepath, chunk) in zip(filepaths, manifest['chunks']):
+            where = range_condition(columns, chunk['lower'], chunk['upper'])
+            if dbconn is not None and 'digest' in chunk and \
+                    chunk['digest'] == chunk_digest(dbconn, self, columns,
+                                                    where):
+                continue
+            parts.append(([filepath], where))
+        return parts
+
+    def data_import(self, dirpath, version=None, bulk=None, dbconn=None,
+                    loaded=None):
         """Generate SQL to import data into a table
 
         :param dirpath: full path for the directory for the file
+        :param version: version number of the target server
+        :param bulk: BulkLoad to add the loading of the data to
+        :param dbconn: connection to the target database, if the table
+            exists there with the same columns and key
+        :param loaded: checksum of the data files last loaded into the
+            table, as recorded in the target database
         :return: list of SQL statements
+
+        With a `bulk` load, the statements returned only prepare the
+        table: its foreign keys, those referring to it, its other
+        constraints except the primary key, and its indexes are
+        dropped, and the table is truncated.  The data is copied, the
+        indexes rebuilt and the constraints added back (CHECK and
+        FOREIGN KEY constraints as NOT VALID, and then validated) by
+        the `bulk` load.
+
+        A table with a primary key configured with the 'merge' mode is
+        not truncated: the data is merged with the existing rows (see
+        :meth:`_merge_stmts`), in the main transaction even with a
+        `bulk` load.
+
+        For a table configured to skip unchanged data, the checksum of
+        the files is recorded in the target database, once loaded.  If
+        it is that of the data last loaded, nothing is done.
         """
-        filepath = os.path.join(dirpath, self.extern_filename('data'))
+        track = []
+        if getattr(self, '_copy_skip_unchanged', False):
+            checksum = files_checksum(self.data_files(dirpath))
+            if checksum is not None:
+                if dbconn is not None and checksum == loaded:
+                    return []
+                track = record_load_stmts(self, checksum)
+        merge = getattr(self, '_copy_mode', 'replace') == 'merge' and \
+            self.primary_key is not None
         stmts = []
-        if hasattr(self, '_referred_by'):
-            for constr in self._referred_by:
-                stmts.append(
-                    "ALTER TABLE %s DROP CONSTRAINT %s"
-                    % (constr._table.qualname(), constr.name)
-                )
+        fkeys = list(getattr(self, '_referred_by', []))
+        if bulk is not None:
+            if not merge:
+                fkeys.extend(self.foreign_keys.values())
+            # constraints between two tables loaded are only dropped once
+            fkeys = [constr for constr in fkeys if bulk.claim(constr)]
+        for constr in fkeys:
+            stmts.append(
+                "ALTER TABLE %s DROP CONSTRAINT %s"
+                % (constr._table.qualname(), constr.name)
+            )
+        if merge:
+            for (filepaths, where) in self._merge_parts(dirpath, dbconn):
+                stmts.extend(self._copy_stmts(filepaths, version, True,
+                                              where))
+            stmts.extend(track)
+            for constr in fkeys:
+                stmts.append(constr.add())
+            return stmts
+        if bulk is not None:
+            checks = [constr for constr in self.check_constraints.values()
+                      if not constr.inherited]
+            uniques = list(self.unique_constraints.values())
+            indexes = [idx for idx in self.indexes.values()
+                       if not getattr(idx, '_for_constraint', None)]
+            for obj in checks + uniques + indexes:
+                stmts.extend(obj.drop())
         stmts.append("TRUNCATE ONLY %s" % self.qualname())
-        stmts.append(("\\copy ", self.qualname(), " from '", filepath,
-                      "' csv"))
-        if hasattr(self, '_referred_by'):
-            for constr in self._referred_by:
+        if bulk is None:
+            stmts.extend(self._copy_stmts(self.data_files(dirpath), version))
+            stmts.extend(track)
+            for constr in fkeys:
                 stmts.append(constr.add())
+            return stmts
+
+        rebuilds = [obj.add() for obj in uniques] + \
+            [obj.create() for obj in indexes]
+        adds = []
+        for constr in checks + fkeys:
+            constr._online = True
+            adds.extend(constr.add())
+        bulk.add(self._copy_stmts(self.data_files(dirpath), version) + track,
+                 rebuilds,
+                 [stmt for stmt in adds if not isinstance(stmt, DeferredStmt)],
+                 [stmt for stmt in adds if isinstance(stmt, DeferredStmt)])
         return stmts
 
     def get_implied_deps(self, db):
@@ -8,7 +8,7 @@
 """
 from pyrseas.lib.pycompat import PY2
 from pyrseas.yamlutil import MultiLineStr
-from . import commentable, ownable, grantable
+from . import commentable, ownable, grantable, normalize_sql
 from .table import DbClass
 from .column import Column
 
@@ -122,7 +122,9 @@ class View(DbClass):
 
         Compares the view to an input view and generates SQL
         statements to transform it into the one represented by the
-        input.
+        input.  The definitions are compared after normalization (see
+        :func:`~pyrseas.dbobject.normalize_sql`), so that differences
+        only in formatting or comments do not replace the view.
         """
         stmts = []
         for col in self.columns:
@@ -132,7 +134,8 @@ class View(DbClass):
             if col.type != inview.columns[col.number - 1].type:
                 raise TypeError("Cannot change datatype of view column '%s'"
                                 % col.name)
-        if self.definition != inview.definition:
+        if normalize_sql(self.definition) != \
+                normalize_sql(inview.definition):
             stmts.append(self.create(dbversion, inview.definition))
         stmts.append(super(View, self).alter(inview))
         return stmts
@@ -6,9 +6,12 @@ from __future__ import print_function
 import sys
 
 from pyrseas import __version__
-from pyrseas.yamlutil import yamldump
+from pyrseas.yamlutil import yamldump_items
+from pyrseas.formats import FORMATS, map_format
 from pyrseas.database import Database
+from pyrseas.datacopy import check_compression
 from pyrseas.cmdargs import cmd_parser, parse_args
+from pyrseas.timings import start_collector, timed
 
 
 def main(schema=None):
@@ -17,6 +20,28 @@ def main(schema=None):
                         "YAML format", __version__)
     parser.add_argument('-m', '--multiple-files', action='store_true',
                         help='output to multiple files (metadata directory)')
+    parser.add_argument('--write-budget', type=float, metavar='MB',
+                        default=64,
+                        help='megabytes of multiple files output to buffer '
+                        'before writing (default %(default)s)')
+    parser.add_argument('--durability', choices=['none', 'atomic', 'fsync'],
+                        default='atomic',
+                        help='how multiple files are written (default '
+                        '%(default)s)')
+    parser.add_argument('--layout', choices=['flat', 'sharded'],
+                        default='flat',
+                        help='layout of the multiple files schema '
+                        'directories (default %(default)s)')
+    parser.add_argument('--format', choices=sorted(FORMATS.keys()),
+                        default='yaml',
+                        help='output format (default %(default)s)')
+    parser.add_argument('-j', '--jobs', type=int, default=1,
+                        help='number of connections to copy out the data '
+                        'of datacopy tables with (default %(default)s)')
+    parser.add_argument('--compress', choices=['none', 'gzip', 'zstd', 'lz4'],
+                        default='none',
+                        help='compression of the data files of datacopy '
+                        'tables (default %(default)s)')
     parser.add_argument('-O', '--no-owner', action='store_true',
                         help='exclude object ownership information')
     parser.add_argument('-x', '--no-privileges', action='store_true',
@@ -42,14 +67,34 @@ def main(schema=None):
     cfg = parse_args(parser)
     output = cfg['files']['output']
     options = cfg['options']
+    start_collector(options)
     if options.multiple_files and output:
         parser.error("Cannot specify both --multiple-files and --output")
+    try:
+        check_compression(options.compress)
+    except ValueError as exc:
+        parser.error(str(exc))
+    try:
+        mapfmt = map_format(options.format)
+    except ValueError as exc:
+        print("Unable to output the %s format: %s" % (options.format, exc))
+        return 1
 
     db = Database(cfg)
-    dbmap = db.to_map()
-
-    if not options.multiple_files:
-        print(yamldump(dbmap), file=output or sys.stdout)
+    if options.multiple_files:
+        db.to_map()
+    elif options.format == 'yaml':
+        # output one schema at a time
+        with timed('output map'):
+            yamldump_items(db.iter_map(), output or sys.stdout)
+            print(file=output or sys.stdout)
+        if output:
+            output.close()
+    else:
+        with timed('output map'):
+            data = mapfmt.dump(dict(db.iter_map()))
+            out = output or sys.stdout
+            getattr(out, 'buffer', out).write(data)
         if output:
             output.close()
 
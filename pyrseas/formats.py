@@ -0,0 +1,187 @@
+# -*- coding: utf-8 -*-
+"""
+    pyrseas.formats
+    ~~~~~~~~~~~~~~~
+
+    The formats in which database maps can be output and read: YAML,
+    the default, and JSON or MessagePack for use by other programs.
+    All of them hold the same maps, as output by `to_map` and input
+    to `from_map`.
+"""
+import json
+import struct
+from abc import ABCMeta, abstractmethod
+
+try:
+    import orjson
+except ImportError:
+    orjson = None
+try:
+    import msgpack
+except ImportError:
+    msgpack = None
+
+from pyrseas.yamlutil import yamldump, yamlload
+
+
+class MapFormat(ABCMeta('MapFormatBase', (object,), {})):
+    """A format of serialized database maps"""
+
+    name = None
+    """Format name, as given in the --format option"""
+
+    ext = None
+    """Extension of the files in the format"""
+
+    binary = False
+    """Whether the format is not text"""
+
+    @abstractmethod
+    def dump(self, objmap):
+        """Serialize a map
+
+        :param objmap: dictionary
+        :return: bytes
+        """
+
+    @abstractmethod
+    def load(self, data):
+        """Deserialize a map
+
+        :param data: bytes
+        :return: dictionary
+        """
+
+    @abstractmethod
+    def concat(self, parts):
+        """Combine serialized maps into the serialization of their union
+
+        :param parts: list of serialized maps, with distinct keys
+        :return: bytes
+
+        This is used for files holding several objects, e.g., casts.
+        """
+
+
+class YamlFormat(MapFormat):
+    """YAML, the default format"""
+
+    name = 'yaml'
+    ext = 'yaml'
+
+    def dump(self, objmap):
+        text = yamldump(objmap)
+        return text if isinstance(text, bytes) else text.encode('utf-8')
+
+    def load(self, data):
+        return yamlload(data)
+
+    def concat(self, parts):
+        # the top-level map is in block style, so the maps can follow
+        # each other
+        return b''.join(parts)
+
+
+class JsonFormat(MapFormat):
+    """JSON, encoded by orjson if available
+
+    The keys are sorted and the output indented, so that the result
+    does not depend on the encoder.
+    """
+
+    name = 'json'
+    ext = 'json'
+
+    def dump(self, objmap):
+        if orjson is not None:
+            return orjson.dumps(objmap, option=orjson.OPT_INDENT_2 |
+                                orjson.OPT_SORT_KEYS) + b'\n'
+        return json.dumps(objmap, indent=2, sort_keys=True,
+                          separators=(',', ': '),
+                          ensure_ascii=False).encode('utf-8') + b'\n'
+
+    def load(self, data):
+        if orjson is not None:
+            return orjson.loads(data)
+        return json.loads(data.decode('utf-8'))
+
+    def concat(self, parts):
+        if len(parts) == 1:
+            return parts[0]
+        # strip the braces of each object and join their members
+        return b'{\n' + b',\n'.join(part.strip()[1:-1].strip(b'\n')
+                                    for part in parts) + b'\n}\n'
+
+
+def _sorted_map(obj):
+    """Return a copy of a map with the keys of all dictionaries sorted
+
+    :param obj: dictionary or other value
+    :return: value, with dictionaries in sorted key order
+    """
+    if isinstance(obj, dict):
+        return dict((key, _sorted_map(obj[key])) for key in sorted(obj))
+    if isinstance(obj, list):
+        return [_sorted_map(val) for val in obj]
+    return obj
+
+
+class MsgpackFormat(MapFormat):
+    """MessagePack, a compact binary format (requires msgpack)"""
+
+    name = 'msgpack'
+    ext = 'msgpack'
+    binary = True
+
+    def __init__(self):
+        if msgpack is None:
+            raise ValueError("The msgpack format requires the msgpack "
+                             "package")
+
+    def dump(self, objmap):
+        # the keys are sorted so that unchanged maps give the same bytes
+        return msgpack.packb(_sorted_map(objmap), use_bin_type=True)
+
+    def load(self, data):
+        return msgpack.unpackb(data, raw=False)
+
+    def concat(self, parts):
+        if len(parts) == 1:
+            return parts[0]
+        # each part is a map of one member, i.e., starts with a fixmap
+        # header byte: replace them by a header for all the members
+        count = len(parts)
+        if count < 16:
+            header = struct.pack('B', 0x80 | count)
+        elif count < 65536:
+            header = struct.pack('>BH', 0xde, count)
+        else:
+            header = struct.pack('>BI', 0xdf, count)
+        return header + b''.join(part[1:] for part in parts)
+
+
+FORMATS = dict((cls.name, cls) for cls in (YamlFormat, JsonFormat,
+                                           MsgpackFormat))
+
+
+def map_format(name='yaml'):
+    """Return the map format of a given name
+
+    :param name: format name: 'yaml', 'json' or 'msgpack'
+    :return: MapFormat
+    """
+    if name not in FORMATS:
+        raise ValueError("Unknown format: %s" % name)
+    return FORMATS[name]()
+
+
+def format_of_file(path):
+    """Return the map format of a file, based on its extension
+
+    :param path: file path
+    :return: MapFormat, or None if the extension is not known
+    """
+    for cls in FORMATS.values():
+        if path.endswith('.' + cls.ext):
+            return cls()
+    return None
@@ -0,0 +1,152 @@
+# -*- coding: utf-8 -*-
+"""
+    pyrseas.mapcache
+    ~~~~~~~~~~~~~~~~
+
+    A `MapCache` keeps the parsed YAML maps of the files in a metadata
+    directory, so that only the files that changed since the previous
+    run need to be parsed again.
+
+    The caches are pickled, so they are kept in the user's cache
+    directory rather than next to the metadata directory, where they
+    could be committed to (and unpickled from) a shared repository.
+"""
+import os
+import sys
+import pickle
+from hashlib import sha1
+
+CACHE_VERSION = 1
+
+
+def cache_dir():
+    """Return the directory of the user's caches
+
+    :return: directory path
+
+    The directory can be set with the PYRSEAS_CACHE_DIR environment
+    variable.
+    """
+    dir = os.environ.get("PYRSEAS_CACHE_DIR")
+    if dir is None:
+        if sys.platform == 'win32':
+            dir = os.path.join(os.getenv('LOCALAPPDATA', ''), 'pyrseas')
+        else:
+            dir = os.path.join(os.environ.get('XDG_CACHE_HOME') or
+                               os.path.join(os.environ['HOME'], '.cache'),
+                               'pyrseas')
+    return os.path.abspath(dir)
+
+
+def file_digest(path):
+    """Return the SHA-1 digest of the contents of a file
+
+    :param path: file path
+    :return: hexadecimal digest string
+    """
+    digest = sha1()
+    with open(path, 'rb') as f:
+        for block in iter(lambda: f.read(65536), b''):
+            digest.update(block)
+    return digest.hexdigest()
+
+
+class MapCache(object):
+    """A cache of parsed maps, keyed by path relative to a directory
+
+    Each entry holds the modification time, size and, optionally, the
+    content digest of the file when it was parsed, together with the
+    parsed map.  An entry is valid if the modification time and size
+    are unchanged or, if digests are used, if the digest matches.
+    """
+
+    def __init__(self, basedir, use_digest=False):
+        """Initialize the cache, reading it if it exists
+
+        :param basedir: directory whose files are cached
+        :param use_digest: validate entries by content digest
+        """
+        self.basedir = os.path.normpath(basedir)
+        self.use_digest = use_digest
+        # named after the directory, but distinct for each full path
+        self.path = os.path.join(cache_dir(), "%s-%s.pickle" % (
+            os.path.basename(self.basedir), sha1(os.path.abspath(
+                self.basedir).encode('utf-8')).hexdigest()[:16]))
+        self.entries = {}
+        self.changed = False
+        try:
+            with open(self.path, 'rb') as f:
+                data = pickle.load(f)
+            if data.get('version') == CACHE_VERSION:
+                self.entries = data['files']
+        except Exception:
+            # missing, unreadable or incompatible cache: start afresh
+            pass
+        self.used = set()
+        self.pending = {}
+
+    def _key(self, path):
+        return os.path.relpath(path, self.basedir)
+
+    def get(self, path):
+        """Return the cached map for a file, if it is still valid
+
+        :param path: file path
+        :return: dictionary or None
+        """
+        key = self._key(path)
+        self.used.add(key)
+        stat = os.stat(path)
+        entry = self.entries.get(key)
+        if entry is not None:
+            (mtime, size, digest, objmap) = entry
+            if (stat.st_mtime, stat.st_size) == (mtime, size):
+                return objmap
+        digest = file_digest(path) if self.use_digest else None
+        if entry is not None and digest is not None and digest == entry[2]:
+            # contents unchanged, e.g., after a checkout: refresh the stamp
+            self.entries[key] = (stat.st_mtime, stat.st_size, digest, objmap)
+            self.changed = True
+            return objmap
+        # the file is stamped before it is parsed, so that changes made
+        # meanwhile will be noticed on the next run
+        self.pending[key] = (stat.st_mtime, stat.st_size, digest)
+        return None
+
+    def put(self, path, objmap):
+        """Store the parsed map of a file previously missed by :meth:`get`
+
+        :param path: file path
+        :param objmap: the parsed map
+        """
+        key = self._key(path)
+        self.entries[key] = self.pending.pop(key) + (objmap, )
+        self.changed = True
+
+    def save(self):
+        """Write the cache if it changed, dropping entries not used
+
+        The cache is written to a temporary file which then replaces
+        the previous cache, so that an interrupted run does not leave
+        a partial cache.
+        """
+        for key in list(self.entries.keys()):
+            if key not in self.used:
+                del self.entries[key]
+                self.changed = True
+        if not self.changed:
+            return
+        cachedir = os.path.dirname(self.path)
+        if not os.path.isdir(cachedir):
+            os.makedirs(cachedir)
+        tmppath = self.path + '.tmp'
+        with open(tmppath, 'wb') as f:
+            pickle.dump({'version': CACHE_VERSION, 'files': self.entries}, f,
+                        pickle.HIGHEST_PROTOCOL)
+        if hasattr(os, 'replace'):
+            os.replace(tmppath, self.path)
+        else:
+            if os.path.exists(self.path):
+                os.remove(self.path)
+            os.rename(tmppath, self.path)
+        self.changed = False
@@ -0,0 +1,271 @@
+# -*- coding: utf-8 -*-
+"""
+    pyrseas.mapwriter
+    ~~~~~~~~~~~~~~~~~
+
+    A `MapWriter` collects the contents of the files of a metadata
+    directory, as output by dbtoyaml --multiple-files, and then writes
+    only the files whose contents changed.
+"""
+import os
+from hashlib import sha1
+
+from pyrseas.formats import map_format
+from pyrseas.timings import timed
+
+DURABILITY = ['none', 'atomic', 'fsync']
+LAYOUTS = ['flat', 'sharded']
+DEFAULT_BUDGET = 64 * 1024 * 1024
+MANIFEST = 'manifest'
+
+
+def shard_name(filename):
+    """Return the name of the shard directory for an object file
+
+    :param filename: file name, e.g., table.t1.yaml
+    :return: two hexadecimal digits
+
+    The files are spread over 256 subdirectories by hashing their
+    names, so that the result does not depend on the other objects.
+    """
+    if not isinstance(filename, bytes):
+        filename = filename.encode('utf-8')
+    return sha1(filename).hexdigest()[:2]
+
+
+def manifest_name(ext):
+    """Return the name of the manifest of a sharded metadata directory
+
+    :param ext: extension of the files, e.g., yaml
+    :return: file name
+    """
+    return '%s.%s' % (MANIFEST, ext)
+
+
+def fsync_dir(path):
+    """Flush the entries of a directory to stable storage
+
+    :param path: directory path
+    """
+    if not hasattr(os, 'O_DIRECTORY'):
+        # e.g., on Windows directories cannot be opened
+        return
+    fd = os.open(path, os.O_RDONLY | os.O_DIRECTORY)
+    try:
+        os.fsync(fd)
+    finally:
+        os.close(fd)
+
+
+def replace_file(path, data, sync=False):
+    """Replace the contents of a file atomically
+
+    :param path: file path
+    :param data: new contents (bytes)
+    :param sync: flush the file to stable storage before renaming it
+
+    The data is written to a temporary file in the same directory,
+    which is then renamed to the target path.
+    """
+    (dirname, filename) = os.path.split(path)
+    tmppath = os.path.join(dirname, '.%s.tmp' % filename)
+    try:
+        with open(tmppath, 'wb') as f:
+            f.write(data)
+            if sync:
+                f.flush()
+                os.fsync(f.fileno())
+        if hasattr(os, 'replace'):
+            os.replace(tmppath, path)
+        else:
+            if os.path.exists(path):
+                os.remove(path)
+            os.rename(tmppath, path)
+    except Exception:
+        if os.path.exists(tmppath):
+            os.remove(tmppath)
+        raise
+
+
+def same_contents(path, data):
+    """Check whether a file exists and holds the given contents
+
+    :param path: file path
+    :param data: expected contents (bytes)
+    :return: boolean
+    """
+    try:
+        if os.path.getsize(path) != len(data):
+            return False
+        with open(path, 'rb') as f:
+            return f.read() == data
+    except (IOError, OSError):
+        return False
+
+
+class MapWriter(object):
+    """Writer of the files in a metadata directory
+
+    The map of each object is serialized in the writer's format (see
+    :mod:`pyrseas.formats`) and added under the path of its file,
+    relative to the metadata directory.  Objects that share a file,
+    e.g., casts, are combined in the order they were added.  The
+    buffered files are output when :meth:`checkpoint` finds they
+    exceed the memory budget, and when :meth:`finish` is called.  Each
+    file is compared to the existing one and only rewritten, with a
+    single write, if it changed.  Files of objects that no longer
+    exist are removed.
+
+    In the 'sharded' layout, the object files of each schema are placed
+    in subdirectories of the schema directory (see :func:`shard_name`),
+    and a manifest listing the object files of each schema file is
+    written to the metadata directory.
+
+    The durability policy is one of:
+
+    - 'none': files are overwritten in place,
+    - 'atomic': files are written to a temporary file which is renamed
+      to replace the previous version,
+    - 'fsync': as 'atomic', but the files are also flushed to stable
+      storage before being renamed, and each directory is flushed
+      once, after all of its files in a batch were written.
+    """
+
+    def __init__(self, basedir, budget=DEFAULT_BUDGET, durability='atomic',
+                 format=None, layout='flat'):
+        """Initialize the writer
+
+        :param basedir: metadata directory
+        :param budget: bytes of output to buffer before writing
+        :param durability: durability policy
+        :param format: MapFormat (default YAML)
+        :param layout: layout of the schema directories
+        """
+        if durability not in DURABILITY:
+            raise ValueError("Invalid durability policy: %s" % durability)
+        if layout not in LAYOUTS:
+            raise ValueError("Invalid layout: %s" % layout)
+        self.basedir = basedir
+        self.layout = layout
+        self.format = format or map_format()
+        self.budget = budget
+        self.durability = durability
+        self.files = {}
+        self.size = 0
+        self.output = set()
+        self.written = []
+        self.removed = []
+
+    def object_path(self, schemadir, filename):
+        """Return the path to the file of a schema object
+
+        :param schemadir: schema directory, relative to the metadata
+            directory
+        :param filename: object file name
+        :return: file path, relative to the metadata directory
+        """
+        if self.layout == 'sharded':
+            return os.path.join(schemadir, shard_name(filename), filename)
+        return os.path.join(schemadir, filename)
+
+    def add(self, relpath, objmap):
+        """Add a map to be output to a file
+
+        :param relpath: file path, relative to the metadata directory
+        :param objmap: dictionary
+        """
+        if relpath not in self.files:
+            if relpath in self.output:
+                raise ValueError("File %s was already written" % relpath)
+            self.files[relpath] = []
+        data = self.format.dump(objmap)
+        self.files[relpath].append(data)
+        self.size += len(data)
+
+    def checkpoint(self):
+        """Write the buffered files if they exceed the memory budget
+
+        This must only be called when no more text will be added to
+        the files buffered so far, e.g., after all the objects of a
+        schema were added.
+        """
+        if self.size > self.budget:
+            with timed('write files'):
+                self._write()
+
+    def _write(self):
+        syncdirs = set()
+        for relpath in sorted(self.files.keys()):
+            data = self.format.concat(self.files[relpath])
+            self.output.add(relpath)
+            path = os.path.join(self.basedir, relpath)
+            if same_contents(path, data):
+                continue
+            dirname = os.path.dirname(path)
+            if not os.path.isdir(dirname):
+                # the parents of the new directories must also be flushed
+                newdir = dirname
+                while not os.path.isdir(os.path.dirname(newdir)):
+                    newdir = os.path.dirname(newdir)
+                syncdirs.add(os.path.dirname(newdir))
+                os.makedirs(dirname)
+            if self.durability == 'none':
+                with open(path, 'wb') as f:
+                    f.write(data)
+            else:
+                replace_file(path, data, self.durability == 'fsync')
+            syncdirs.add(dirname)
+            self.written.append(relpath)
+        if self.durability == 'fsync':
+            for dirname in sorted(syncdirs):
+                fsync_dir(dirname)
+        self.files = {}
+        self.size = 0
+
+    def _remove(self, oldfiles):
+        syncdirs = set()
+        basedir = os.path.normpath(self.basedir)
+        for relpath in oldfiles:
+            if relpath in self.output:
+                continue
+            path = os.path.join(self.basedir, relpath)
+            if not os.path.exists(path):
+                continue
+            os.remove(path)
+            self.removed.append(relpath)
+            # remove the schema and shard directories left empty
+            dirname = os.path.dirname(path)
+            while os.path.normpath(dirname) != basedir and \
+                    not os.listdir(dirname):
+                os.rmdir(dirname)
+                syncdirs.discard(dirname)
+                dirname = os.path.dirname(dirname)
+            syncdirs.add(dirname)
+        if self.durability == 'fsync':
+            for dirname in sorted(syncdirs):
+                fsync_dir(dirname)
+
+    def finish(self, oldfiles=()):
+        """Write the changed files and remove those no longer needed
+
+        :param oldfiles: paths of the files previously output, relative
+            to the metadata directory
+        """
+        manifest = manifest_name(self.format.ext)
+        if self.layout == 'sharded':
+            files = {}
+            for relpath in self.output | set(self.files.keys()):
+                parts = relpath.split(os.sep)
+                if len(parts) > 1 and parts[0].startswith('schema.'):
+                    schfile = '%s.%s' % (parts[0], self.format.ext)
+                    files.setdefault(schfile, []).append(
+                        '/'.join(parts))
+            self.add(manifest, {'layout': self.layout, 'files': dict(
+                (schfile, sorted(objfiles))
+                for (schfile, objfiles) in files.items())})
+        else:
+            # a manifest left by a previous sharded output
+            oldfiles = list(oldfiles) + [manifest]
+        with timed('write files'):
+            self._write()
+            self._remove(oldfiles)
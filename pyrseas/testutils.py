@@ -15,6 +15,7 @@ from pyrseas.config import Config
 from pyrseas.database import Database
 from pyrseas.augmentdb import AugmentDatabase
 from pyrseas.lib.dbutils import pgexecute, PostgresDb
+from pyrseas.yamlutil import yamlload
 
 
 def fix_indent(stmt):
@@ -182,7 +183,8 @@ class DatabaseToMapTestCase(PyrseasTestCase):
     superuser = False
 
     def to_map(self, stmts, config={}, schemas=[], tables=[], no_owner=True,
-               no_privs=True, superuser=False, multiple_files=False):
+               no_privs=True, superuser=False, multiple_files=False, jobs=1,
+               compress=None):
         """Execute statements and return a database map.
 
         :param stmts: list of SQL statements to execute
@@ -193,6 +195,8 @@ class DatabaseToMapTestCase(PyrseasTestCase):
         :param no_privs: exclude privilege information
         :param superuser: must be superuser to run
         :param multiple_files: emulate --multiple_files option
+        :param jobs: emulate --jobs option
+        :param compress: emulate --compress option
         :return: possibly trimmed map of database
         """
         if (self.superuser or superuser) and not self.db.is_superuser():
@@ -207,7 +211,8 @@ class DatabaseToMapTestCase(PyrseasTestCase):
             self.cfg.merge({'files': {'data_path': os.path.join(
                             TEST_DIR, self.cfg['repository']['data'])}})
         self.config_options(schemas=schemas, tables=tables, no_owner=no_owner,
-                            no_privs=no_privs, multiple_files=multiple_files)
+                            no_privs=no_privs, multiple_files=multiple_files,
+                            jobs=jobs, compress=compress)
         self.cfg.merge(config)
         return self.database().to_map()
 
@@ -221,7 +226,7 @@ class DatabaseToMapTestCase(PyrseasTestCase):
         with open(os.path.join(self.cfg['files']['metadata_path'],
                                subdir or '', filename), 'r') as f:
             inmap = f.read()
-        return yaml.safe_load(inmap)
+        return yamlload(inmap)
 
     def remove_tempfiles(self):
         remove_temp_files(TEST_DIR)
@@ -246,7 +251,8 @@ class InputMapToSqlTestCase(PyrseasTestCase):
     superuser = False
 
     def to_sql(self, inmap, stmts=None, config={}, superuser=False, schemas=[],
-               revert=False, quote_reserved=False):
+               revert=False, quote_reserved=False, online=False,
+               consolidate_grants=False, deparse_views=False):
         """Execute statements and compare database to input map.
 
         :param inmap: dictionary defining target database
@@ -256,6 +262,9 @@ class InputMapToSqlTestCase(PyrseasTestCase):
         :param schemas: list of schemas to diff
         :param revert: generate statements to back out changes
         :param quote_reserved: fetch reserved words
+        :param online: emulate --online option
+        :param consolidate_grants: emulate --consolidate-grants option
+        :param deparse_views: emulate --deparse-views option
         :return: list of SQL statements
         """
         if (self.superuser or superuser) and not self.db.is_superuser():
@@ -268,7 +277,9 @@ class InputMapToSqlTestCase(PyrseasTestCase):
         if 'datacopy' in config:
             self.cfg.merge({'files': {'data_path': os.path.join(
                             TEST_DIR, self.cfg['repository']['data'])}})
-        self.config_options(schemas=schemas, revert=revert),
+        self.config_options(schemas=schemas, revert=revert, online=online,
+                            consolidate_grants=consolidate_grants,
+                            deparse_views=deparse_views),
         self.cfg.merge(config)
         return self.database().diff_map(inmap, quote_reserved=quote_reserved)
 
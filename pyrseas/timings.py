@@ -0,0 +1,187 @@
+# -*- coding: utf-8 -*-
+"""
+    pyrseas.timings
+    ~~~~~~~~~~~~~~~
+
+    Instrumentation of the stages of a run: fetching each kind of
+    object from the catalogs, the phases of a `Database`, such as
+    building the dependency graph or generating the SQL statements,
+    and the reading and output of the maps.  For each stage, the wall
+    clock and CPU time, and the number of catalog queries, rows
+    fetched and bytes of their values are recorded.
+
+    Functions registered with :func:`add_hook` are called with the
+    record of each stage when it ends.  Nothing is measured when no
+    hook is registered.  The --timings and --timings-json options of
+    the utilities register a :class:`Collector`, which reports the
+    stages as a summary table and as JSON lines.
+"""
+import atexit
+import json
+import os
+import sys
+import time
+from contextlib import contextmanager
+from datetime import datetime
+
+wall_clock = getattr(time, 'perf_counter', time.time)
+cpu_clock = getattr(time, 'process_time', None) or time.clock
+
+_hooks = []
+_counts = {'queries': 0, 'rows': 0, 'bytes': 0}
+_depth = [0]
+
+
+def add_hook(hook):
+    """Register a function to be called at the end of each stage
+
+    :param hook: function taking the record of a stage, a dictionary
+        with the keys 'stage' (its name), 'depth' (the number of
+        enclosing stages), 'start' (wall clock at the start), 'wall'
+        and 'cpu' (seconds), 'queries', 'rows' and 'bytes' (including
+        those of the enclosed stages)
+    """
+    _hooks.append(hook)
+
+
+def remove_hook(hook):
+    """Unregister a function registered by :func:`add_hook`
+
+    :param hook: the function
+    """
+    if hook in _hooks:
+        _hooks.remove(hook)
+
+
+def count_query():
+    """Count a query executed on the catalog connection"""
+    if _hooks:
+        _counts['queries'] += 1
+
+
+def count_rows(rows):
+    """Count the rows fetched by a query, and the bytes of their values
+
+    :param rows: list of rows
+
+    The bytes are those of the text of the values, which approximates
+    the amount of data sent by the server.
+    """
+    if _hooks:
+        _counts['rows'] += len(rows)
+        _counts['bytes'] += sum(len(str(val)) for row in rows for val in row
+                                if val is not None)
+
+
+@contextmanager
+def timed(stage):
+    """Measure a stage of a run, as a context manager
+
+    :param stage: name of the stage, e.g., 'fetch TableDict'
+
+    Stages may be nested, e.g., the fetching of the objects within
+    the reading of the catalogs.
+    """
+    if not _hooks:
+        yield
+        return
+    counts = dict(_counts)
+    depth = _depth[0]
+    _depth[0] += 1
+    (wall, cpu) = (wall_clock(), cpu_clock())
+    try:
+        yield
+    finally:
+        _depth[0] = depth
+        record = {'stage': stage, 'depth': depth, 'start': wall,
+                  'wall': wall_clock() - wall, 'cpu': cpu_clock() - cpu}
+        for key in counts:
+            record[key] = _counts[key] - counts[key]
+        for hook in list(_hooks):
+            hook(record)
+
+
+class Collector(object):
+    """Hook collecting the records of the stages of a run
+
+    The records are reported, once the run is over, as a summary table
+    of the stages, in the order they started, with the totals of those
+    that were run more than once, and as JSON lines, one per record,
+    tagged with the program and the time the run started, from which
+    the start of each stage is counted in seconds.
+    """
+
+    def __init__(self, program, summary=True, jsonpath=None):
+        """Initialize the collector
+
+        :param program: name of the utility
+        :param summary: output the summary table
+        :param jsonpath: path of the file to append the JSON lines to
+        """
+        self.program = program
+        self.summary = summary
+        self.jsonpath = jsonpath
+        self.started = datetime.now().isoformat()
+        self.clock = wall_clock()
+        self.records = []
+
+    def __call__(self, record):
+        self.records.append(record)
+
+    def table(self):
+        """Return the summary table of the stages
+
+        :return: text
+        """
+        lines = ["%-40s %6s %9s %9s %8s %9s %11s" % (
+            'stage', 'calls', 'wall (s)', 'cpu (s)', 'queries', 'rows',
+            'bytes')]
+        stages = {}
+        for rec in self.records:
+            stages.setdefault((rec['depth'], rec['stage']), []).append(rec)
+        # a stage starts before those it encloses, which end first
+        for ((depth, stage), recs) in sorted(
+                stages.items(), key=lambda item: item[1][0]['start']):
+            lines.append("%-40s %6d %9.3f %9.3f %8d %9d %11d" % (
+                '  ' * depth + stage, len(recs),
+                sum(rec['wall'] for rec in recs),
+                sum(rec['cpu'] for rec in recs),
+                sum(rec['queries'] for rec in recs),
+                sum(rec['rows'] for rec in recs),
+                sum(rec['bytes'] for rec in recs)))
+        return '\n'.join(lines) + '\n'
+
+    def report(self, out=None):
+        """Stop collecting and output the summary and JSON lines
+
+        :param out: file for the summary table (default stderr)
+        """
+        remove_hook(self)
+        if self.summary:
+            (out or sys.stderr).write(self.table())
+        if self.jsonpath is not None:
+            with open(self.jsonpath, 'a') as f:
+                for rec in self.records:
+                    line = dict(rec, program=self.program,
+                                started=self.started,
+                                start=rec['start'] - self.clock)
+                    f.write(json.dumps(line, sort_keys=True) + '\n')
+
+
+def start_collector(options):
+    """Register a collector if requested by the command line options
+
+    :param options: parsed command line options
+    :return: Collector, or None
+
+    The collector reports when the program exits, including after an
+    error.
+    """
+    jsonpath = getattr(options, 'timings_json', None)
+    if not getattr(options, 'timings', False) and jsonpath is None:
+        return None
+    collector = Collector(os.path.basename(sys.argv[0]),
+                          getattr(options, 'timings', False), jsonpath)
+    add_hook(collector)
+    atexit.register(collector.report)
+    return collector
@@ -7,12 +7,17 @@ from __future__ import print_function
 import sys
 from argparse import FileType
 
-import yaml
+from yaml import YAMLError
 
 from pyrseas import __version__
+from pyrseas.yamlutil import yamlload_items
+from pyrseas.formats import FORMATS, map_format
 from pyrseas.database import Database
+from pyrseas.datacopy import copy_command, execute_stmt
+from pyrseas.dbobject import DeferredStmt
 from pyrseas.cmdargs import cmd_parser, parse_args
 from pyrseas.lib.pycompat import PY2
+from pyrseas.timings import start_collector, timed
 
 
 def main():
@@ -22,60 +27,123 @@ def main():
                         "YAML-formatted file(s)", __version__)
     parser.add_argument('-m', '--multiple-files', action='store_true',
                         help='input from multiple files (metadata directory)')
+    parser.add_argument('-j', '--jobs', type=int, default=1,
+                        help='number of processes to read multiple files '
+                        'with, or of connections to bulk load data with '
+                        '(default %(default)s)')
+    parser.add_argument('--cache', nargs='?', const='stat',
+                        choices=['stat', 'digest'],
+                        help='cache the parsed multiple files, validated by '
+                        'modification time and size (stat) or by contents '
+                        '(digest)')
+    parser.add_argument('--format', choices=sorted(FORMATS.keys()),
+                        default='yaml',
+                        help='input format (default %(default)s)')
     parser.add_argument('spec', nargs='?', type=FileType('r'),
-                        default=sys.stdin, help='YAML specification')
+                        default=sys.stdin,
+                        help='specification (YAML, unless --format is given)')
     parser.add_argument('-1', '--single-transaction', action='store_true',
                         dest='onetrans', help="wrap commands in BEGIN/COMMIT")
     parser.add_argument('-u', '--update', action='store_true',
                         help="apply changes to database (implies -1)")
     parser.add_argument('--revert', action='store_true',
                         help="generate SQL to revert changes (experimental)")
+    parser.add_argument('--online', action='store_true',
+                        help="add constraints as NOT VALID and validate "
+                        "them after the main transaction")
+    parser.add_argument('--bulk-load', action='store_true',
+                        help="load the datacopy tables in parallel after "
+                        "the main transaction, rebuilding their indexes "
+                        "and constraints afterwards")
+    parser.add_argument('--deparse-views', action='store_true',
+                        help="compare changed view definitions as "
+                        "deparsed by the server")
+    parser.add_argument('--consolidate-grants', action='store_true',
+                        help="use GRANT ... ON ALL ... IN SCHEMA when all "
+                        "objects of a kind in a schema get the same GRANT")
     parser.add_argument('-n', '--schema', metavar='SCHEMA', dest='schemas',
                         action='append', default=[],
                         help="process only named schema(s) (default all)")
     cfg = parse_args(parser)
     output = cfg['files']['output']
     options = cfg['options']
+    if options.update and options.replay_catalogs:
+        parser.error("Cannot specify both --update and --replay-catalogs")
+    start_collector(options)
     db = Database(cfg)
     if options.multiple_files:
-        inmap = db.map_from_dir()
+        with timed('read input files'):
+            inmap = db.map_from_dir()
+    elif options.format == 'yaml':
+        # each schema is processed as soon as it is read
+        inmap = yamlload_items(options.spec)
     else:
+        spec = getattr(options.spec, 'buffer', options.spec)
         try:
-            inmap = yaml.safe_load(options.spec)
-        except Exception as exc:
-            print("Unable to process the input YAML file")
+            with timed('read input files'):
+                inmap = map_format(options.format).load(spec.read())
+        except ValueError as exc:
+            print("Unable to process the input %s file" % options.format)
             print("Error is '%s'" % exc)
             return 1
 
-    stmts = db.diff_map(inmap)
+    try:
+        stmts = db.diff_map(inmap)
+    except YAMLError as exc:
+        print("Unable to process the input YAML file")
+        print("Error is '%s'" % exc)
+        return 1
     if stmts:
+        deferred = [s for s in stmts if isinstance(s, DeferredStmt)]
+        stmts = [s for s in stmts if not isinstance(s, DeferredStmt)]
         fd = output or sys.stdout
-        if options.onetrans or options.update:
-            print("BEGIN;", file=fd)
-        for stmt in stmts:
+
+        def print_stmt(stmt):
             if isinstance(stmt, tuple):
-                outstmt = "".join(stmt) + '\n'
+                outstmt = copy_command(stmt) + '\n'
             else:
                 outstmt = "%s;\n" % stmt
             if PY2:
                 outstmt = outstmt.encode('utf-8')
             print(outstmt, file=fd)
-        if options.onetrans or options.update:
-            print("COMMIT;", file=fd)
+
+        bulk = db.bulk_load
+        with timed('output statements'):
+            if options.onetrans or options.update:
+                print("BEGIN;", file=fd)
+            for stmt in stmts:
+                print_stmt(stmt)
+            if options.onetrans or options.update:
+                print("COMMIT;", file=fd)
+            if bulk is not None:
+                for stmt in bulk.statements():
+                    print_stmt(stmt)
+            for stmt in deferred:
+                print_stmt(stmt)
         if options.update:
-            try:
-                for stmt in stmts:
-                    if isinstance(stmt, tuple):
-                        # expected format: (\copy, table, from, path, csv)
-                        db.dbconn.copy_from(stmt[3], stmt[1])
-                    else:
-                        db.dbconn.execute(stmt)
-            except:
-                db.dbconn.rollback()
-                raise
-            else:
-                db.dbconn.commit()
-                print("Changes applied", file=sys.stderr)
+            with timed('apply statements'):
+                try:
+                    for stmt in stmts:
+                        execute_stmt(db.dbconn, stmt)
+                except:
+                    db.dbconn.rollback()
+                    raise
+                else:
+                    db.dbconn.commit()
+            if bulk is not None:
+                bulk.run(db._data_connection, options.jobs)
+            # deferred statements are run outside of a transaction block,
+            # e.g., CREATE INDEX CONCURRENTLY, so each one is committed,
+            # once the data is loaded
+            if deferred:
+                with timed('apply deferred statements'):
+                    db.dbconn.conn.autocommit = True
+                    try:
+                        for stmt in deferred:
+                            db.dbconn.execute(stmt).close()
+                    finally:
+                        db.dbconn.conn.autocommit = False
+            print("Changes applied", file=sys.stderr)
         if output:
             output.close()
 
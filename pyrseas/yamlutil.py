@@ -1,30 +1,181 @@
 # -*- coding: utf-8 -*-
-"""Pyrseas YAML utilities"""
+"""Pyrseas YAML utilities
 
-from yaml import add_representer, dump
+The YAML maps are loaded and dumped with the libyaml-based
+:class:`yaml.CSafeLoader` and :class:`yaml.CSafeDumper` if PyYAML was
+built with libyaml, falling back to the pure Python classes otherwise.
+Both produce the same output.
+"""
+
+from yaml import add_representer, dump, load
+from yaml.composer import Composer, ComposerError
+from yaml.events import MappingStartEvent, MappingEndEvent, StreamEndEvent
+from yaml import SafeLoader as PySafeLoader, SafeDumper as PySafeDumper
+try:
+    from yaml import CSafeLoader as SafeLoader, CSafeDumper as SafeDumper
+    LIBYAML = True
+except ImportError:
+    SafeLoader, SafeDumper = PySafeLoader, PySafeDumper
+    LIBYAML = False
 
 from pyrseas.lib.pycompat import PY2
 
 
 if PY2:
-    from yaml import safe_dump as dump
-
-    class MultiLineStr(unicode):
-        """ Marker for multiline strings"""
+    text_type = unicode
 else:
-    class MultiLineStr(str):
-        """ Marker for multiline strings"""
+    text_type = str
+
+
+class MultiLineStr(text_type):
+    """ Marker for multiline strings"""
 
 
 def MultiLineStr_presenter(dumper, data):
-    return dumper.represent_scalar('tag:yaml.org,2002:str', data, style='|')
+    # the libyaml emitter only accepts instances of the exact string type
+    return dumper.represent_scalar('tag:yaml.org,2002:str', text_type(data),
+                                   style='|')
+
+
+def str_subclass_presenter(dumper, data):
+    # e.g., a DeferredStmt, dumped as a plain string
+    return dumper.represent_scalar('tag:yaml.org,2002:str', text_type(data))
+
+
+def tuple_presenter(dumper, data):
+    return dumper.represent_list(list(data))
+
+
 add_representer(MultiLineStr, MultiLineStr_presenter)
 
 
-def yamldump(objmap):
+class Dumper(SafeDumper):
+    """Dumper for Pyrseas maps, with block style for multiline strings
+
+    Being based on a safe dumper, it only accepts standard YAML types.
+    Subclasses of the string type and tuples, which may be put in the
+    maps, are dumped as plain strings and lists, respectively.
+    """
+
+
+class PyDumper(PySafeDumper):
+    """Pure Python equivalent of :class:`Dumper`"""
+
+
+for dumper in (Dumper, PyDumper):
+    dumper.add_representer(MultiLineStr, MultiLineStr_presenter)
+    dumper.add_multi_representer(text_type, str_subclass_presenter)
+    dumper.add_representer(tuple, tuple_presenter)
+del dumper
+
+
+def yamldump(objmap, dumper=Dumper):
     """Dump an object map using yaml.dump with certain defaults
 
     :param objmap: dictionary
+    :param dumper: YAML dumper class
     :return: dumped object map
     """
-    return dump(objmap, default_flow_style=False, allow_unicode=True)
+    return dump(objmap, Dumper=dumper, default_flow_style=False,
+                allow_unicode=True)
+
+
+def yamldump_items(items, stream, dumper=Dumper):
+    """Dump the items of an object map to a stream, one at a time
+
+    :param items: iterable of (key, value) pairs, in sorted key order
+    :param stream: open file
+    :param dumper: YAML dumper class
+
+    The output is the same as that of :func:`yamldump` for the
+    complete map, but only one value needs to be held in memory.
+    """
+    empty = True
+    for (key, val) in items:
+        stream.write(yamldump({key: val}, dumper))
+        empty = False
+    if empty:
+        stream.write(yamldump({}, dumper))
+
+
+def yamlload(stream, loader=SafeLoader):
+    """Load a YAML document, e.g., a Pyrseas map, safely
+
+    :param stream: string or open file
+    :param loader: YAML loader class
+    :return: loaded object, usually a dictionary
+    """
+    return load(stream, Loader=loader)
+
+
+class _Composer(Composer):
+    """Composer of nodes from the events of a loader
+
+    The libyaml-based loaders compose whole documents in C, so the
+    nodes for parts of a document are composed here from the events,
+    which are still parsed in C.  Loading a large map this way is not
+    slower than loading it whole (see ``tests/yamlbench.py``).
+    """
+
+    def __init__(self, loader):
+        self.loader = loader
+        self.anchors = {}
+
+    def check_event(self, *choices):
+        return self.loader.check_event(*choices)
+
+    def peek_event(self):
+        return self.loader.peek_event()
+
+    def get_event(self):
+        return self.loader.get_event()
+
+    def descend_resolver(self, current_node, current_index):
+        return self.loader.descend_resolver(current_node, current_index)
+
+    def ascend_resolver(self):
+        return self.loader.ascend_resolver()
+
+    def resolve(self, kind, value, implicit):
+        return self.loader.resolve(kind, value, implicit)
+
+
+def yamlload_items(stream, loader=SafeLoader):
+    """Load the items of a YAML map, e.g., a Pyrseas map, one at a time
+
+    :param stream: string or open file
+    :param loader: YAML loader class
+    :return: generator of (key, value) pairs
+
+    Each value of the top-level map is composed and constructed only
+    when the previous one was consumed, so that its YAML node can be
+    released before the next one is read.
+    """
+    ldr = loader(stream)
+    composer = _Composer(ldr)
+    try:
+        ldr.get_event()
+        if ldr.check_event(StreamEndEvent):
+            return
+        ldr.get_event()
+        if not ldr.check_event(MappingStartEvent):
+            raise ComposerError(None, None, "expected a map",
+                                ldr.peek_event().start_mark)
+        start = ldr.get_event()
+        while not ldr.check_event(MappingEndEvent):
+            keynode = composer.compose_node(None, None)
+            valnode = composer.compose_node(None, keynode)
+            key = ldr.construct_object(keynode, True)
+            value = ldr.construct_object(valnode, True)
+            ldr.constructed_objects = {}
+            ldr.recursive_objects = {}
+            del keynode, valnode
+            yield (key, value)
+        ldr.get_event()
+        ldr.get_event()
+        if not ldr.check_event(StreamEndEvent):
+            raise ComposerError("expected a single document in the stream",
+                                start.start_mark, "but found another "
+                                "document", ldr.peek_event().start_mark)
+    finally:
+        ldr.dispose()
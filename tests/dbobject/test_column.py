@@ -173,6 +173,19 @@ class ColumnToMapTestCase(DatabaseToMapTestCase):
                   'owner_table': 't1', 'owner_column': 'c1'}
         assert dbmap['schema sd']['sequence t1_c1_seq'] == expmap
 
+    def test_map_generated(self):
+        "Map a table with a stored generated column"
+        if self.db.version < 120000:
+            self.skipTest('Only available on PG 12 and later')
+        stmts = ["CREATE TABLE t1 (c1 integer, c2 integer GENERATED ALWAYS "
+                 "AS (c1 * 2) STORED)"]
+        dbmap = self.to_map(stmts)
+        expmap = {'columns': [{'c1': {'type': 'integer'}},
+                              {'c2': {'type': 'integer',
+                                      'default': '(c1 * 2)',
+                                      'generated': 'stored'}}]}
+        assert dbmap['schema sd']['table t1'] == expmap
+
 
 class ColumnToSqlTestCase(InputMapToSqlTestCase):
     """Test SQL generation of column-related statements from input schemas"""
@@ -221,6 +234,20 @@ class ColumnToSqlTestCase(InputMapToSqlTestCase):
             "IDENTITY (SEQUENCE NAME sd.t1_c1_seq START WITH 1 INCREMENT BY 1 "
             "NO MINVALUE NO MAXVALUE CACHE 1), c2 text)")
 
+    def test_create_column_generated(self):
+        "Create a table with a stored generated column"
+        if self.db.version < 120000:
+            self.skipTest('Only available on PG 12 and later')
+        inmap = self.std_map()
+        inmap['schema sd'].update({'table t1': {
+            'columns': [{'c1': {'type': 'integer'}},
+                        {'c2': {'type': 'integer', 'default': '(c1 * 2)',
+                                'generated': 'stored'}}]}})
+        sql = self.to_sql(inmap)
+        assert fix_indent(sql[0]) == (
+            "CREATE TABLE sd.t1 (c1 integer, c2 integer GENERATED ALWAYS AS "
+            "((c1 * 2)) STORED)")
+
     def test_change_column_default(self):
         "Change the default value for an existing column"
         stmt = "CREATE TABLE t1 (c1 integer, c2 boolean default true)"
@@ -242,6 +269,39 @@ class ColumnToSqlTestCase(InputMapToSqlTestCase):
         assert fix_indent(sql[0]) == \
             "ALTER TABLE sd.t1 ALTER COLUMN c1 SET NOT NULL"
 
+    def test_set_column_not_null_online(self):
+        "Change a nullable column to NOT NULL using a validated CHECK"
+        if self.db.version < 120000:
+            self.skipTest('Only available on PG 12 and later')
+        inmap = self.std_map()
+        inmap['schema sd'].update({'table t1': {
+            'columns': [{'c1': {'type': 'integer', 'not_null': True}},
+                        {'c2': {'type': 'text'}}]}})
+        sql = self.to_sql(inmap, [CREATE_STMT1], online=True)
+        assert len(sql) == 4
+        assert fix_indent(sql[0]) == "ALTER TABLE sd.t1 ADD CONSTRAINT " \
+            "t1_c1_not_null CHECK (c1 IS NOT NULL) NOT VALID"
+        assert sql[1] == "ALTER TABLE sd.t1 VALIDATE CONSTRAINT t1_c1_not_null"
+        assert sql[2] == "ALTER TABLE sd.t1 ALTER COLUMN c1 SET NOT NULL"
+        assert sql[3] == "ALTER TABLE sd.t1 DROP CONSTRAINT t1_c1_not_null"
+
+    def test_set_column_not_null_online_name_taken(self):
+        "Name the CHECK for NOT NULL differently from existing constraints"
+        if self.db.version < 120000:
+            self.skipTest('Only available on PG 12 and later')
+        stmts = [CREATE_STMT1, "ALTER TABLE t1 ADD CONSTRAINT "
+                 "t1_c1_not_null CHECK (c1 > 0)"]
+        inmap = self.std_map()
+        inmap['schema sd'].update({'table t1': {
+            'columns': [{'c1': {'type': 'integer', 'not_null': True}},
+                        {'c2': {'type': 'text'}}],
+            'check_constraints': {'t1_c1_not_null': {
+                'columns': ['c1'], 'expression': '(c1 > 0)'}}}})
+        sql = self.to_sql(inmap, stmts, online=True)
+        assert fix_indent(sql[0]) == "ALTER TABLE sd.t1 ADD CONSTRAINT " \
+            "t1_c1_not_null1 CHECK (c1 IS NOT NULL) NOT VALID"
+        assert sql[3] == "ALTER TABLE sd.t1 DROP CONSTRAINT t1_c1_not_null1"
+
     def test_change_column_types(self):
         "Change the datatypes of two columns"
         inmap = self.std_map()
@@ -89,6 +89,35 @@ class CheckConstraintToSqlTestCase(InputMapToSqlTestCase):
         assert fix_indent(sql[0]) == "ALTER TABLE sd.t1 ADD CONSTRAINT " \
             "t1_check_2_1 CHECK (c2 != c1)"
 
+    def test_add_check_constraint_online(self):
+        "Add a CHECK constraint as NOT VALID and validate it afterwards"
+        stmts = ["CREATE TABLE t1 (c1 INTEGER, c2 TEXT)"]
+        inmap = self.std_map()
+        inmap['schema sd'].update({'table t1': {
+            'columns': [{'c1': {'type': 'integer'}},
+                        {'c2': {'type': 'text'}}],
+            'check_constraints': {
+                't1_c1_check': {'columns': ['c1'],
+                                'expression': '(c1 > 0)'}}}})
+        sql = self.to_sql(inmap, stmts, online=True)
+        assert len(sql) == 2
+        assert fix_indent(sql[0]) == "ALTER TABLE sd.t1 ADD CONSTRAINT " \
+            "t1_c1_check CHECK (c1 > 0) NOT VALID"
+        assert sql[1] == "ALTER TABLE sd.t1 VALIDATE CONSTRAINT t1_c1_check"
+
+    def test_create_w_check_constraint_online(self):
+        "Create new table with a CHECK constraint, ignoring online option"
+        inmap = self.std_map()
+        inmap['schema sd'].update({'table t1': {
+            'columns': [{'c1': {'type': 'integer'}}],
+            'check_constraints': {
+                't1_c1_check': {'columns': ['c1'],
+                                'expression': '(c1 > 0)'}}}})
+        sql = self.to_sql(inmap, online=True)
+        assert len(sql) == 2
+        assert fix_indent(sql[1]) == "ALTER TABLE sd.t1 ADD CONSTRAINT " \
+            "t1_c1_check CHECK (c1 > 0)"
+
     def test_add_check_constraint_no_columns(self):
         "Add a CHECK constraint with no column"
         stmts = ["CREATE TABLE t1 (c1 INTEGER)"]
@@ -697,6 +726,29 @@ class ForeignKeyToSqlTestCase(InputMapToSqlTestCase):
         assert fix_indent(sql[0]) == "ALTER TABLE sd.t2 ADD CONSTRAINT " \
             "t2_c23_fkey FOREIGN KEY (c23, c24) REFERENCES sd.t1 (c11, c12)"
 
+    def test_add_foreign_key_online(self):
+        "Add a foreign key as NOT VALID and validate it afterwards"
+        stmts = ["CREATE TABLE t1 (c11 INTEGER PRIMARY KEY, c12 TEXT)",
+                 "CREATE TABLE t2 (c21 INTEGER PRIMARY KEY, c22 INTEGER)"]
+        inmap = self.std_map()
+        inmap['schema sd'].update({
+            'table t1': {'columns': [
+                        {'c11': {'type': 'integer', 'not_null': True}},
+                        {'c12': {'type': 'text'}}],
+                'primary_key': {'t1_pkey': {'columns': ['c11']}}},
+            'table t2': {'columns': [
+                        {'c21': {'type': 'integer', 'not_null': True}},
+                        {'c22': {'type': 'integer'}}],
+                'primary_key': {'t2_pkey': {'columns': ['c21']}},
+                'foreign_keys': {'t2_c22_fkey': {
+                    'columns': ['c22'],
+                    'references': {'columns': ['c11'], 'table': 't1'}}}}})
+        sql = self.to_sql(inmap, stmts, online=True)
+        assert len(sql) == 2
+        assert fix_indent(sql[0]) == "ALTER TABLE sd.t2 ADD CONSTRAINT " \
+            "t2_c22_fkey FOREIGN KEY (c22) REFERENCES sd.t1 (c11) NOT VALID"
+        assert sql[1] == "ALTER TABLE sd.t2 VALIDATE CONSTRAINT t2_c22_fkey"
+
     def test_alter_foreign_key1(self):
         "Change foreign key: referencing column"
         stmts = ["CREATE TABLE t1 (c11 INTEGER PRIMARY KEY NOT NULL, "
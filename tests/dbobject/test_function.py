@@ -250,6 +250,16 @@ class FunctionToSqlTestCase(InputMapToSqlTestCase):
             "RETURNS text LANGUAGE sql IMMUTABLE AS " \
             "$_$SELECT 'example'::text$_$"
 
+    def test_function_source_formatting(self):
+        "Ignore differences only in formatting of a function source"
+        inmap = self.std_map()
+        inmap['schema sd'].update({'function f1()': {
+            'language': 'sql', 'returns': 'text',
+            'source': "select 'dummy' :: text;  -- constant\n",
+            'volatility': 'immutable'}})
+        sql = self.to_sql(inmap, [CREATE_STMT1])
+        assert sql == []
+
     def test_function_with_comment(self):
         "Create a function with a comment"
         inmap = self.std_map()
@@ -138,6 +138,14 @@ class IndexToMapTestCase(DatabaseToMapTestCase):
                   'indexes': {'t1_idx': {'keys': ['c1'], 'cluster': True}}}
         assert dbmap['schema sd']['table t1'] == expmap
 
+    def test_map_index_options(self):
+        "Map an index with storage parameters"
+        stmts = [CREATE_TABLE_STMT,
+                 "CREATE INDEX t1_idx ON t1 (c1) WITH (fillfactor=70)"]
+        dbmap = self.to_map(stmts)
+        assert dbmap['schema sd']['table t1']['indexes'] == {
+            't1_idx': {'keys': ['c1'], 'options': ['fillfactor=70']}}
+
     def test_map_index_comment(self):
         "Map an index comment"
         dbmap = self.to_map([CREATE_TABLE_STMT, CREATE_STMT, COMMENT_STMT])
@@ -368,3 +376,92 @@ class IndexToSqlTestCase(InputMapToSqlTestCase):
         sql = self.to_sql(inmap, stmts)
         assert sql == ["DROP INDEX sd.t1_idx",
                        "CREATE INDEX t1_idx ON sd.t1 (c2, c1)"]
+
+    def test_change_index_options(self):
+        "Change storage parameters of an index without rebuilding it"
+        stmts = [CREATE_TABLE_STMT,
+                 "CREATE INDEX t1_idx ON t1 (c1) WITH (fillfactor=70)"]
+        inmap = self.std_map()
+        inmap['schema sd'].update({'table t1': {
+            'columns': [{'c1': {'type': 'integer'}}, {'c2': {'type': 'text'}}],
+            'indexes': {'t1_idx': {'keys': ['c1'],
+                                   'options': ['fillfactor=90']}}}})
+        sql = self.to_sql(inmap, stmts)
+        assert fix_indent(sql[0]) == \
+            "ALTER INDEX sd.t1_idx SET (fillfactor=90)"
+        assert len(sql) == 1
+
+    def test_rename_index(self):
+        "Rename an existing index"
+        stmts = [CREATE_TABLE_STMT, CREATE_STMT]
+        inmap = self.std_map()
+        inmap['schema sd'].update({'table t1': {
+            'columns': [{'c1': {'type': 'integer'}}, {'c2': {'type': 'text'}}],
+            'indexes': {'t1_c1_idx': {'keys': ['c1'], 'oldname': 't1_idx'}}}})
+        sql = self.to_sql(inmap, stmts)
+        assert sql == ["ALTER INDEX sd.t1_idx RENAME TO t1_c1_idx"]
+
+    def test_rename_index_detected(self):
+        "Rename an index whose only change is its name"
+        stmts = [CREATE_TABLE_STMT, CREATE_STMT]
+        inmap = self.std_map()
+        inmap['schema sd'].update({'table t1': {
+            'columns': [{'c1': {'type': 'integer'}}, {'c2': {'type': 'text'}}],
+            'indexes': {'t1_c1_idx': {'keys': ['c1']}}}})
+        sql = self.to_sql(inmap, stmts)
+        assert sql == ["ALTER INDEX sd.t1_idx RENAME TO t1_c1_idx"]
+
+    def test_rename_index_ambiguous(self):
+        "Do not rename one of several indexes with the same definition"
+        stmts = [CREATE_TABLE_STMT, CREATE_STMT,
+                 "CREATE INDEX t1_idx2 ON t1 (c1)"]
+        inmap = self.std_map()
+        inmap['schema sd'].update({'table t1': {
+            'columns': [{'c1': {'type': 'integer'}}, {'c2': {'type': 'text'}}],
+            'indexes': {'t1_c1_idx': {'keys': ['c1']}}}})
+        sql = self.to_sql(inmap, stmts)
+        assert not [stmt for stmt in sql if 'RENAME' in stmt]
+        assert "CREATE INDEX t1_c1_idx ON sd.t1 (c1)" in [
+            fix_indent(stmt) for stmt in sql]
+        assert "DROP INDEX sd.t1_idx" in sql
+        assert "DROP INDEX sd.t1_idx2" in sql
+
+    def test_change_index_keys_online(self):
+        "Change keys of an existing index by building a replacement"
+        stmts = [CREATE_TABLE_STMT, CREATE_STMT]
+        inmap = self.std_map()
+        inmap['schema sd'].update({'table t1': {
+            'columns': [{'c1': {'type': 'integer'}}, {'c2': {'type': 'text'}}],
+            'indexes': {'t1_idx': {'keys': ['c1', 'c2']}}}})
+        sql = self.to_sql(inmap, stmts, online=True)
+        assert sql == [
+            "CREATE INDEX CONCURRENTLY t1_idx_ccnew ON sd.t1 (c1, c2)",
+            "DROP INDEX CONCURRENTLY sd.t1_idx",
+            "ALTER INDEX sd.t1_idx_ccnew RENAME TO t1_idx"]
+
+    def test_change_index_keys_description_online(self):
+        "Change keys and description of an index built as a replacement"
+        stmts = [CREATE_TABLE_STMT, CREATE_STMT,
+                 "COMMENT ON INDEX t1_idx IS 'Old description'"]
+        inmap = self.std_map()
+        inmap['schema sd'].update({'table t1': {
+            'columns': [{'c1': {'type': 'integer'}}, {'c2': {'type': 'text'}}],
+            'indexes': {'t1_idx': {'keys': ['c1', 'c2'],
+                                   'description': 'New description'}}}})
+        sql = self.to_sql(inmap, stmts, online=True)
+        assert sql == [
+            "CREATE INDEX CONCURRENTLY t1_idx_ccnew ON sd.t1 (c1, c2)",
+            "DROP INDEX CONCURRENTLY sd.t1_idx",
+            "ALTER INDEX sd.t1_idx_ccnew RENAME TO t1_idx",
+            "COMMENT ON INDEX sd.t1_idx IS 'New description'"]
+
+    def test_create_index_cluster_online(self):
+        "Create an index concurrently and cluster the table on it"
+        inmap = self.std_map()
+        inmap['schema sd'].update({'table t1': {
+            'columns': [{'c1': {'type': 'integer'}}, {'c2': {'type': 'text'}}],
+            'indexes': {'t1_idx': {'keys': ['c1'], 'cluster': True}}}})
+        sql = self.to_sql(inmap, [CREATE_TABLE_STMT], online=True)
+        assert sql == [
+            "CREATE INDEX CONCURRENTLY t1_idx ON sd.t1 (c1)",
+            "ALTER TABLE sd.t1 CLUSTER ON t1_idx"]
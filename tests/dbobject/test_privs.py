@@ -257,6 +257,21 @@ class PrivilegeToSqlTestCase(InputMapToSqlTestCase):
         assert sorted(sql) == [GRANT_INSUPD % 'user1', GRANT_SELECT % 'PUBLIC',
                                "REVOKE SELECT ON TABLE sd.t1 FROM user1"]
 
+    def test_table_unchanged_grants(self):
+        "Compare unchanged privileges on an existing table"
+        inmap = self.std_map()
+        inmap['schema sd'].update({'table t1': {
+            'columns': [{'c1': {'type': 'integer'}}, {'c2': {'type': 'text'}}],
+            'owner': self.db.user,
+            'privileges': [{'user1': ['insert', 'update']},
+                           {self.db.user: ['all']}, {'PUBLIC': ['select']},
+                           {'user2': [{'trigger': {'grantable': True}},
+                                      {'references': {'grantable': True}}]}]}})
+        sql = self.to_sql(inmap, [
+            CREATE_TABLE, GRANT_SELECT % 'PUBLIC', GRANT_INSUPD % 'user1',
+            "GRANT REFERENCES, TRIGGER ON t1 TO user2 WITH GRANT OPTION"])
+        assert sql == []
+
     def test_column_change_grants(self):
         "Change existing colum-level privileges"
         inmap = self.std_map()
@@ -462,3 +477,37 @@ class PrivilegeToSqlTestCase(InputMapToSqlTestCase):
         assert sql[0] == "GRANT ALL ON TABLE sd.ft1 TO %s" % self.db.user
         assert sql[1] == "GRANT INSERT, UPDATE ON TABLE sd.ft1 TO user1"
         assert sql[2] == "GRANT SELECT ON TABLE sd.ft1 TO PUBLIC"
+
+    def test_consolidate_table_grants(self):
+        "Grant the same privileges on all tables in a schema"
+        inmap = self.std_map()
+        for tbl in ['t0', 't1', 't2']:
+            inmap['schema sd'].update({'table %s' % tbl: {
+                'columns': [{'c1': {'type': 'integer'}}],
+                'owner': self.db.user,
+                'privileges': [{self.db.user: ['all']},
+                               {'user1': ['select']}]}})
+        sql = self.to_sql(inmap, ["CREATE TABLE t0 (c1 integer)",
+                                  "GRANT SELECT ON t0 TO user1"],
+                          consolidate_grants=True)
+        assert sql[-2] == "GRANT ALL ON ALL TABLES IN SCHEMA sd TO %s" % (
+            self.db.user)
+        assert sql[-1] == "GRANT SELECT ON ALL TABLES IN SCHEMA sd TO user1"
+        assert not [stmt for stmt in sql if " ON TABLE " in stmt]
+
+    def test_consolidate_grants_exception(self):
+        "Do not consolidate grants if a table lacks the privileges"
+        inmap = self.std_map()
+        for tbl in ['t0', 't1', 't2']:
+            inmap['schema sd'].update({'table %s' % tbl: {
+                'columns': [{'c1': {'type': 'integer'}}],
+                'owner': self.db.user,
+                'privileges': [{self.db.user: ['all']},
+                               {'user1': ['select']}]}})
+        inmap['schema sd']['table t0']['privileges'] = [
+            {self.db.user: ['all']}]
+        sql = self.to_sql(inmap, consolidate_grants=True)
+        assert "GRANT SELECT ON TABLE sd.t1 TO user1" in sql
+        assert "GRANT SELECT ON TABLE sd.t2 TO user1" in sql
+        assert "GRANT ALL ON ALL TABLES IN SCHEMA sd TO %s" % (
+            self.db.user) in sql
@@ -1,7 +1,9 @@
 # -*- coding: utf-8 -*-
 """Test loading of data from and into static tables"""
+import gzip
 import os
 
+from pyrseas.datacopy import read_binary_header, read_chunks
 from pyrseas.testutils import DatabaseToMapTestCase
 from pyrseas.testutils import InputMapToSqlTestCase
 
@@ -56,6 +58,80 @@ class StaticTableToMapTestCase(DatabaseToMapTestCase):
                 recs.append((int(c1), c2, c3.rstrip()))
         assert recs == sorted(TABLE_DATA2)
 
+    def test_copy_static_tables_parallel(self):
+        "Copy several tables using more than one connection"
+        self.db.execute(CREATE_STMT)
+        self.db.execute("CREATE TABLE t2 (c1 integer, c2 text)")
+        for row in TABLE_DATA:
+            self.db.execute("INSERT INTO t1 VALUES (%s, %s)", row)
+            self.db.execute("INSERT INTO t2 VALUES (%s, %s)", row)
+        cfg = {'datacopy': {'schema sd': ['t1', 't2']}}
+        self.to_map([], config=cfg, jobs=2)
+        for filename in (FILE_PATH, 'table.t2.data'):
+            recs = []
+            with open(os.path.join(self.cfg['files']['data_path'],
+                                   "schema.sd", filename)) as f:
+                for line in f:
+                    (c1, c2) = line.split(',')
+                    recs.append((int(c1), c2.rstrip()))
+            assert recs == TABLE_DATA
+
+    def test_copy_static_tables_no_open_transaction(self):
+        "Leave no transaction open once the tables are copied"
+        self.db.execute(CREATE_STMT)
+        self.db.execute("CREATE TABLE t2 (c1 integer, c2 text)")
+        cfg = {'datacopy': {'schema sd': ['t1', 't2']}}
+        for jobs in (1, 2):
+            self.to_map([], config=cfg, jobs=jobs)
+            row = self.db.fetchone(
+                "SELECT count(*) FROM pg_stat_activity "
+                "WHERE datname = current_database() "
+                "AND state = 'idle in transaction' "
+                "AND pid <> pg_backend_pid()")
+            self.db.conn.rollback()
+            assert row[0] == 0
+
+    def test_copy_static_table_compressed(self):
+        "Copy a table to a compressed file"
+        self.db.execute(CREATE_STMT)
+        for row in TABLE_DATA:
+            self.db.execute("INSERT INTO t1 VALUES (%s, %s)", row)
+        cfg = {'datacopy': {'schema sd': ['t1']}}
+        self.to_map([], config=cfg, compress='gzip')
+        dirpath = os.path.join(self.cfg['files']['data_path'], "schema.sd")
+        assert not os.path.exists(os.path.join(dirpath, FILE_PATH))
+        with gzip.open(os.path.join(dirpath, FILE_PATH + '.gz'), 'rt') as f:
+            assert f.read() == "1,abc\n2,def\n3,ghi\n"
+
+    def test_copy_static_table_binary(self):
+        "Copy a table to a file in binary format"
+        self.db.execute(CREATE_STMT)
+        for row in TABLE_DATA:
+            self.db.execute("INSERT INTO t1 VALUES (%s, %s)", row)
+        cfg = {'datacopy': {'schema sd': [{'t1': {'format': 'binary'}}]}}
+        self.to_map([], config=cfg)
+        path = os.path.join(self.cfg['files']['data_path'], "schema.sd",
+                            'table.t1.bin')
+        header = read_binary_header(path)
+        assert header['columns'] == [('c1', 'integer'), ('c2', 'text')]
+        assert header['version'] == self.db.version
+
+    def test_copy_static_table_chunks(self):
+        "Copy a table in chunks of primary key ranges"
+        self.db.execute("CREATE TABLE t1 (c1 integer PRIMARY KEY, c2 text)")
+        self.db.execute("INSERT INTO t1 SELECT i, 'row ' || i "
+                        "FROM generate_series(1, 1000) i")
+        cfg = {'datacopy': {'schema sd': [{'t1': {'chunks': 4}}]}}
+        self.to_map([], config=cfg, jobs=2)
+        dirpath = os.path.join(self.cfg['files']['data_path'], "schema.sd")
+        manifest = read_chunks(os.path.join(dirpath, 'table.t1.chunks'))
+        assert manifest['complete']
+        recs = []
+        for chunk in manifest['chunks']:
+            with open(os.path.join(dirpath, chunk['file'])) as f:
+                recs.extend(int(line.split(',')[0]) for line in f)
+        assert recs == list(range(1, 1001))
+
 
 class StaticTableToSqlTestCase(InputMapToSqlTestCase):
     """Test SQL generation of table load statements"""
@@ -101,3 +177,18 @@ class StaticTableToSqlTestCase(InputMapToSqlTestCase):
         assert sql[2] == copy_stmt
         assert sql[3] == "ALTER TABLE sd.t2 ADD CONSTRAINT t2_c2_fkey " \
             "FOREIGN KEY (c2) REFERENCES sd.t1 (pc1)"
+
+    def test_load_static_table_binary(self):
+        "Truncate and load a table in binary format"
+        inmap = self.std_map()
+        inmap['schema sd'].update({'table t1': {
+            'columns': [{'c1': {'type': 'integer'}},
+                        {'c2': {'type': 'text'}}]}})
+        cfg = {'datacopy': {'format': 'binary', 'schema sd': ['t1']}}
+        sql = self.to_sql(inmap, [CREATE_STMT], config=cfg)
+        copy_stmt = ("\\copy ", 'sd.t1', " from '",
+                     os.path.join(self.cfg['files']['data_path'],
+                                  "schema.sd", 'table.t1.bin'),
+                     "' with (format binary)")
+        assert sql[0] == "TRUNCATE ONLY sd.t1"
+        assert sql[1] == copy_stmt
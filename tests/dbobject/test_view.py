@@ -141,6 +141,29 @@ class ViewToSqlTestCase(InputMapToSqlTestCase):
         assert fix_indent(sql[0]) == "CREATE OR REPLACE VIEW sd.v1 AS " \
             "SELECT 'now'::text::date AS today"
 
+    def test_view_defn_formatting(self):
+        "Ignore differences only in formatting of a view definition"
+        inmap = self.std_map()
+        inmap['schema sd'].update({'view v1': {
+            'columns': [{'today': {'type': 'date'}}],
+            'definition': "select now() :: date as today -- current date\n"}})
+        sql = self.to_sql(inmap, [CREATE_STMT])
+        assert sql == []
+
+    def test_view_defn_deparsed(self):
+        "Compare a view definition as deparsed by the server"
+        inmap = self.std_map()
+        inmap['schema sd'].update({'table t1': {
+            'columns': [{'c1': {'type': 'integer'}}, {'c2': {'type': 'text'}},
+                        {'c3': {'type': 'integer'}}]},
+            'view v1': {
+                'columns': [{'c1': {'type': 'integer'}},
+                            {'c2': {'type': 'integer'}}],
+                'definition': "SELECT c1, c3 * 2 AS c2 FROM t1"}})
+        sql = self.to_sql(inmap, [CREATE_TBL, CREATE_STMT2],
+                          deparse_views=True)
+        assert sql == []
+
     def test_change_column_name(self):
         "Attempt rename view column name (disallowed)"
         inmap = self.std_map()
@@ -0,0 +1,184 @@
+# -*- coding: utf-8 -*-
+"""Test recording and replaying the catalog queries"""
+from argparse import Namespace
+
+import pytest
+from psycopg2 import DatabaseError
+
+from pyrseas.capture import CapturedRow, RecordingDbConnection
+from pyrseas.capture import ReplayDbConnection, query_key
+from pyrseas.capture import read_capture, write_capture
+from pyrseas.database import Database
+from pyrseas.dbobject.language import Language, LanguageDict
+from pyrseas.dbobject.view import View
+
+DB_CFG = {'dbname': 'pyrseas_testdb', 'username': None, 'password': None,
+          'host': None, 'port': None}
+DEPARSE_QUERY = ("SELECT pg_get_viewdef('pg_temp.pyrseas_deparse'::regclass, "
+                 "true)")
+LANG_ROW = {'name': 'plperl', 'trusted': True, 'owner': 'postgres',
+            'privileges': None, 'description': 'Perl', 'oid': 16384}
+
+
+def capture_file(tmpdir, version=120000):
+    "Write a capture of the query of the languages"
+    path = str(tmpdir.join('catalogs.json.gz'))
+    cols = sorted(LANG_ROW.keys())
+    write_capture(path, {version: {
+        query_key(Language.query(version)): {
+            'columns': cols, 'rows': [[LANG_ROW[col] for col in cols]]},
+        query_key("SELECT 1 WHERE false"): {'columns': [], 'rows': []}}})
+    return path
+
+
+def test_query_key():
+    "Normalize the whitespace of the queries"
+    assert query_key("SELECT a,\n       b\n  FROM t ") == "SELECT a, b FROM t"
+    assert query_key("SELECT %s", (1,)) == "SELECT %s\x00[1]"
+    assert query_key("SELECT 1", None, ["SET a = 1", "SET b = 2"]) == \
+        "SET a = 1; SET b = 2; SELECT 1"
+
+
+def test_write_read_capture(tmpdir):
+    "Read the queries of a capture, identically rewritten"
+    path = capture_file(tmpdir)
+    servers = read_capture(path)
+    assert list(servers.keys()) == [120000]
+    data = tmpdir.join('catalogs.json.gz').read_binary()
+    write_capture(path, servers)
+    assert tmpdir.join('catalogs.json.gz').read_binary() == data
+
+
+def test_replay_fetch(tmpdir):
+    "Replay the rows of a query, by position and by column name"
+    dbconn = ReplayDbConnection('db', capture_file(tmpdir))
+    assert dbconn.version == 120000
+    rows = dbconn.fetchall(Language.query(120000))
+    assert len(rows) == 1
+    assert dict(rows[0]) == LANG_ROW
+    assert rows[0]['name'] == 'plperl'
+    assert rows[0][list(rows[0].keys()).index('oid')] == 16384
+    assert dbconn.fetchone("SELECT 1\n WHERE false") is None
+    dbconn.execute("SET search_path TO pg_catalog").close()
+    dbconn.rollback()
+
+
+def test_replay_not_captured(tmpdir):
+    "Fail to fetch the rows of a query that was not recorded"
+    dbconn = ReplayDbConnection('db', capture_file(tmpdir))
+    with pytest.raises(KeyError):
+        dbconn.fetchall("SELECT nspname FROM pg_namespace")
+
+
+def test_replay_version(tmpdir):
+    "Replay the queries of the highest or a given server version"
+    path = capture_file(tmpdir)
+    servers = read_capture(path)
+    servers[90600] = {}
+    write_capture(path, servers)
+    assert ReplayDbConnection('db', path).version == 120000
+    assert ReplayDbConnection('db', path, 90600).version == 90600
+    with pytest.raises(ValueError):
+        ReplayDbConnection('db', path, 100000)
+
+
+def test_replay_dict(tmpdir):
+    "Fetch the objects of a dictionary from a capture"
+    langs = LanguageDict(ReplayDbConnection('db', capture_file(tmpdir)))
+    assert list(langs.keys()) == ['plperl']
+    assert langs['plperl'].trusted
+    assert langs['plperl'].description == 'Perl'
+
+
+def test_record_save(tmpdir):
+    "Add the recorded queries to a capture"
+    path = capture_file(tmpdir)
+    dbconn = RecordingDbConnection('db', path=path)
+    dbconn._version = 120000
+    dbconn.record("SELECT nspname\n  FROM pg_namespace", None,
+                  [CapturedRow(['s1'], {'nspname': 0})])
+    dbconn.save()
+    replay = ReplayDbConnection('db', path)
+    assert [row['nspname'] for row in replay.fetchall(
+        "SELECT nspname FROM pg_namespace")] == ['s1']
+    assert len(replay.fetchall(Language.query(120000))) == 1
+
+
+def test_database_replay(tmpdir):
+    "Use a replay connection for the catalogs"
+    db = Database({'database': DB_CFG, 'options': Namespace(
+        replay_catalogs=capture_file(tmpdir))})
+    assert isinstance(db.dbconn, ReplayDbConnection)
+    assert db.dbconn.dbname == 'pyrseas_testdb'
+
+
+def test_record_varying(tmpdir):
+    "Refuse to replay a query whose results varied when recorded"
+    path = capture_file(tmpdir)
+    dbconn = RecordingDbConnection('db', path=path)
+    dbconn._version = 120000
+    query = "SELECT nspname FROM pg_namespace"
+    dbconn.record(query, None, [CapturedRow(['s1'], {'nspname': 0})], True)
+    dbconn.record(query, None, [CapturedRow(['s1'], {'nspname': 0}),
+                                CapturedRow(['s2'], {'nspname': 0})])
+    dbconn.record("SELECT 1", None, [CapturedRow([1], {'a': 0})])
+    dbconn.record("SELECT 1", None, [CapturedRow([2], {'a': 0})])
+    dbconn.save()
+    replay = ReplayDbConnection('db', path)
+    assert len(replay.fetchall(query)) == 2
+    with pytest.raises(ValueError):
+        replay.fetchone("SELECT 1")
+
+
+def deparse_key(newdef):
+    "Key of the deparsing of a temporary view"
+    return query_key(DEPARSE_QUERY, None, [
+        "SET LOCAL search_path TO sd, pg_catalog",
+        "CREATE TEMPORARY VIEW pyrseas_deparse AS %s" % newdef,
+        "SET LOCAL search_path TO pg_catalog"])
+
+
+def test_replay_deparse_views(tmpdir):
+    "Replay the deparsing of each changed view"
+    newdefs = ["SELECT 1::integer AS a", "SELECT 2::bigint AS b",
+               "SELECT c FROM t3"]
+    deparsed = [" SELECT 1 AS a;", " SELECT 2::bigint AS b;"]
+    path = str(tmpdir.join('catalogs.json.gz'))
+    queries = dict((deparse_key(newdef), {
+        'columns': ['pg_get_viewdef'], 'rows': [[defn]]})
+        for (newdef, defn) in zip(newdefs, deparsed))
+    queries[query_key("SHOW search_path")] = {
+        'columns': ['search_path'], 'rows': [['pg_catalog']]}
+    queries[query_key(
+        "CREATE TEMPORARY VIEW pyrseas_deparse AS %s" % newdefs[2], None,
+        ["SET LOCAL search_path TO sd, pg_catalog"])] = {
+        'error': 'relation "t3" does not exist'}
+    write_capture(path, {120000: queries})
+    db = Database({'database': DB_CFG, 'options': Namespace(
+        replay_catalogs=path)})
+    names = ['v1', 'v2', 'v3']
+    db.db = Namespace(tables=dict(
+        (('sd', name), View(name, 'sd', None, None, [], defn))
+        for (name, defn) in zip(names, [" SELECT 1 AS a;", " SELECT 2 AS b;",
+                                        " SELECT 3 AS c;"])))
+    db.ndb = Namespace(tables=dict(
+        (('sd', name), View(name, 'sd', None, None, [], defn))
+        for (name, defn) in zip(names, newdefs)))
+    db._deparse_views()
+    assert db.ndb.tables[('sd', 'v1')].definition == " SELECT 1 AS a;"
+    assert db.ndb.tables[('sd', 'v2')].definition == newdefs[1]
+    assert db.ndb.tables[('sd', 'v3')].definition == newdefs[2]
+
+
+def test_replay_error(tmpdir):
+    "Raise the error of a statement that failed when recorded"
+    path = str(tmpdir.join('catalogs.json.gz'))
+    write_capture(path, {120000: {
+        query_key("CREATE TEMPORARY VIEW v AS SELECT x"): {
+            'error': 'column "x" does not exist'},
+        query_key("SELECT 1"): {'columns': ['a'], 'rows': [[1]]}}})
+    dbconn = ReplayDbConnection('db', path)
+    with pytest.raises(DatabaseError):
+        dbconn.execute("CREATE TEMPORARY VIEW v AS SELECT x")
+    # the failed transaction was rolled back
+    assert dbconn.fetchone("SELECT 1")['a'] == 1
@@ -0,0 +1,152 @@
+# -*- coding: utf-8 -*-
+"""Test reading the metadata directory"""
+
+from argparse import Namespace
+
+import pytest
+
+from pyrseas.database import Database
+from pyrseas.yamlutil import yamldump
+from pyrseas.formats import map_format
+from pyrseas.mapwriter import MapWriter
+
+DB_CFG = {'dbname': 'pyrseas_testdb', 'username': None, 'password': None,
+          'host': None, 'port': None}
+SCHEMA_MAP = {'schema sd': {'owner': 'user1'}}
+TABLE_MAP = {'table t%d' % i: {'columns': [{'c1': {'type': 'integer'}}]}
+             for i in range(20)}
+
+
+def write_map(path, objmap):
+    path.write(yamldump(objmap))
+
+
+def metadata_dir(tmpdir):
+    "Create a metadata directory with a schema and some tables"
+    mdir = tmpdir.mkdir('metadata')
+    write_map(mdir.join('database.testdb.yaml'), {})
+    write_map(mdir.join('language.plpgsql.yaml'), {'language plpgsql': {}})
+    write_map(mdir.join('schema.sd.yaml'), SCHEMA_MAP)
+    sdir = mdir.mkdir('schema.sd')
+    for (key, val) in TABLE_MAP.items():
+        write_map(sdir.join('%s.yaml' % key.replace(' ', '.')), {key: val})
+    return mdir
+
+
+def database(mdir, **opts):
+    return Database({'database': DB_CFG, 'options': Namespace(**opts),
+                     'files': {'metadata_path': str(mdir)}})
+
+
+def test_map_from_dir(tmpdir):
+    "Read a metadata directory"
+    inmap = database(metadata_dir(tmpdir)).map_from_dir()
+    expmap = {'language plpgsql': {}, 'schema sd': {'owner': 'user1'}}
+    expmap['schema sd'].update(TABLE_MAP)
+    assert inmap == expmap
+
+
+def test_map_from_dir_parallel(tmpdir):
+    "Read a metadata directory using several processes"
+    db = database(metadata_dir(tmpdir))
+    assert db.map_from_dir(jobs=3) == db.map_from_dir(jobs=1)
+
+
+def test_map_from_dir_bad_schema(tmpdir):
+    "Reject a schema file with more than one schema"
+    mdir = metadata_dir(tmpdir)
+    write_map(mdir.join('schema.sd.yaml'), {'schema sd': {}, 'schema s2': {}})
+    with pytest.raises(AssertionError):
+        database(mdir).map_from_dir(jobs=2)
+
+
+@pytest.fixture
+def cachedir(tmpdir, monkeypatch):
+    "A user cache directory, outside of the metadata directory"
+    path = tmpdir.join('cache')
+    monkeypatch.setenv('PYRSEAS_CACHE_DIR', str(path))
+    return path
+
+
+def test_map_from_dir_cached(tmpdir, cachedir):
+    "Read a metadata directory using the cache of parsed files"
+    mdir = metadata_dir(tmpdir)
+    db = database(mdir)
+    inmap = db.map_from_dir()
+    assert db.map_from_dir(cache='stat') == inmap
+    assert [path.basename.split('-')[0] for path in cachedir.listdir()] == [
+        'metadata']
+    assert not tmpdir.join('.pyrseas-cache').check()
+    assert db.map_from_dir(cache='stat') == inmap
+
+
+def test_map_from_dir_cache_changed(tmpdir, cachedir):
+    "Parse again a file changed after it was cached"
+    mdir = metadata_dir(tmpdir)
+    db = database(mdir)
+    db.map_from_dir(cache='digest')
+    write_map(mdir.join('schema.sd', 'table.t1.yaml'),
+              {'table t1': {'columns': [{'c2': {'type': 'text'}}]}})
+    inmap = db.map_from_dir(cache='digest')
+    assert inmap['schema sd']['table t1'] == {
+        'columns': [{'c2': {'type': 'text'}}]}
+    assert inmap == db.map_from_dir()
+
+
+def test_map_from_dir_cache_removed_file(tmpdir, cachedir):
+    "Omit a file removed after it was cached"
+    mdir = metadata_dir(tmpdir)
+    db = database(mdir)
+    db.map_from_dir(cache='stat')
+    mdir.join('schema.sd', 'table.t1.yaml').remove()
+    inmap = db.map_from_dir(cache='stat')
+    assert 'table t1' not in inmap['schema sd']
+
+
+def test_map_from_dir_schema_no_objects(tmpdir):
+    "Read a schema without a directory of objects"
+    mdir = metadata_dir(tmpdir)
+    write_map(mdir.join('schema.s2.yaml'), {'schema s2': {'owner': 'u2'}})
+    inmap = database(mdir).map_from_dir()
+    assert inmap['schema s2'] == {'owner': 'u2'}
+
+
+def test_map_from_dir_json(tmpdir):
+    "Read a metadata directory in JSON format"
+    mdir = tmpdir.mkdir('metadata')
+    writer = MapWriter(str(mdir), format=map_format('json'))
+    writer.add('language.plpgsql.json', {'language plpgsql': {}})
+    writer.add('schema.sd.json', SCHEMA_MAP)
+    for (key, val) in TABLE_MAP.items():
+        writer.add('schema.sd/%s.json' % key.replace(' ', '.'), {key: val})
+    writer.finish()
+    write_map(mdir.join('schema.s2.yaml'), {'schema s2': {}})
+    inmap = database(mdir, format='json').map_from_dir()
+    assert inmap == database(metadata_dir(tmpdir.mkdir('yaml'))).map_from_dir()
+
+
+def sharded_dir(tmpdir):
+    "Create a metadata directory with the sharded layout"
+    mdir = tmpdir.mkdir('metadata')
+    writer = MapWriter(str(mdir), layout='sharded')
+    writer.add('language.plpgsql.yaml', {'language plpgsql': {}})
+    writer.add('schema.sd.yaml', SCHEMA_MAP)
+    for (key, val) in TABLE_MAP.items():
+        writer.add(writer.object_path(
+            'schema.sd', '%s.yaml' % key.replace(' ', '.')), {key: val})
+    writer.finish()
+    return mdir
+
+
+def test_map_from_dir_sharded(tmpdir):
+    "Read a metadata directory with the sharded layout"
+    inmap = database(sharded_dir(tmpdir)).map_from_dir(jobs=2)
+    assert inmap == database(metadata_dir(tmpdir.mkdir('flat'))).map_from_dir()
+
+
+def test_map_from_dir_sharded_no_manifest(tmpdir):
+    "Read a sharded metadata directory whose manifest was removed"
+    mdir = sharded_dir(tmpdir)
+    mdir.join('manifest.yaml').remove()
+    inmap = database(mdir).map_from_dir()
+    assert inmap == database(metadata_dir(tmpdir.mkdir('flat'))).map_from_dir()
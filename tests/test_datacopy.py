@@ -0,0 +1,648 @@
+# -*- coding: utf-8 -*-
+"""Test copying the data of static tables out and in"""
+import struct
+import threading
+
+import pytest
+
+from pyrseas.datacopy import DataExporter, compression_of_file, data_ext
+from pyrseas.datacopy import copy_command
+from pyrseas.datacopy import open_data_file, BinaryHeaderWriter
+from pyrseas.datacopy import BINARY_SIGNATURE, binary_compatible
+from pyrseas.datacopy import binary_header, read_binary_header
+from pyrseas.datacopy import ChunkedExport, range_condition, read_chunks
+from pyrseas.datacopy import BulkLoad, files_checksum, read_state
+from pyrseas.datacopy import sort_csv_file
+from pyrseas.dbobject import DeferredStmt
+from pyrseas.dbobject.constraint import CheckConstraint, ForeignKey
+from pyrseas.dbobject.constraint import PrimaryKey, UniqueConstraint
+from pyrseas.dbobject.column import Column
+from pyrseas.dbobject.index import Index
+from pyrseas.dbobject.table import Table
+
+
+class FakeConnection(object):
+    "A connection that records the statements executed"
+
+    def __init__(self, version=100000):
+        self.version = version
+        self.stmts = []
+        self.closed = False
+
+    def execute(self, query, args=None):
+        self.stmts.append(query)
+        return self
+
+    def fetchone(self, query, args=None):
+        self.stmts.append(query)
+        return ['00000003-0000001B-1']
+
+    def rollback(self):
+        self.stmts.append('ROLLBACK')
+
+    def close(self):
+        self.closed = True
+
+
+class FakeTable(object):
+    "A table that records the connection it was exported with"
+
+    def __init__(self, name, fail=False):
+        self.name = name
+        self.fail = fail
+        self.dbconn = None
+
+    def data_export(self, dbconn, dirpath, compression=None):
+        if self.fail:
+            raise IOError("No space left on device")
+        self.dbconn = dbconn
+        self.thread = threading.current_thread()
+
+
+def test_export_serial():
+    "Export each table when added, on the catalog connection"
+    leader = FakeConnection()
+    exporter = DataExporter(leader, FakeConnection)
+    table = FakeTable('t1')
+    exporter.add(table, '/tmp')
+    assert table.dbconn is leader
+    exporter.finish()
+    assert leader.stmts == ['ROLLBACK']
+
+
+def test_export_parallel():
+    "Export the tables on workers that share the leader's snapshot"
+    leader = FakeConnection()
+    workers = []
+
+    def connect():
+        workers.append(FakeConnection())
+        return workers[-1]
+
+    exporter = DataExporter(leader, connect, jobs=3)
+    tables = [FakeTable('t%d' % i) for i in range(10)]
+    for table in tables:
+        exporter.add(table, '/tmp')
+    assert all(table.dbconn is None for table in tables)
+    exporter.finish()
+    assert leader.stmts == ["SELECT pg_export_snapshot()", 'ROLLBACK']
+    assert len(workers) == 3
+    for worker in workers:
+        assert worker.stmts == [
+            "SET TRANSACTION ISOLATION LEVEL REPEATABLE READ, READ ONLY",
+            "SET TRANSACTION SNAPSHOT '00000003-0000001B-1'", 'ROLLBACK']
+        assert worker.closed
+    assert all(table.dbconn in workers for table in tables)
+    assert not any(table.thread is threading.current_thread()
+                   for table in tables)
+
+
+def test_export_parallel_error():
+    "Re-raise the error of a worker after all of them stopped"
+    exporter = DataExporter(FakeConnection(), FakeConnection, jobs=2)
+    exporter.add(FakeTable('t1', fail=True), '/tmp')
+    exporter.add(FakeTable('t2'), '/tmp')
+    with pytest.raises(IOError):
+        exporter.finish()
+    assert threading.active_count() == 1
+
+
+def test_export_old_server():
+    "Export serially if the server cannot share snapshots"
+    leader = FakeConnection(90100)
+    exporter = DataExporter(leader, FakeConnection, jobs=4)
+    table = FakeTable('t1')
+    exporter.add(table, '/tmp')
+    assert table.dbconn is leader
+
+
+def test_data_ext():
+    "Record the compression method in the extension of the data files"
+    assert data_ext() == data_ext('none') == 'data'
+    assert data_ext('gzip') == 'data.gz'
+    assert compression_of_file('/tmp/table.t1.data.gz') == 'gzip'
+    assert compression_of_file('/tmp/table.t1.data') is None
+    with pytest.raises(ValueError):
+        DataExporter(FakeConnection(), FakeConnection, compression='rar')
+
+
+def test_open_compressed(tmpdir):
+    "Compress and decompress a data file as it is written and read"
+    path = str(tmpdir.join('table.t1.data.gz'))
+    with open_data_file(path, 'wb') as f:
+        f.write(b'1,abc\n2,def\n')
+    with open(path, 'rb') as f:
+        assert f.read(2) == b'\x1f\x8b'
+    with open_data_file(path) as f:
+        assert f.read() == b'1,abc\n2,def\n'
+
+
+def test_import_compressed(tmpdir):
+    "Decompress the most recent data file of a table with psql"
+    table = Table('t1', 'sd', None, None, [])
+    assert table.data_import(str(tmpdir))[1] == (
+        "\\copy ", 'sd.t1', " from '", str(tmpdir.join('table.t1.data')),
+        "' csv")
+    tmpdir.join('table.t1.data').write('1,abc\n')
+    path = tmpdir.join('table.t1.data.gz')
+    path.write('')
+    path.setmtime(tmpdir.join('table.t1.data').mtime() + 1)
+    assert table.data_import(str(tmpdir))[1] == (
+        "\\copy ", 'sd.t1', " from program 'gzip -dc ", str(path), "' csv")
+
+
+def test_copy_command_quoted():
+    "Quote the paths of data files for psql and the shell"
+    assert copy_command(("\\copy ", 'sd.t1', " from '", "/tmp/it's.data",
+                         "' csv")) == "\\copy sd.t1 from '/tmp/it''s.data' csv"
+    assert copy_command((
+        "\\copy ", 'sd.t1', " from program 'gzip -dc ",
+        "/tmp/my data/it's.data.gz", "' csv")) == (
+        "\\copy sd.t1 from program 'gzip -dc "
+        "''/tmp/my data/it''\"''\"''s.data.gz''' csv")
+
+
+COLUMNS = [('c1', 'integer'), ('c2', 'text')]
+BINARY_DATA = BINARY_SIGNATURE + struct.pack('>II', 0, 0) + \
+    b'\x00\x02\x00\x00\x00\x04\x00\x00\x00\x01\xff\xff\xff\xff\xff\xff'
+
+
+def write_binary(path, columns=COLUMNS, version=150002):
+    with open_data_file(path, 'wb') as f:
+        writer = BinaryHeaderWriter(f, binary_header(version, columns))
+        # as received from the server, in arbitrary pieces
+        for i in range(0, len(BINARY_DATA), 7):
+            writer.write(BINARY_DATA[i:i + 7])
+
+
+def test_binary_header(tmpdir):
+    "Record the server version and column types in binary files"
+    path = str(tmpdir.join('table.t1.bin.gz'))
+    write_binary(path)
+    with open_data_file(path) as f:
+        data = f.read()
+    extension = binary_header(150002, COLUMNS)
+    assert data == BINARY_SIGNATURE + struct.pack(
+        '>II', 0, len(extension)) + extension + BINARY_DATA[19:]
+    header = read_binary_header(path)
+    assert header == {'version': 150002, 'columns': COLUMNS}
+    assert binary_compatible(header, COLUMNS, 150004)
+    assert not binary_compatible(header, COLUMNS, 140010)
+    assert not binary_compatible(header, [('c1', 'bigint'), ('c2', 'text')],
+                                 150002)
+    assert binary_compatible(None, COLUMNS, 90600)
+
+
+def binary_table(types):
+    table = Table('t1', 'sd', None, None, [])
+    table.columns = [Column(name, 'sd', 't1', num + 1, type)
+                     for (num, (name, type))
+                     in enumerate(zip(['c1', 'c2'], types))]
+    table._copy_format = 'binary'
+    return table
+
+
+def test_import_binary(tmpdir):
+    "Copy binary data as is into a table with the same column types"
+    path = str(tmpdir.join('table.t1.bin'))
+    write_binary(path)
+    stmts = binary_table(['integer', 'text']).data_import(str(tmpdir),
+                                                          150002)
+    assert stmts == ["TRUNCATE ONLY sd.t1", (
+        "\\copy ", 'sd.t1', " from '", path, "' with (format binary)")]
+
+
+def test_import_binary_missing(tmpdir):
+    "Copy from a binary file even if none was exported yet"
+    path = str(tmpdir.join('table.t1.bin'))
+    stmts = binary_table(['integer', 'text']).data_import(str(tmpdir))
+    assert stmts == ["TRUNCATE ONLY sd.t1", (
+        "\\copy ", 'sd.t1', " from '", path, "' with (format binary)")]
+
+
+def test_import_binary_cast(tmpdir):
+    "Cast binary data copied out of columns of other types"
+    path = str(tmpdir.join('table.t1.bin'))
+    write_binary(path)
+    stmts = binary_table(['bigint', 'text']).data_import(str(tmpdir),
+                                                         150002)
+    assert stmts == [
+        "TRUNCATE ONLY sd.t1",
+        "CREATE TEMPORARY TABLE pg_temp.sd_t1_data (c1 integer, c2 text)",
+        ("\\copy ", 'pg_temp.sd_t1_data', " from '", path,
+         "' with (format binary)"),
+        "INSERT INTO sd.t1 (c1, c2) SELECT c1::text::bigint, c2 "
+        "FROM pg_temp.sd_t1_data",
+        "DROP TABLE pg_temp.sd_t1_data"]
+
+
+def test_import_binary_no_cast(tmpdir):
+    "Convert binary data through text if the types have no cast"
+    path = str(tmpdir.join('table.t1.bin'))
+    write_binary(path)
+    table = binary_table(['date', 'text'])
+    table.primary_key = PrimaryKey('t1_pkey', 'sd', 't1', None, [1])
+    table._copy_mode = 'merge'
+    stmts = table.data_import(str(tmpdir), 150002)
+    assert stmts[0] == (
+        "CREATE TEMPORARY TABLE pg_temp.sd_t1_data (c1 integer, c2 text)")
+    # there is no integer to date cast, but '1' is rejected as a date
+    assert stmts[4] == (
+        "UPDATE sd.t1 t SET c2 = s.c2 FROM pg_temp.sd_t1_data s WHERE "
+        "(t.c1) = (s.c1::text::date) AND ROW(t.c2)::text IS DISTINCT FROM "
+        "ROW(s.c2)::text")
+
+
+class SampleConnection(FakeConnection):
+    "A connection that returns sampled keys and writes the COPY output"
+
+    def fetchone(self, query, args=None):
+        self.stmts.append(query)
+        return [1000.0]
+
+    def fetchall(self, query, args=None):
+        self.stmts.append(query)
+        return [[[str(i)]] for i in range(10)]
+
+    def sql_copy_to(self, sql, path):
+        self.stmts.append(sql)
+        with open(path, 'w') as f:
+            f.write(sql)
+
+
+def chunked_table(nchunks=3):
+    table = binary_table(['integer', 'text'])
+    table._copy_format = 'csv'
+    table._copy_chunks = nchunks
+    table.primary_key = PrimaryKey('t1_pkey', 'sd', 't1', None, [1])
+    return table
+
+
+def test_range_condition():
+    "Select a range of a multiple-column key"
+    cols = [('c1', 'integer'), ('c2', 'text')]
+    assert range_condition(cols, ['1', "it's"], ['5', 'a']) == (
+        "(c1, c2) >= ('1'::integer, 'it''s'::text) AND "
+        "(c1, c2) < ('5'::integer, 'a'::text)")
+    assert range_condition(cols[:1], None, ['5']) == "(c1) < ('5'::integer)"
+    assert range_condition(cols, None, None) is None
+
+
+def test_chunked_export(tmpdir):
+    "Export a table in chunks of key ranges listed in a manifest"
+    dbconn = SampleConnection()
+    exporter = DataExporter(dbconn, None)
+    exporter.add(chunked_table(), str(tmpdir))
+    assert "TABLESAMPLE SYSTEM (30.000000)" in dbconn.stmts[1]
+    manifest = read_chunks(str(tmpdir.join('table.t1.chunks')))
+    assert manifest['complete']
+    assert [(chunk['file'], chunk['lower'], chunk['upper'])
+            for chunk in manifest['chunks']] == [
+        ('table.t1.0000.data', None, ['3']),
+        ('table.t1.0001.data', ['3'], ['6']),
+        ('table.t1.0002.data', ['6'], None)]
+    assert tmpdir.join('table.t1.0001.data').read() == (
+        "COPY (SELECT * FROM sd.t1 WHERE (c1) >= ('3'::integer) AND (c1) < "
+        "('6'::integer) ORDER BY c1) TO STDOUT WITH CSV")
+    assert chunked_table().data_files(str(tmpdir)) == [
+        str(tmpdir.join(chunk['file'])) for chunk in manifest['chunks']]
+
+
+def test_chunked_export_resume(tmpdir):
+    "Resume an interrupted export with the chunks not yet written"
+    dbconn = SampleConnection()
+    export = ChunkedExport(chunked_table(), str(tmpdir))
+    chunks = export.plan(dbconn, 3)
+    export.run(dbconn, chunks[0])
+    with pytest.raises(ValueError):
+        chunked_table().data_files(str(tmpdir))
+    export = ChunkedExport(chunked_table(), str(tmpdir))
+    chunks = export.plan(dbconn, 3)
+    assert [chunk['file'] for chunk in chunks] == [
+        'table.t1.0001.data', 'table.t1.0002.data']
+    assert not tmpdir.join('.tmp.table.t1.0001.data').check()
+    # the number of chunks changed: start afresh
+    export = ChunkedExport(chunked_table(), str(tmpdir))
+    assert len(export.plan(dbconn, 2)) == 2
+    assert not tmpdir.join('table.t1.0000.data').check()
+
+
+class LoadConnection(FakeConnection):
+    "A connection that records the statements run in autocommit mode"
+
+    def __init__(self, log):
+        super(LoadConnection, self).__init__()
+        self.log = log
+        self.conn = None
+
+    def connect(self):
+        self.conn = self
+        self.autocommit = False
+
+    def execute(self, query, args=None):
+        assert self.autocommit
+        self.log.append(query)
+        return self
+
+    def close(self):
+        pass
+
+
+def test_bulk_load_run():
+    "Run each phase of a bulk load once the previous one is over"
+    bulk = BulkLoad()
+    bulk.add(["COPY t1"], [["CREATE INDEX t1_idx"]], ["ADD t1_fkey"],
+             [DeferredStmt("VALIDATE t1_fkey")])
+    bulk.add(["COPY t2"], [["CREATE INDEX t2_idx"], ["ADD t2_key"]],
+             ["ADD t2_check"], [DeferredStmt("VALIDATE t2_check")])
+    assert bulk.statements() == [
+        "COPY t1", "COPY t2", "CREATE INDEX t1_idx", "CREATE INDEX t2_idx",
+        "ADD t2_key", "ADD t1_fkey", "ADD t2_check", "VALIDATE t1_fkey",
+        "VALIDATE t2_check"]
+    log = []
+    bulk.run(lambda: LoadConnection(log), jobs=2)
+    assert sorted(log[:2]) == ["COPY t1", "COPY t2"]
+    assert sorted(log[2:5]) == ["ADD t2_key", "CREATE INDEX t1_idx",
+                                "CREATE INDEX t2_idx"]
+    assert log[5:7] == ["ADD t1_fkey", "ADD t2_check"]
+    assert sorted(log[7:]) == ["VALIDATE t1_fkey", "VALIDATE t2_check"]
+
+
+def bulk_tables():
+    t1 = binary_table(['integer', 'text'])
+    t1._copy_format = 'csv'
+    t1.primary_key = PrimaryKey('t1_pkey', 'sd', 't1', None, ['c1'])
+    t1.unique_constraints['t1_c2_key'] = UniqueConstraint(
+        't1_c2_key', 'sd', 't1', None, ['c2'])
+    t1.check_constraints['t1_c1_check'] = CheckConstraint(
+        't1_c1_check', 'sd', 't1', None, ['c1'], 'c1 > 0')
+    t1.indexes['t1_c2_idx'] = Index('t1_c2_idx', 'sd', 't1', None,
+                                    keys=['c2'])
+    t1.indexes['t1_c2_key'] = Index('t1_c2_key', 'sd', 't1', None,
+                                    unique=True, keys=['c2'])
+    t1.indexes['t1_c2_key']._for_constraint = True
+    t2 = Table('t2', 'sd', None, None, [])
+    fkey = ForeignKey('t2_c1_fkey', 'sd', 't2', None, ['c1'], 'sd.t1',
+                      ['c1'], 'a', 'a', 's')
+    t2.foreign_keys['t2_c1_fkey'] = fkey
+    t1._referred_by = [fkey]
+    for constr in list(t1.unique_constraints.values()) + \
+            list(t1.check_constraints.values()):
+        constr._table = t1
+    fkey._table = t2
+    fkey._references = t1
+    return (t1, t2)
+
+
+def test_bulk_import(tmpdir):
+    "Drop the indexes and constraints of a table loaded in bulk"
+    (t1, t2) = bulk_tables()
+    bulk = BulkLoad()
+    stmts = t1.data_import(str(tmpdir), bulk=bulk)
+    assert stmts == [
+        "ALTER TABLE sd.t2 DROP CONSTRAINT t2_c1_fkey",
+        "ALTER TABLE sd.t1 DROP CONSTRAINT t1_c1_check",
+        "ALTER TABLE sd.t1 DROP CONSTRAINT t1_c2_key",
+        "DROP INDEX sd.t1_c2_idx", "TRUNCATE ONLY sd.t1"]
+    assert bulk.loads == [[("\\copy ", 'sd.t1', " from '",
+                            str(tmpdir.join('table.t1.data')), "' csv")]]
+    assert bulk.indexes == [
+        ["ALTER TABLE sd.t1 ADD CONSTRAINT t1_c2_key UNIQUE (c2)"],
+        ["CREATE INDEX t1_c2_idx ON sd.t1 (c2)"]]
+    assert bulk.constraints == [
+        "ALTER TABLE sd.t1 ADD CONSTRAINT t1_c1_check CHECK (c1 > 0) "
+        "NOT VALID",
+        "ALTER TABLE sd.t2 ADD CONSTRAINT t2_c1_fkey FOREIGN KEY (c1) "
+        "REFERENCES sd.t1 (c1) NOT VALID"]
+    assert bulk.validations == [
+        "ALTER TABLE sd.t1 VALIDATE CONSTRAINT t1_c1_check",
+        "ALTER TABLE sd.t2 VALIDATE CONSTRAINT t2_c1_fkey"]
+    # the foreign key between both tables is only dropped once
+    assert t2.data_import(str(tmpdir), bulk=bulk) == ["TRUNCATE ONLY sd.t2"]
+
+
+def test_merge_import(tmpdir):
+    "Merge the data of a table with the existing rows"
+    table = chunked_table(None)
+    table._copy_mode = 'merge'
+    path = str(tmpdir.join('table.t1.data'))
+    assert table.data_import(str(tmpdir)) == [
+        "CREATE TEMPORARY TABLE pg_temp.sd_t1_data (LIKE sd.t1)",
+        ("\\copy ", 'pg_temp.sd_t1_data', " from '", path, "' csv"),
+        "ANALYZE pg_temp.sd_t1_data",
+        "DELETE FROM sd.t1 t WHERE NOT EXISTS (SELECT 1 FROM "
+        "pg_temp.sd_t1_data s WHERE (t.c1) = (s.c1))",
+        "UPDATE sd.t1 t SET c2 = s.c2 FROM pg_temp.sd_t1_data s WHERE "
+        "(t.c1) = (s.c1) AND ROW(t.c2)::text IS DISTINCT FROM "
+        "ROW(s.c2)::text",
+        "INSERT INTO sd.t1 (c1, c2) SELECT s.c1, s.c2 FROM "
+        "pg_temp.sd_t1_data s WHERE NOT EXISTS (SELECT 1 FROM sd.t1 t "
+        "WHERE (t.c1) = (s.c1))",
+        "DROP TABLE pg_temp.sd_t1_data"]
+
+
+def test_merge_import_generated(tmpdir):
+    "Merge into a table with identity and generated columns"
+    table = chunked_table(None)
+    table._copy_mode = 'merge'
+    table.columns[0].identity = 'always'
+    table.columns.append(Column('c3', 'sd', 't1', 3, 'integer',
+                                default='(c1 * 2)', generated='stored'))
+    path = str(tmpdir.join('table.t1.data'))
+    assert table.data_import(str(tmpdir)) == [
+        "CREATE TEMPORARY TABLE pg_temp.sd_t1_data (c1 integer, c2 text)",
+        ("\\copy ", 'pg_temp.sd_t1_data', " from '", path, "' csv"),
+        "ANALYZE pg_temp.sd_t1_data",
+        "DELETE FROM sd.t1 t WHERE NOT EXISTS (SELECT 1 FROM "
+        "pg_temp.sd_t1_data s WHERE (t.c1) = (s.c1))",
+        "UPDATE sd.t1 t SET c2 = s.c2 FROM pg_temp.sd_t1_data s WHERE "
+        "(t.c1) = (s.c1) AND ROW(t.c2)::text IS DISTINCT FROM "
+        "ROW(s.c2)::text",
+        "INSERT INTO sd.t1 (c1, c2) OVERRIDING SYSTEM VALUE SELECT s.c1, "
+        "s.c2 FROM pg_temp.sd_t1_data s WHERE NOT EXISTS (SELECT 1 FROM "
+        "sd.t1 t WHERE (t.c1) = (s.c1))",
+        "DROP TABLE pg_temp.sd_t1_data"]
+    dbconn = UnsortedConnection()
+    table.data_export(dbconn, str(tmpdir))
+    assert dbconn.stmts == [
+        "COPY (SELECT c1, c2 FROM sd.t1 ORDER BY c1) TO STDOUT WITH CSV"]
+
+
+class DigestConnection(SampleConnection):
+    "A connection that returns a digest of the rows of a range"
+
+    def __init__(self, changed=None):
+        super(DigestConnection, self).__init__()
+        self.changed = changed
+
+    def fetchone(self, query, args=None):
+        if not query.startswith("SELECT md5("):
+            return super(DigestConnection, self).fetchone(query, args)
+        self.stmts.append(query)
+        if self.changed is not None and self.changed in query:
+            return ['changed']
+        return [query.split(" WHERE ")[-1]]
+
+
+def test_key_columns_by_name():
+    "Resolve the key columns of an input table by their names"
+    table = chunked_table(None)
+    by_name = chunked_table(None)
+    by_name.primary_key = PrimaryKey('t1_pkey', 'sd', 't1', None, ['c1'])
+    assert by_name.key_columns() == table.key_columns() == [
+        ('c1', 'integer')]
+
+
+def test_merge_skip_chunks(tmpdir):
+    "Merge only the chunks whose rows differ from the existing ones"
+    table = chunked_table()
+    table._copy_mode = 'merge'
+    DataExporter(DigestConnection(), None).add(table, str(tmpdir))
+    manifest = read_chunks(str(tmpdir.join('table.t1.chunks')))
+    assert manifest['chunks'][1]['digest'] == (
+        "(c1) >= ('3'::integer) AND (c1) < ('6'::integer)")
+    dbconn = DigestConnection("('6'::integer)")
+    stmts = table.data_import(str(tmpdir), dbconn=dbconn)
+    assert stmts[1] == ("\\copy ", 'pg_temp.sd_t1_data', " from '",
+                        str(tmpdir.join('table.t1.0001.data')), "' csv")
+    assert stmts[3] == (
+        "DELETE FROM sd.t1 t WHERE (c1) >= ('3'::integer) AND (c1) < "
+        "('6'::integer) AND NOT EXISTS (SELECT 1 FROM pg_temp.sd_t1_data s "
+        "WHERE (t.c1) = (s.c1))")
+    assert [stmt[3] for stmt in stmts if isinstance(stmt, tuple)] == [
+        str(tmpdir.join('table.t1.0001.data')),
+        str(tmpdir.join('table.t1.0002.data'))]
+    # without a connection to compare with, all the chunks are merged
+    assert len([stmt for stmt in table.data_import(str(tmpdir))
+                if isinstance(stmt, tuple)]) == 3
+
+
+class CounterConnection(SampleConnection):
+    "A connection that returns the change counters of a table"
+
+    def __init__(self, counters):
+        super(CounterConnection, self).__init__()
+        self.counters = counters
+
+    def fetchone(self, query, args=None):
+        self.stmts.append(query)
+        return self.counters
+
+
+def test_export_skip_unchanged(tmpdir):
+    "Export a table again only if its counters or files changed"
+    table = chunked_table(None)
+    table._copy_skip_unchanged = True
+    dbconn = CounterConnection([16384, 10, 0, 0, None])
+    path = tmpdir.join('table.t1.data')
+
+    def export():
+        dbconn.stmts = []
+        exporter = DataExporter(dbconn, None)
+        exporter.add(table, str(tmpdir))
+        exporter.finish()
+        return len([stmt for stmt in dbconn.stmts
+                    if stmt != 'ROLLBACK']) > 1
+
+    assert export()
+    state = read_state(str(tmpdir.join('table.t1.export')))
+    assert state['counters'] == [16384, 10, 0, 0, None]
+    assert state['checksum'] == files_checksum([str(path)])
+    assert not export()
+    dbconn.counters = [16384, 10, 1, 0, None]
+    assert export()
+    path.write('1,abc\n')
+    assert export()
+    assert not export()
+    # the changes are not counted
+    dbconn.counters = None
+    assert export()
+
+
+def test_import_skip_unchanged(tmpdir):
+    "Load the data files only if they were not the last ones loaded"
+    table = chunked_table(None)
+    table._copy_skip_unchanged = True
+    tmpdir.join('table.t1.data').write('1,abc\n')
+    checksum = files_checksum([str(tmpdir.join('table.t1.data'))])
+    dbconn = FakeConnection()
+    assert table.data_import(str(tmpdir), dbconn=dbconn,
+                             loaded=checksum) == []
+    stmts = table.data_import(str(tmpdir), dbconn=dbconn, loaded='0123')
+    assert stmts[0] == "TRUNCATE ONLY sd.t1"
+    assert stmts[2:] == [
+        "DELETE FROM pyrseas.datacopy_loads WHERE (schema_name, table_name) "
+        "= ('sd', 't1')",
+        "INSERT INTO pyrseas.datacopy_loads (schema_name, table_name, "
+        "checksum) VALUES ('sd', 't1', '%s')" % checksum]
+    # the table was changed in the target database: load it again
+    assert len(table.data_import(str(tmpdir), loaded=checksum)) == 4
+
+
+CSV_DATA = b'3,"multi\nline"\n1,abc\n2,"say ""hi"""\n1,"a\nb"\n0,\n'
+
+
+def test_sort_csv_file(tmpdir):
+    "Sort the records of a CSV file, merging sorted runs if needed"
+    src = tmpdir.join('unsorted')
+    src.write_binary(CSV_DATA)
+    expected = b'0,\n1,"a\nb"\n1,abc\n2,"say ""hi"""\n3,"multi\nline"\n'
+    sort_csv_file(str(src), str(tmpdir.join('table.t1.data')))
+    assert tmpdir.join('table.t1.data').read_binary() == expected
+    path = str(tmpdir.join('table.t1.data.gz'))
+    sort_csv_file(str(src), path, budget=10)
+    with open_data_file(path) as f:
+        assert f.read() == expected
+    assert sorted(tmpdir.listdir()) == [
+        tmpdir.join('table.t1.data'), path, src]
+
+
+class UnsortedConnection(FakeConnection):
+    "A connection that outputs the rows of a table unsorted"
+
+    def sql_copy_to(self, sql, path):
+        self.stmts.append(sql)
+        with open(path, 'wb') as f:
+            f.write(CSV_DATA)
+
+
+def test_export_client_order(tmpdir):
+    "Copy out the rows unsorted and sort them on the client"
+    table = binary_table(['integer', 'text'])
+    table._copy_format = 'csv'
+    table._copy_order = 'client'
+    dbconn = UnsortedConnection()
+    table.data_export(dbconn, str(tmpdir))
+    assert dbconn.stmts == ["COPY (SELECT * FROM sd.t1) TO STDOUT WITH CSV"]
+    assert tmpdir.join('table.t1.data').read_binary().startswith(
+        b'0,\n1,"a\nb"\n')
+    assert tmpdir.listdir() == [tmpdir.join('table.t1.data')]
+
+
+def test_export_index_order(tmpdir):
+    "Read the rows in the order of a unique index on NOT NULL columns"
+    table = binary_table(['integer', 'text'])
+    table._copy_format = 'csv'
+    table._copy_order = 'index'
+    table.columns[1].not_null = False
+    table.indexes['t1_c2_idx'] = Index('t1_c2_idx', 'sd', 't1', None,
+                                       unique=True, keys=['c2'])
+    assert table.order_key() is None
+    table.indexes['t1_c1_idx'] = Index('t1_c1_idx', 'sd', 't1', None,
+                                       unique=True, keys=['c1'])
+    assert table.order_key() == ['c1']
+    dbconn = UnsortedConnection()
+    table.data_export(dbconn, str(tmpdir))
+    assert dbconn.stmts == [
+        "SET enable_sort = off",
+        "COPY (SELECT * FROM sd.t1 ORDER BY c1) TO STDOUT WITH CSV",
+        "RESET enable_sort"]
+
+
+def test_index_order_quoted():
+    "Order by a unique index on a column whose name must be quoted"
+    table = binary_table(['integer', 'text'])
+    table.columns[0].name = 'Key1'
+    table.indexes['t1_key_idx'] = Index('t1_key_idx', 'sd', 't1', None,
+                                        unique=True, keys=['Key1'])
+    assert table.order_key() == ['"Key1"']
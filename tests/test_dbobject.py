@@ -0,0 +1,86 @@
+# -*- coding: utf-8 -*-
+"""Test the mapping of database objects"""
+import copy
+
+from pyrseas.dbobject import DbSchemaObject
+
+
+class Widget(DbSchemaObject):
+    "An object with attributes of all the kinds mapped"
+
+    keylist = ['schema', 'name']
+
+
+class Gadget(Widget):
+    "An object with an attribute that is not mapped"
+
+    unmapped = Widget.unmapped + ('cache',)
+
+
+class FakeDb(object):
+    "A database without schemas"
+
+    schemas = {}
+
+
+def widget(cls, name, dep=None):
+    obj = cls(name, 'sd', "Object %s" % name)
+    obj.oid = 16384
+    obj.cache = {'rows': 10}
+    obj.keys = ['c1', 'c2']
+    obj.options = {'fillfactor': [70]}
+    obj._private = 'internal'
+    if dep is not None:
+        obj.depends_on = [dep]
+    return obj
+
+
+def deepcopy_map(obj, db):
+    "Map an object as to_map did, by deep-copying its attributes"
+    dct = copy.deepcopy(obj.__dict__)
+    for key in obj.keylist:
+        del dct[key]
+    if obj.description is None:
+        del dct['description']
+    if obj.owner is None:
+        del dct['owner']
+    if len(obj.privileges) == 0:
+        del dct['privileges']
+    dct.pop('oid', None)
+    deps = set(dct.pop('depends_on', ()))
+    deps -= obj.get_implied_deps(db)
+    if deps:
+        dct['depends_on'] = sorted([dep.extern_key() for dep in deps])
+    for key in list(dct.keys()):
+        if key.startswith('_'):
+            del dct[key]
+    return dct
+
+
+def test_to_map_cached_exclusions():
+    "Map the same attributes before and after caching the exclusions"
+    db = FakeDb()
+    obj = widget(Widget, 'w2', widget(Widget, 'w1'))
+    expmap = deepcopy_map(obj, db)
+    assert 'oid' not in expmap and expmap['depends_on'] == ['widget w1']
+    if '_map_excluded_attrs' in Widget.__dict__:
+        del Widget._map_excluded_attrs
+    assert obj.to_map(db) == expmap
+    assert '_map_excluded_attrs' in Widget.__dict__
+    assert obj.to_map(db) == expmap
+    # the lists and dictionaries are copied
+    obj.to_map(db)['options']['fillfactor'].append(80)
+    assert obj.options == {'fillfactor': [70]}
+
+
+def test_to_map_subclass_exclusions():
+    "Exclude the additional attributes of a subclass, but not its parent's"
+    db = FakeDb()
+    wdg = widget(Widget, 'w1')
+    obj = widget(Gadget, 'g1', wdg)
+    assert 'cache' in wdg.to_map(db)
+    expmap = deepcopy_map(obj, db)
+    del expmap['cache']
+    assert obj.to_map(db) == expmap
+    assert obj.to_map(db) == expmap
+    assert 'cache' in wdg.to_map(db)
@@ -0,0 +1,87 @@
+# -*- coding: utf-8 -*-
+"""Test the formats of database maps"""
+
+import pytest
+
+from pyrseas import formats
+from pyrseas.formats import map_format, format_of_file
+from pyrseas.yamlutil import MultiLineStr
+
+MAP = {'schema sd': {
+    'owner': 'user1', 'privileges': [{'user1': ['all']}, {'PUBLIC': [
+        'usage']}],
+    'sequence seq1': {'cache_value': 1, 'increment_by': 1,
+                      'max_value': None, 'start_value': 9223372036854775807},
+    'table t1': {'columns': [
+        {'c1': {'type': 'integer', 'not_null': True}},
+        {'c2': {'type': 'text', 'default': "'é'::text"}}],
+        'description': 'Table "t1"\twith\ttabs'},
+    'view v1': {'definition': MultiLineStr(" SELECT t1.c1\n   FROM t1;"),
+                'depends_on': ['table t1']}}}
+CASTS = [{'cast (smallint as boolean)': {'context': 'explicit'}},
+         {'cast (sd.d1 as integer)': {'context': 'implicit'}}]
+FORMATS = ['yaml', 'json'] + (['msgpack'] if formats.msgpack else [])
+
+
+@pytest.mark.parametrize('name', FORMATS)
+def test_round_trip(name):
+    "Load the same map as was dumped"
+    fmt = map_format(name)
+    assert fmt.load(fmt.dump(MAP)) == MAP
+
+
+@pytest.mark.parametrize('name', FORMATS)
+def test_convert(name):
+    "Convert between formats without loss"
+    fmt = map_format(name)
+    yaml = map_format('yaml')
+    inmap = fmt.load(fmt.dump(yaml.load(yaml.dump(MAP))))
+    assert yaml.load(yaml.dump(inmap)) == MAP
+
+
+@pytest.mark.parametrize('name', FORMATS)
+def test_concat(name):
+    "Combine the maps of objects sharing a file"
+    fmt = map_format(name)
+    data = fmt.concat([fmt.dump(objmap) for objmap in CASTS])
+    assert fmt.load(data) == dict(CASTS[0], **CASTS[1])
+    assert fmt.concat([fmt.dump(CASTS[0])]) == fmt.dump(CASTS[0])
+
+
+@pytest.mark.skipif(formats.orjson is None, reason="orjson not installed")
+def test_json_encoders_identical(monkeypatch):
+    "Output the same JSON with or without orjson"
+    fmt = map_format('json')
+    data = fmt.dump(MAP)
+    monkeypatch.setattr(formats, 'orjson', None)
+    assert fmt.dump(MAP) == data
+    assert fmt.load(data) == MAP
+
+
+def test_format_of_file():
+    "Recognize the format of a file from its extension"
+    assert format_of_file('schema.sd/table.t1.json').name == 'json'
+    assert format_of_file('schema.sd.yaml').name == 'yaml'
+    assert format_of_file('schema.sd/.table.t1.yaml.tmp') is None
+    with pytest.raises(ValueError):
+        map_format('xml')
+
+
+def test_abstract_format():
+    "Require the formats to implement all the methods"
+    with pytest.raises(TypeError):
+        formats.MapFormat()
+
+    class PartialFormat(formats.MapFormat):
+        def dump(self, objmap):
+            return b''
+
+    with pytest.raises(TypeError):
+        PartialFormat()
+
+
+def test_msgpack_missing(monkeypatch):
+    "Reject the msgpack format when the package is not installed"
+    monkeypatch.setattr(formats, 'msgpack', None)
+    with pytest.raises(ValueError):
+        map_format('msgpack')
@@ -0,0 +1,126 @@
+# -*- coding: utf-8 -*-
+"""Test writing the metadata directory"""
+import os
+
+import pytest
+
+from pyrseas.mapwriter import MapWriter, shard_name
+
+
+def write_dir(mdir, files, oldfiles=(), layout='flat'):
+    writer = MapWriter(str(mdir), layout=layout)
+    for (relpath, objmap) in files:
+        writer.add(relpath, objmap)
+    writer.finish(oldfiles)
+    return writer
+
+
+def test_write_files(tmpdir):
+    "Write files, creating the schema directory"
+    writer = write_dir(tmpdir, [('schema.s1.yaml', {'schema s1': {}}),
+                                ('schema.s1/table.t1.yaml', {'table t1': {}})])
+    assert tmpdir.join('schema.s1', 'table.t1.yaml').read() == \
+        'table t1: {}\n'
+    assert sorted(writer.written) == ['schema.s1.yaml',
+                                      'schema.s1/table.t1.yaml']
+
+
+def test_write_shared_file(tmpdir):
+    "Concatenate the objects that share a file"
+    write_dir(tmpdir, [('cast.yaml', {'cast (a as b)': {}}),
+                       ('cast.yaml', {'cast (c as d)': {}})])
+    assert tmpdir.join('cast.yaml').read() == \
+        'cast (a as b): {}\ncast (c as d): {}\n'
+
+
+def test_skip_unchanged(tmpdir):
+    "Rewrite only the files whose contents changed"
+    files = [('schema.s1.yaml', {'schema s1': {}}),
+             ('schema.s1/table.t1.yaml', {'table t1': {}})]
+    write_dir(tmpdir, files)
+    path = tmpdir.join('schema.s1.yaml')
+    os.utime(str(path), (0, 0))
+    writer = write_dir(tmpdir, [files[0], ('schema.s1/table.t1.yaml',
+                                           {'table t1': {'a': 1}})])
+    assert writer.written == ['schema.s1/table.t1.yaml']
+    assert path.mtime() == 0
+    assert tmpdir.join('schema.s1', 'table.t1.yaml').read() == \
+        'table t1:\n  a: 1\n'
+    assert [f.basename for f in tmpdir.join('schema.s1').listdir()] == \
+        ['table.t1.yaml']
+
+
+def test_remove_vanished(tmpdir):
+    "Remove only the files of objects that no longer exist"
+    oldfiles = ['schema.s1.yaml', 'schema.s1/table.t1.yaml',
+                'schema.s1/table.t2.yaml', 'schema.s2.yaml',
+                'schema.s2/table.t3.yaml']
+    write_dir(tmpdir, [(f, {f: {}}) for f in oldfiles])
+    writer = write_dir(tmpdir, [(f, {f: {}}) for f in oldfiles[:2]],
+                       oldfiles)
+    assert writer.written == []
+    assert sorted(writer.removed) == oldfiles[2:]
+    assert tmpdir.join('schema.s1', 'table.t1.yaml').check()
+    assert not tmpdir.join('schema.s1', 'table.t2.yaml').check()
+    assert not tmpdir.join('schema.s2').check()
+
+
+def test_write_budget(tmpdir):
+    "Write the buffered files when they exceed the budget"
+    writer = MapWriter(str(tmpdir), budget=20)
+    writer.add('schema.s1.yaml', {'schema s1': {}})
+    writer.checkpoint()
+    assert not tmpdir.join('schema.s1.yaml').check()
+    writer.add('schema.s2.yaml', {'schema s2': {}})
+    writer.checkpoint()
+    assert tmpdir.join('schema.s1.yaml').check()
+    assert writer.files == {}
+    writer.add('schema.s3.yaml', {'schema s3': {}})
+    writer.finish(['schema.s1.yaml', 'schema.s4.yaml'])
+    assert sorted(writer.written) == ['schema.s1.yaml', 'schema.s2.yaml',
+                                      'schema.s3.yaml']
+    assert tmpdir.join('schema.s1.yaml').check()
+
+
+def test_durability(tmpdir):
+    "Write files with each durability policy"
+    for policy in ['none', 'atomic', 'fsync']:
+        writer = MapWriter(str(tmpdir.join(policy)), durability=policy)
+        writer.add('schema.s1/table.t1.yaml', {'table t1': {}})
+        writer.finish()
+        assert tmpdir.join(policy, 'schema.s1', 'table.t1.yaml').read() == \
+            'table t1: {}\n'
+        assert tmpdir.join(policy, 'schema.s1').listdir() == [
+            tmpdir.join(policy, 'schema.s1', 'table.t1.yaml')]
+    with pytest.raises(ValueError):
+        MapWriter(str(tmpdir), durability='always')
+
+
+def test_sharded_layout(tmpdir):
+    "Write object files to shard directories, listed in a manifest"
+    writer = MapWriter(str(tmpdir), layout='sharded')
+    relpath = writer.object_path('schema.s1', 'table.t1.yaml')
+    shard = shard_name('table.t1.yaml')
+    assert relpath == os.path.join('schema.s1', shard, 'table.t1.yaml')
+    writer.add('schema.s1.yaml', {'schema s1': {}})
+    writer.add(relpath, {'table t1': {}})
+    writer.finish()
+    assert tmpdir.join('schema.s1', shard, 'table.t1.yaml').check()
+    assert tmpdir.join('manifest.yaml').read() == (
+        "files:\n  schema.s1.yaml:\n  - schema.s1/%s/table.t1.yaml\n"
+        "layout: sharded\n" % shard)
+
+
+def test_sharded_remove_empty_shard(tmpdir):
+    "Remove the shard directories left empty and a stale manifest"
+    writer = MapWriter(str(tmpdir), layout='sharded')
+    relpath = writer.object_path('schema.s1', 'table.t1.yaml')
+    files = [('schema.s1.yaml', {'schema s1': {}}), (relpath,
+                                                     {'table t1': {}})]
+    write_dir(tmpdir, files, layout='sharded')
+    writer = write_dir(tmpdir, files[:1], [f[0] for f in files])
+    assert writer.removed == [relpath, 'manifest.yaml']
+    assert not tmpdir.join('schema.s1').check()
+    assert tmpdir.listdir() == [tmpdir.join('schema.s1.yaml')]
+    with pytest.raises(ValueError):
+        MapWriter(str(tmpdir), layout='deep')
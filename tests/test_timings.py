@@ -0,0 +1,119 @@
+# -*- coding: utf-8 -*-
+"""Test the timings of the stages of a run"""
+import json
+
+try:
+    from StringIO import StringIO
+except ImportError:
+    from io import StringIO
+
+import pytest
+
+from pyrseas.mapwriter import MapWriter
+from pyrseas.timings import Collector, add_hook, remove_hook, timed
+from pyrseas.timings import count_query, count_rows
+
+
+@pytest.fixture
+def records():
+    recs = []
+    add_hook(recs.append)
+    yield recs
+    remove_hook(recs.append)
+
+
+def test_no_hooks():
+    "Measure nothing without hooks"
+    with timed('stage'):
+        count_query()
+        count_rows([('abc', None)])
+
+
+def test_stage_record(records):
+    "Record the queries, rows and bytes of a stage"
+    with timed('fetch TableDict'):
+        count_query()
+        count_rows([('abc', 12), ('de', None)])
+    assert len(records) == 1
+    rec = records[0]
+    assert rec['stage'] == 'fetch TableDict'
+    assert rec['depth'] == 0
+    assert (rec['queries'], rec['rows'], rec['bytes']) == (1, 2, 7)
+    assert rec['wall'] >= 0 and rec['cpu'] >= 0
+
+
+def test_nested_stages(records):
+    "Include the counts of the enclosed stages"
+    with timed('read catalogs'):
+        count_query()
+        with timed('fetch SchemaDict'):
+            count_query()
+            count_rows([('s1',)])
+    assert [(rec['stage'], rec['depth'], rec['queries']) for rec in
+            records] == [('fetch SchemaDict', 1, 1), ('read catalogs', 0, 2)]
+
+
+def test_stage_error(records):
+    "Record a stage that raises an error"
+    with pytest.raises(KeyError):
+        with timed('link references'):
+            raise KeyError('t1')
+    assert records[0]['stage'] == 'link references'
+    with timed('generate drops'):
+        pass
+    assert records[1]['depth'] == 0
+
+
+def test_writer_stage(tmpdir, records):
+    "Time the writing of the metadata files"
+    writer = MapWriter(str(tmpdir))
+    writer.add('schema.s1.yaml', {'schema s1': {}})
+    writer.finish()
+    assert [rec['stage'] for rec in records] == ['write files']
+
+
+def test_collector_summary():
+    "Summarize the stages in the order they started"
+    collector = Collector('dbtoyaml')
+    add_hook(collector)
+    with timed('read catalogs'):
+        for i in range(2):
+            with timed('fetch TableDict'):
+                count_query()
+                count_rows([('t1',), ('t2',)])
+        with timed('dependency graph'):
+            count_query()
+    with timed('output map'):
+        pass
+    out = StringIO()
+    collector.report(out)
+    lines = out.getvalue().splitlines()
+    assert lines[0].split()[:2] == ['stage', 'calls']
+    assert [line.split()[:2] for line in lines[1:]] == [
+        ['read', 'catalogs'], ['fetch', 'TableDict'], ['dependency', 'graph'],
+        ['output', 'map']]
+    assert lines[2].startswith('  fetch TableDict')
+    assert lines[2].split()[2:3] == ['2']
+    assert lines[2].split()[5:] == ['2', '4', '8']
+    with timed('unreported'):
+        pass
+    assert len(collector.records) == 5
+
+
+def test_collector_json(tmpdir):
+    "Append the records of a run as JSON lines"
+    path = str(tmpdir.join('timings.jsonl'))
+    for i in range(2):
+        collector = Collector('yamltodb', False, path)
+        add_hook(collector)
+        with timed('generate statements'):
+            count_query()
+        collector.report()
+    with open(path) as f:
+        lines = [json.loads(line) for line in f]
+    assert len(lines) == 2
+    assert lines[0]['program'] == 'yamltodb'
+    assert lines[0]['stage'] == 'generate statements'
+    assert lines[0]['queries'] == 1
+    assert lines[0]['start'] >= 0
+    assert 'started' in lines[0]
@@ -0,0 +1,73 @@
+# -*- coding: utf-8 -*-
+"""Test YAML utilities"""
+
+import io
+
+import pytest
+from yaml import YAMLError
+
+from pyrseas.dbobject import DeferredStmt
+from pyrseas.yamlutil import LIBYAML, MultiLineStr, yamldump, yamlload
+from pyrseas.yamlutil import yamldump_items, yamlload_items
+from pyrseas.yamlutil import Dumper, PyDumper, SafeLoader, PySafeLoader
+
+DEFN = " SELECT t1.c1,\n    t1.c2\n   FROM t1;"
+MAP = {'schema sd': {'view v1': {'definition': MultiLineStr(DEFN),
+                                 'depends_on': ['table t1']},
+                     'table t1': {'columns': [
+                         {'c1': {'type': 'integer', 'not_null': True}},
+                         {'c2': {'type': 'text', 'default': "'é'::text"}}],
+                         'description': 'yes'}}}
+
+
+def test_multiline_block_style():
+    "Dump a multiline string in block style"
+    text = yamldump(MAP)
+    assert "definition: |2-\n       SELECT t1.c1," in text
+    assert yamlload(text) == MAP
+
+
+@pytest.mark.skipif(not LIBYAML, reason="PyYAML built without libyaml")
+def test_backends_identical():
+    "Dump and load the same with the libyaml and pure Python classes"
+    text = yamldump(MAP, Dumper)
+    assert text == yamldump(MAP, PyDumper)
+    assert yamlload(text, SafeLoader) == yamlload(text, PySafeLoader)
+
+
+def test_dump_items():
+    "Dump the items of a map one at a time, as if dumping the map"
+    dbmap = dict(MAP, **{'language plpgsql': {}, 'schema s2': {
+        'owner': 'user1'}, 'cast (smallint as boolean)': {
+            'context': 'explicit', 'method': 'function'}})
+    for objmap in (dbmap, {}):
+        stream = io.StringIO()
+        yamldump_items(sorted(objmap.items()), stream)
+        assert stream.getvalue() == yamldump(objmap)
+
+
+@pytest.mark.parametrize('loader', [SafeLoader, PySafeLoader])
+def test_load_items(loader):
+    "Load the items of a map one at a time, as if loading the map"
+    text = yamldump(dict(MAP, **{'language plpgsql': {}}))
+    items = list(yamlload_items(io.StringIO(text), loader))
+    assert [key for (key, val) in items] == ['language plpgsql', 'schema sd']
+    assert dict(items) == yamlload(text)
+    assert list(yamlload_items('', loader)) == []
+
+
+@pytest.mark.parametrize('loader', [SafeLoader, PySafeLoader])
+def test_load_items_not_map(loader):
+    "Reject a document that is not a map or more than one document"
+    for text in ('- schema sd\n', 'schema sd: {}\n---\nschema s2: {}\n'):
+        with pytest.raises(YAMLError):
+            list(yamlload_items(text, loader))
+
+
+@pytest.mark.parametrize('dumper', [Dumper, PyDumper])
+def test_dump_subclasses(dumper):
+    "Dump string subclasses and tuples as plain strings and lists"
+    objmap = {'stmt': DeferredStmt("VALIDATE CONSTRAINT c1"),
+              'keys': ('c1', 'c2')}
+    assert yamldump(objmap, dumper) == yamldump(
+        {'stmt': "VALIDATE CONSTRAINT c1", 'keys': ['c1', 'c2']}, dumper)
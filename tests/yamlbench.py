@@ -0,0 +1,88 @@
+# -*- coding: utf-8 -*-
+"""Benchmark the YAML backends used for Pyrseas maps
+
+Generates a synthetic database map and compares the time taken to
+dump and load it with the libyaml-based and the pure Python classes,
+and to load it one schema at a time, as yamltodb does (see
+:func:`~pyrseas.yamlutil.yamlload_items`).  It also checks that both
+dumpers produce the same output.  Run with:
+
+    python -m tests.yamlbench [schemas] [tables-per-schema]
+"""
+from __future__ import print_function
+import sys
+from timeit import default_timer
+
+from pyrseas.yamlutil import LIBYAML, MultiLineStr, yamldump, yamlload
+from pyrseas.yamlutil import yamlload_items
+from pyrseas.yamlutil import Dumper, PyDumper, SafeLoader, PySafeLoader
+
+
+def synthetic_map(nschemas, ntables):
+    "Return a database map with the given number of schemas and tables"
+    dbmap = {}
+    for i in range(nschemas):
+        schmap = {'owner': 'user%d' % i,
+                  'privileges': [{'user%d' % i: ['all']},
+                                 {'PUBLIC': ['usage']}]}
+        for j in range(ntables):
+            tbl = 't%d' % j
+            schmap['table %s' % tbl] = {
+                'columns': [{'c1': {'type': 'integer', 'not_null': True}},
+                            {'c2': {'type': 'text',
+                                    'default': "'é'::text"}},
+                            {'c3': {'type': 'timestamp with time zone',
+                                    'default': 'now()'}}],
+                'description': "Table %s in schema s%d" % (tbl, i),
+                'owner': 'user%d' % i,
+                'primary_key': {'%s_pkey' % tbl: {'columns': ['c1']}},
+                'indexes': {'%s_c2_idx' % tbl: {'keys': ['c2']}}}
+            schmap['view v%d' % j] = {
+                'definition': MultiLineStr(
+                    " SELECT %s.c1,\n    %s.c2\n   FROM %s\n  WHERE "
+                    "%s.c1 > 0;" % (tbl, tbl, tbl, tbl)),
+                'depends_on': ['table %s' % tbl]}
+        dbmap['schema s%d' % i] = schmap
+    return dbmap
+
+
+def timed(func, *args):
+    "Return the result of calling func and the seconds it took"
+    start = default_timer()
+    result = func(*args)
+    return (result, default_timer() - start)
+
+
+def load_items(text, loader):
+    "Load a map one top-level item at a time"
+    return dict(yamlload_items(text, loader))
+
+
+def main():
+    nschemas = int(sys.argv[1]) if len(sys.argv) > 1 else 10
+    ntables = int(sys.argv[2]) if len(sys.argv) > 2 else 200
+    dbmap = synthetic_map(nschemas, ntables)
+    if not LIBYAML:
+        print("PyYAML was built without libyaml: only the pure Python "
+              "backend is available")
+    backends = [('python', PyDumper, PySafeLoader)]
+    if LIBYAML:
+        backends.append(('libyaml', Dumper, SafeLoader))
+    outputs = []
+    print("%-8s %10s %10s %10s %10s %10s" % (
+        'backend', 'MB', 'dump s', 'load s', 'load MB/s', 'items s'))
+    for (name, dumper, loader) in backends:
+        (text, dumptime) = timed(yamldump, dbmap, dumper)
+        (loaded, loadtime) = timed(yamlload, text, loader)
+        (items, itemstime) = timed(load_items, text, loader)
+        size = len(text.encode('utf-8')) / 1048576.0
+        print("%-8s %10.2f %10.2f %10.2f %10.2f %10.2f" % (
+            name, size, dumptime, loadtime, size / loadtime, itemstime))
+        assert loaded == items == dbmap
+        outputs.append(text)
+    if len(outputs) > 1:
+        print("identical output: %s" % (outputs[0] == outputs[1]))
+
+
+if __name__ == '__main__':
+    main()